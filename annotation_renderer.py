@@ -0,0 +1,185 @@
+# annotation_renderer.py
+
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+# ----------------------------------------------------
+# 1. Style Configuration
+# ----------------------------------------------------
+# 与 Ultralytics 默认调色板一致 (RGB hex)，保证标注颜色和 result.plot() 相同
+PALETTE_HEX = (
+    "042AFF", "0BDBEB", "F3F3F3", "00DFB7", "111F68", "FF6FDD", "FF444F", "CCED00", "00F344", "BD00FF",
+    "00B4FF", "DD00BA", "00FFFF", "26C000", "01FFB3", "7D24FF", "7B0068", "FF1B6C", "FC6D2F", "A2FF0B",
+)
+# 转成 BGR，OpenCV 直接使用
+PALETTE_BGR = np.array([[int(h[i:i + 2], 16) for i in (4, 2, 0)] for h in PALETTE_HEX], dtype=np.uint8)
+
+# 文字标签缓存的条目上限（类别名 + 置信度字符串，数量有限）
+GLYPH_CACHE_SIZE = 512
+
+
+class RenderStyle:
+    """
+    Drawing options for render_result().
+    line_width=None follows result.plot(): max(round((H + W) / 2 * 0.003), 2).
+    """
+
+    def __init__(self, line_width: int = None, mask_alpha: float = 0.5, show_labels: bool = True,
+                 show_conf: bool = True, show_boxes: bool = True, show_masks: bool = True,
+                 font=cv2.FONT_HERSHEY_SIMPLEX):
+        self.line_width = line_width
+        self.mask_alpha = mask_alpha
+        self.show_labels = show_labels
+        self.show_conf = show_conf
+        self.show_boxes = show_boxes
+        self.show_masks = show_masks
+        self.font = font
+
+
+DEFAULT_STYLE = RenderStyle()
+
+# ----------------------------------------------------
+# 2. Helper Functions
+# ----------------------------------------------------
+
+_glyph_cache = OrderedDict()
+
+
+def _to_numpy(x) -> np.ndarray:
+    return x.cpu().numpy() if hasattr(x, "cpu") else np.asarray(x)
+
+
+def _text_alpha(text: str, font, font_scale: float, thickness: int) -> np.ndarray:
+    """Pre-rendered anti-aliased text mask (float32 0..1), cached by text and size."""
+    key = (text, font, font_scale, thickness)
+    alpha = _glyph_cache.get(key)
+    if alpha is not None:
+        _glyph_cache.move_to_end(key)
+        return alpha
+
+    (w, h), baseline = cv2.getTextSize(text, font, font_scale, thickness)
+    canvas = np.zeros((h + baseline + 3, w + 2), dtype=np.uint8)
+    cv2.putText(canvas, text, (1, h + 1), font, font_scale, 255, thickness, cv2.LINE_AA)
+    alpha = canvas.astype(np.float32) / 255.0
+
+    _glyph_cache[key] = alpha
+    if len(_glyph_cache) > GLYPH_CACHE_SIZE:
+        _glyph_cache.popitem(last=False)
+    return alpha
+
+
+def _label_alpha(name: str, conf_text: str, font, font_scale: float, thickness: int) -> np.ndarray:
+    # 类别名和置信度分开缓存再拼接：置信度只有 0.00-1.00 这 101 种
+    parts = [_text_alpha(name, font, font_scale, thickness)]
+    if conf_text:
+        parts.append(_text_alpha(" " + conf_text, font, font_scale, thickness))
+    height = max(p.shape[0] for p in parts)
+    padded = [np.pad(p, ((0, height - p.shape[0]), (0, 0))) for p in parts]
+    return np.hstack(padded)
+
+
+def _mask_overlay(mask_data: np.ndarray, colors: np.ndarray, out_h: int, out_w: int) -> tuple:
+    """
+    Collapses N instance masks into one color overlay (later instances on top)
+    at mask resolution, then undoes the letterbox and resizes once.
+    :return: (overlay BGR image, uint8 coverage mask), both at out_h x out_w.
+    """
+    n, h, w = mask_data.shape
+    covered = mask_data > 0.5
+    any_covered = covered.any(axis=0)
+    top_most = n - 1 - np.argmax(covered[::-1], axis=0)
+    # 在低分辨率上查表上色，比在原图尺寸上做花式索引快得多
+    overlay = colors[top_most]
+    coverage = any_covered.view(np.uint8)
+
+    if (h, w) != (out_h, out_w):
+        # 与 Ultralytics 的 letterbox 对应：去掉 padding 后再缩放回原图尺寸
+        gain = min(h / out_h, w / out_w)
+        pad_w, pad_h = (w - out_w * gain) / 2, (h - out_h * gain) / 2
+        top, left = int(round(pad_h - 0.1)), int(round(pad_w - 0.1))
+        bottom, right = h - int(round(pad_h + 0.1)), w - int(round(pad_w + 0.1))
+        overlay = cv2.resize(overlay[top:bottom, left:right], (out_w, out_h), interpolation=cv2.INTER_NEAREST)
+        coverage = cv2.resize(coverage[top:bottom, left:right], (out_w, out_h), interpolation=cv2.INTER_NEAREST)
+    return overlay, coverage
+
+
+def _draw_label(image: np.ndarray, x1: int, y1: int, alpha: np.ndarray, color: np.ndarray, pad: int) -> None:
+    H, W = image.shape[:2]
+    lh, lw = alpha.shape[0] + pad, alpha.shape[1] + pad
+    # 标签放在框上方，放不下就放到框内
+    top = y1 - lh if y1 - lh >= 0 else y1
+    top, left = max(top, 0), max(min(x1, W - lw), 0)
+    bottom, right = min(top + lh, H), min(left + lw, W)
+    if bottom <= top or right <= left:
+        return
+
+    # 浅色背景用深色字，深色背景用白色字（同 result.plot()）
+    brightness = 0.299 * color[2] + 0.587 * color[1] + 0.114 * color[0]
+    text_color = np.array([104, 31, 17] if brightness > 160 else [255, 255, 255], dtype=np.float32)
+
+    region = image[top:bottom, left:right]
+    region[:] = color
+    avail_h, avail_w = max(bottom - top - pad // 2, 0), max(right - left - pad // 2, 0)
+    a = alpha[:avail_h, :avail_w, None]
+    if a.size == 0:
+        return
+    sub = region[pad // 2:pad // 2 + a.shape[0], pad // 2:pad // 2 + a.shape[1]]
+    sub[:] = (sub * (1 - a) + text_color * a).astype(np.uint8)
+
+# ----------------------------------------------------
+# 3. Core Function
+# ----------------------------------------------------
+
+def render_result(result, names: dict = None, style: RenderStyle = DEFAULT_STYLE) -> np.ndarray:
+    """
+    Fast replacement for result.plot() on detection / segmentation results.
+    All instance masks are blended in a single vectorized pass, and label
+    text comes from a glyph cache instead of being rasterized per box.
+    :return: Annotated BGR image (a new array, result.orig_img is not modified).
+    """
+    # 姿态/旋转框/分类结果仍交给 Ultralytics 自己画
+    if getattr(result, "keypoints", None) is not None or getattr(result, "obb", None) is not None \
+            or getattr(result, "probs", None) is not None:
+        return result.plot()
+
+    image = np.ascontiguousarray(result.orig_img).copy()
+    H, W = image.shape[:2]
+    names = names if names is not None else getattr(result, "names", {}) or {}
+
+    boxes = result.boxes
+    n = len(boxes) if boxes is not None else 0
+    if n == 0:
+        return image
+
+    xyxy = _to_numpy(boxes.xyxy).astype(int)
+    confs = _to_numpy(boxes.conf)
+    classes = _to_numpy(boxes.cls).astype(int)
+    colors = PALETTE_BGR[classes % len(PALETTE_BGR)]
+
+    lw = style.line_width or max(round((H + W) / 2 * 0.003), 2)
+
+    # --- 1. 所有实例掩码：一次性合并 + 一次混合 ---
+    masks = getattr(result, "masks", None)
+    if style.show_masks and masks is not None:
+        overlay, coverage = _mask_overlay(_to_numpy(masks.data), colors, H, W)
+        if coverage.any():
+            # 整图混合一次，再只把被掩码覆盖的像素拷回
+            blended = cv2.addWeighted(image, 1 - style.mask_alpha, overlay, style.mask_alpha, 0)
+            cv2.copyTo(blended, coverage, image)
+
+    # --- 2. 边框 + 标签 ---
+    font_scale = lw / 3
+    thickness = max(lw - 1, 1)
+    for (x1, y1, x2, y2), conf, cls_id, color in zip(xyxy, confs, classes, colors):
+        color_t = tuple(int(c) for c in color)
+        if style.show_boxes:
+            cv2.rectangle(image, (x1, y1), (x2, y2), color_t, lw, cv2.LINE_AA)
+        if style.show_labels:
+            name = str(names.get(cls_id, cls_id))
+            conf_text = f"{conf:.2f}" if style.show_conf else ""
+            alpha = _label_alpha(name, conf_text, style.font, font_scale, thickness)
+            _draw_label(image, x1, y1, alpha, color, pad=lw)
+
+    return image
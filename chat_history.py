@@ -0,0 +1,131 @@
+# chat_history.py
+
+import os
+import re
+import hashlib
+from collections import OrderedDict
+from typing import List, Tuple, Union
+
+# ----------------------------------------------------
+# 1. Configuration
+# ----------------------------------------------------
+# 逐字保留的最近对话的 token 预算
+CHAT_HISTORY_TOKEN_BUDGET = int(os.environ.get("CHAT_HISTORY_TOKEN_BUDGET", "3000"))
+# 早期对话折叠成摘要后的 token 上限
+SUMMARY_TOKEN_BUDGET = int(os.environ.get("CHAT_SUMMARY_TOKEN_BUDGET", "600"))
+# 摘要中每条问/答保留的最大字符数
+SUMMARY_SNIPPET_CHARS = 160
+# 每条消息的固定开销（role、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_CACHE_SIZE = 256
+
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+_SENTENCE_END_RE = re.compile(r"(?<=[。！？.!?])\s*")
+
+# ----------------------------------------------------
+# 2. Token Estimation
+# ----------------------------------------------------
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap token estimate without a tokenizer:
+    about one token per CJK character, about four characters per token otherwise.
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def turn_tokens(user_msg: str, ai_msg: str) -> int:
+    return estimate_tokens(user_msg) + estimate_tokens(ai_msg) + 2 * MESSAGE_OVERHEAD_TOKENS
+
+# ----------------------------------------------------
+# 3. Rolling Summary
+# ----------------------------------------------------
+# 前缀哈希 -> 该前缀对应的摘要行；窗口每次只移动一两轮，所以只需在上一次结果上追加
+_summary_cache = OrderedDict()
+
+
+def _snippet(text: str) -> str:
+    text = " ".join(str(text).split()).replace("**", "")
+    first = _SENTENCE_END_RE.split(text, maxsplit=1)[0] or text
+    if len(first) > SUMMARY_SNIPPET_CHARS:
+        first = first[:SUMMARY_SNIPPET_CHARS].rstrip() + "…"
+    return first
+
+
+def _summarize_turn(user_msg: str, ai_msg: str) -> str:
+    line = f"- Q: {_snippet(user_msg)}"
+    if ai_msg:
+        line += f" / A: {_snippet(ai_msg)}"
+    return line
+
+
+def _prefix_hashes(turns: List[Tuple[str, str]]) -> list:
+    hashes = []
+    h = hashlib.sha1()
+    for user_msg, ai_msg in turns:
+        h.update(str(user_msg).encode("utf-8", errors="ignore") + b"\x00")
+        h.update(str(ai_msg).encode("utf-8", errors="ignore") + b"\x01")
+        hashes.append(h.copy().hexdigest())
+    return hashes
+
+
+def _summary_lines(folded: List[Tuple[str, str]]) -> list:
+    hashes = _prefix_hashes(folded)
+
+    # 找到已缓存的最长前缀，只对新折叠进来的轮次做摘要
+    start, lines = 0, []
+    for i in range(len(hashes) - 1, -1, -1):
+        cached = _summary_cache.get(hashes[i])
+        if cached is not None:
+            _summary_cache.move_to_end(hashes[i])
+            start, lines = i + 1, list(cached)
+            break
+
+    for i in range(start, len(folded)):
+        lines.append(_summarize_turn(*folded[i]))
+        # 超出摘要预算时丢弃最旧的行
+        while len(lines) > 1 and sum(estimate_tokens(l) for l in lines) > SUMMARY_TOKEN_BUDGET:
+            lines.pop(0)
+        _summary_cache[hashes[i]] = tuple(lines)
+        if len(_summary_cache) > SUMMARY_CACHE_SIZE:
+            _summary_cache.popitem(last=False)
+    return lines
+
+# ----------------------------------------------------
+# 4. Core Function
+# ----------------------------------------------------
+
+def fit_history(chat_history: List[Tuple[str, str]], budget: int = CHAT_HISTORY_TOKEN_BUDGET) -> tuple:
+    """
+    Splits the history into (summary_text, recent_turns).
+    The most recent turns are kept verbatim while they fit in `budget` tokens
+    (the newest turn is always kept). Older turns are folded into a compact
+    running summary, or summary_text is None if nothing had to be folded.
+    """
+    used = 0
+    keep_from = len(chat_history)
+    for i in range(len(chat_history) - 1, -1, -1):
+        cost = turn_tokens(*chat_history[i])
+        if used + cost > budget and keep_from < len(chat_history):
+            break
+        used += cost
+        keep_from = i
+
+    folded = chat_history[:keep_from]
+    recent = chat_history[keep_from:]
+    if not folded:
+        return None, recent
+
+    lines = _summary_lines(folded)
+    summary = f"Summary of the earlier conversation ({len(folded)} turns):\n" + "\n".join(lines)
+    return summary, recent
+
+
+def summary_message(summary: Union[str, None]) -> Union[dict, None]:
+    if not summary:
+        return None
+    return {"role": "system", "content": summary, "image_base64": None}
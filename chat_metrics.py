@@ -0,0 +1,154 @@
+# chat_metrics.py
+
+import json
+import time
+from typing import Union
+
+from metrics import histogram, counter, gauge
+from chat_history import estimate_tokens
+
+# ----------------------------------------------------
+# 1. Histograms
+# ----------------------------------------------------
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+
+PAYLOAD_BUILD = histogram("chat_payload_build_seconds", "Image payload (resize/base64/upload) plus prompt assembly.")
+CONNECT = histogram("chat_upstream_connect_seconds", "TCP (+TLS) connect to the Qwen backend; only for new connections.")
+UPSTREAM_TTFB = histogram("chat_upstream_ttfb_seconds", "Request sent to response headers received from the Qwen backend.")
+TTFT_SERVER = histogram("chat_ttft_server_seconds", "Request start to first token received from the backend.")
+TTFT_CLIENT = histogram("chat_ttft_client_seconds", "Request start to first chunk handed to the client connection.")
+INTER_TOKEN_GAP = histogram("chat_inter_token_gap_seconds", "Gap between consecutive streamed chunks from the backend.")
+TOKENS_PER_SECOND = histogram("chat_tokens_per_second", "Estimated output tokens per second after the first token.",
+                              RATE_BUCKETS)
+TOTAL = histogram("chat_total_seconds", "Whole chat request, start to last chunk.")
+REQUESTS = counter("chat_requests_total", "Chat requests by outcome.", ("outcome", "upstream"))
+ACTIVE = gauge("chat_streams_active", "Chat responses currently streaming.")
+
+# ----------------------------------------------------
+# 2. Per-attempt Timing (httpx trace extension)
+# ----------------------------------------------------
+
+class AttemptTiming:
+    """Timing of one upstream attempt, filled in by the httpx `trace` extension."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.start = time.perf_counter()
+        self.connect_started = None
+        self.connect_s = None
+        self.request_sent = None
+        self.ttfb_s = None
+
+    async def trace(self, event: str, info: dict) -> None:
+        now = time.perf_counter()
+        if event == "connection.connect_tcp.started":
+            self.connect_started = now
+        elif event in ("connection.connect_tcp.complete", "connection.start_tls.complete") and self.connect_started:
+            # TLS 握手完成时覆盖，connect 包含 TCP + TLS
+            self.connect_s = now - self.connect_started
+        elif event.endswith(".send_request_headers.started"):
+            self.request_sent = now
+        elif event.endswith(".receive_response_headers.complete") and self.request_sent:
+            self.ttfb_s = now - self.request_sent
+
+# ----------------------------------------------------
+# 3. Per-request Timing
+# ----------------------------------------------------
+
+class ChatTiming:
+    """
+    Collects the latency breakdown of one chat request and, on finish(),
+    feeds the histograms and prints one structured log line.
+    All times are relative to the moment the request entered astream_qwen_response.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.payload_build_s = None
+        self.attempts = []
+        self.winner = None
+        self.first_token_at = None
+        self.last_token_at = None
+        self.first_sent_at = None
+        self.chunks = 0
+        self.output_tokens = 0
+        self.max_gap_s = 0.0
+        self.upstream = False
+        self.image_sent = False
+        ACTIVE.inc()
+
+    # --- 上游（produce 内部）---
+    def payload_built(self, started: float) -> None:
+        self.payload_build_s = time.perf_counter() - started
+        self.upstream = True
+
+    def new_attempt(self, url: str) -> AttemptTiming:
+        attempt = AttemptTiming(url)
+        self.attempts.append(attempt)
+        return attempt
+
+    def upstream_chunk(self, text: str, attempt: Union[AttemptTiming, None] = None) -> None:
+        now = time.perf_counter()
+        if self.first_token_at is None:
+            self.first_token_at = now
+            self.winner = attempt
+        else:
+            gap = now - self.last_token_at
+            self.max_gap_s = max(self.max_gap_s, gap)
+            INTER_TOKEN_GAP.observe(gap)
+        self.last_token_at = now
+        self.chunks += 1
+        self.output_tokens += estimate_tokens(text)
+
+    # --- 下游（发给客户端）---
+    def chunk_sent(self) -> None:
+        if self.first_sent_at is None:
+            self.first_sent_at = time.perf_counter()
+
+    def finish(self, outcome: str) -> dict:
+        end = time.perf_counter()
+        attempt = self.winner or (self.attempts[-1] if self.attempts else None)
+        tokens_per_second = None
+        if self.first_token_at is not None and self.last_token_at > self.first_token_at:
+            tokens_per_second = self.output_tokens / (self.last_token_at - self.first_token_at)
+
+        record = {
+            "event": "chat_timing",
+            "outcome": outcome,
+            # upstream=False：命中缓存或合并到了别人的在途请求
+            "upstream": self.upstream,
+            "image_sent": self.image_sent,
+            "attempts": len(self.attempts),
+            "backend": attempt.url if attempt else None,
+            "payload_build_ms": _ms(self.payload_build_s),
+            "connect_ms": _ms(attempt.connect_s) if attempt else None,
+            "upstream_ttfb_ms": _ms(attempt.ttfb_s) if attempt else None,
+            "ttft_server_ms": _ms(self.first_token_at - self.start) if self.first_token_at else None,
+            "ttft_client_ms": _ms(self.first_sent_at - self.start) if self.first_sent_at else None,
+            "max_gap_ms": _ms(self.max_gap_s) if self.chunks > 1 else None,
+            "chunks": self.chunks,
+            "output_tokens": self.output_tokens,
+            "tokens_per_second": round(tokens_per_second, 2) if tokens_per_second else None,
+            "total_ms": _ms(end - self.start),
+        }
+
+        if self.payload_build_s is not None:
+            PAYLOAD_BUILD.observe(self.payload_build_s)
+        if attempt is not None:
+            CONNECT.observe(attempt.connect_s)
+            UPSTREAM_TTFB.observe(attempt.ttfb_s)
+        if self.first_token_at is not None:
+            TTFT_SERVER.observe(self.first_token_at - self.start)
+        if self.first_sent_at is not None:
+            TTFT_CLIENT.observe(self.first_sent_at - self.start)
+        TOKENS_PER_SECOND.observe(tokens_per_second)
+        TOTAL.observe(end - self.start)
+        REQUESTS.labels(outcome=outcome, upstream="yes" if self.upstream else "no").inc()
+        ACTIVE.dec()
+
+        print(f"DEBUG: chat_timing {json.dumps(record)}")
+        return record
+
+
+def _ms(seconds: Union[float, None]) -> Union[float, None]:
+    return round(seconds * 1000, 1) if seconds is not None else None
@@ -0,0 +1,271 @@
+# chunked_upload.py
+
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import asyncio
+import hashlib
+from typing import AsyncIterator
+
+from upload_ingest import ingest_stream, IngestResult, MAX_IMAGE_BYTES, MAX_VIDEO_BYTES
+
+# ----------------------------------------------------
+# 1. Configuration
+# ----------------------------------------------------
+# 会话目录放在 UPLOAD_DIR 下的隐藏目录里，每个会话一个子目录
+SESSION_DIR_NAME = ".chunked"
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+MIN_CHUNK_SIZE = 256 * 1024
+# 超过这个时间没完成的会话会被清理（创建新会话时和存储后台清理时）
+SESSION_TTL_SECONDS = 24 * 3600
+# 同时打开的会话数和它们声明的总字节数上限，防止半途而废的大文件堆满磁盘
+MAX_OPEN_SESSIONS = int(os.environ.get("CHUNKED_UPLOAD_MAX_SESSIONS", "32"))
+MAX_OPEN_SESSION_BYTES = int(os.environ.get("CHUNKED_UPLOAD_MAX_OPEN_MB", str(20 * 1024))) * 1024 * 1024
+
+MAX_BYTES_BY_KIND = {
+    "image": MAX_IMAGE_BYTES,
+    "video": MAX_VIDEO_BYTES,
+}
+
+_UPLOAD_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+# ----------------------------------------------------
+# 2. Errors
+# ----------------------------------------------------
+
+class ChunkedUploadError(Exception):
+    """Protocol error; status_code is the HTTP status the server should answer with."""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+# ----------------------------------------------------
+# 3. Session Management
+# ----------------------------------------------------
+
+def _sessions_root(upload_dir: str) -> str:
+    return os.path.join(upload_dir, SESSION_DIR_NAME)
+
+
+def _session_dir(upload_dir: str, upload_id: str) -> str:
+    # upload_id 来自 URL，必须校验格式，防止路径穿越
+    if not _UPLOAD_ID_RE.match(upload_id or ""):
+        raise ChunkedUploadError("Invalid upload id.", 404)
+    return os.path.join(_sessions_root(upload_dir), upload_id)
+
+
+def _chunk_path(session: dict, index: int) -> str:
+    return os.path.join(session["dir"], f"{index:06d}.part")
+
+
+def _expected_chunk_size(session: dict, index: int) -> int:
+    if index == session["total_chunks"] - 1:
+        return session["size"] - index * session["chunk_size"]
+    return session["chunk_size"]
+
+
+def cleanup_stale_sessions(upload_dir: str, ttl: int = SESSION_TTL_SECONDS) -> int:
+    """Removes sessions that received nothing for `ttl` seconds; returns how many."""
+    root = _sessions_root(upload_dir)
+    if not os.path.isdir(root):
+        return 0
+    now = time.time()
+    removed = 0
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            if now - os.path.getmtime(path) > ttl:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def _open_sessions(upload_dir: str) -> tuple:
+    """(number of open sessions, sum of their declared sizes)"""
+    root = _sessions_root(upload_dir)
+    if not os.path.isdir(root):
+        return 0, 0
+    count, total = 0, 0
+    for name in os.listdir(root):
+        try:
+            with open(os.path.join(root, name, "meta.json"), "r", encoding="utf-8") as f:
+                total += int(json.load(f)["size"])
+        except (OSError, ValueError, KeyError):
+            # 没有 meta.json 的目录（创建到一半）也占一个名额
+            pass
+        count += 1
+    return count, total
+
+
+def create_session(upload_dir: str, filename: str, size: int, kind: str,
+                   chunk_size: int = None, sha256: str = None) -> dict:
+    """
+    Starts a resumable upload. Returns the session info the client needs:
+    upload_id, chunk_size and total_chunks.
+    """
+    if kind not in MAX_BYTES_BY_KIND:
+        raise ChunkedUploadError(f"Unsupported upload kind: {kind}")
+    if size <= 0:
+        raise ChunkedUploadError("Upload size must be positive.")
+    if size > MAX_BYTES_BY_KIND[kind]:
+        raise ChunkedUploadError(f"Upload exceeds limit of {MAX_BYTES_BY_KIND[kind] // (1024 * 1024)} MB", 413)
+
+    chunk_size = min(max(chunk_size or DEFAULT_CHUNK_SIZE, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+    cleanup_stale_sessions(upload_dir)
+
+    # 检查和创建之间没有 await：在事件循环里调用时不会有两个请求同时通过检查
+    open_count, open_bytes = _open_sessions(upload_dir)
+    if open_count >= MAX_OPEN_SESSIONS:
+        raise ChunkedUploadError("Too many uploads in progress, please retry later.", 429)
+    if open_bytes + size > MAX_OPEN_SESSION_BYTES:
+        raise ChunkedUploadError("Not enough upload space right now, please retry later.", 507)
+
+    upload_id = uuid.uuid4().hex
+    session_dir = _session_dir(upload_dir, upload_id)
+    os.makedirs(session_dir)
+    meta = {
+        "upload_id": upload_id,
+        "filename": os.path.basename(filename or ""),
+        "size": size,
+        "kind": kind,
+        "chunk_size": chunk_size,
+        "total_chunks": (size + chunk_size - 1) // chunk_size,
+        "sha256": sha256.lower() if sha256 else None,
+        "created": time.time(),
+    }
+    with open(os.path.join(session_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    return meta
+
+
+def load_session(upload_dir: str, upload_id: str) -> dict:
+    session_dir = _session_dir(upload_dir, upload_id)
+    meta_path = os.path.join(session_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        raise ChunkedUploadError("Upload session not found or expired.", 404)
+    with open(meta_path, "r", encoding="utf-8") as f:
+        session = json.load(f)
+    session["dir"] = session_dir
+    return session
+
+
+def received_chunks(session: dict) -> list:
+    """Indices of chunks already stored with the right size."""
+    received = []
+    for index in range(session["total_chunks"]):
+        path = _chunk_path(session, index)
+        if os.path.exists(path) and os.path.getsize(path) == _expected_chunk_size(session, index):
+            received.append(index)
+    return received
+
+
+def missing_chunks(session: dict) -> list:
+    received = set(received_chunks(session))
+    return [i for i in range(session["total_chunks"]) if i not in received]
+
+
+def session_status(session: dict) -> dict:
+    return {
+        "upload_id": session["upload_id"],
+        "chunk_size": session["chunk_size"],
+        "total_chunks": session["total_chunks"],
+        "received": received_chunks(session),
+        "missing": missing_chunks(session),
+    }
+
+
+def discard_session(session: dict) -> None:
+    shutil.rmtree(session["dir"], ignore_errors=True)
+
+# ----------------------------------------------------
+# 4. Chunk Transfer & Assembly
+# ----------------------------------------------------
+
+async def write_chunk(session: dict, index: int, chunks: AsyncIterator[bytes], expected_sha256: str = None) -> None:
+    """
+    Stores one chunk. The chunk is written to a temp file and only renamed into
+    place once its size (and SHA-256, if the client sent one) checks out,
+    so an interrupted PUT never leaves a half chunk that counts as received.
+    """
+    if not 0 <= index < session["total_chunks"]:
+        raise ChunkedUploadError(f"Chunk index {index} out of range.")
+    expected_size = _expected_chunk_size(session, index)
+
+    final_path = _chunk_path(session, index)
+    temp_path = f"{final_path}.{uuid.uuid4().hex}.tmp"
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        with open(temp_path, "wb") as f:
+            async for data in chunks:
+                if not data:
+                    continue
+                size += len(data)
+                if size > expected_size:
+                    raise ChunkedUploadError(f"Chunk {index} is larger than {expected_size} bytes.")
+                hasher.update(data)
+                await asyncio.to_thread(f.write, data)
+
+        if size != expected_size:
+            raise ChunkedUploadError(f"Chunk {index} has {size} bytes, expected {expected_size}.")
+        if expected_sha256 and hasher.hexdigest() != expected_sha256.lower():
+            raise ChunkedUploadError(f"Chunk {index} checksum mismatch.", 422)
+        os.replace(temp_path, final_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+async def _iter_chunk_files(session: dict) -> AsyncIterator[bytes]:
+    for index in range(session["total_chunks"]):
+        with open(_chunk_path(session, index), "rb") as f:
+            yield await asyncio.to_thread(f.read)
+
+
+# 每个会话一把锁（带引用计数，用完即删）：重复的 complete 请求不会组装两次
+_assembly_locks = {}
+
+
+async def assemble(session: dict, upload_dir: str) -> IngestResult:
+    """
+    Concatenates all chunks into UPLOAD_DIR through the regular ingest path
+    (content-hash name, dedupe), verifies the whole-file hash and drops the session.
+    A second complete for the same session waits for the first and then gets a 409.
+    """
+    upload_id = session["upload_id"]
+    entry = _assembly_locks.setdefault(upload_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            if not os.path.exists(os.path.join(session["dir"], "meta.json")):
+                raise ChunkedUploadError("Upload already completed.", 409)
+            return await _assemble(session, upload_dir)
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _assembly_locks[upload_id]
+
+
+async def _assemble(session: dict, upload_dir: str) -> IngestResult:
+    missing = missing_chunks(session)
+    if missing:
+        raise ChunkedUploadError(f"Upload incomplete, missing chunks: {missing[:20]}", 409)
+
+    ingested = await ingest_stream(_iter_chunk_files(session), session["filename"], upload_dir,
+                                   MAX_BYTES_BY_KIND[session["kind"]])
+    if session["sha256"] and ingested.sha256 != session["sha256"]:
+        # 整体校验失败：删掉结果（若不是早已存在的重复文件）并让客户端重传
+        if not ingested.duplicate:
+            os.remove(ingested.path)
+        discard_session(session)
+        raise ChunkedUploadError("File checksum mismatch after assembly, please re-upload.", 422)
+
+    discard_session(session)
+    return ingested
@@ -0,0 +1,217 @@
+# detection_context.py
+
+import os
+import json
+from collections import defaultdict
+from typing import Union
+
+import numpy as np
+
+# ----------------------------------------------------
+# 1. Configuration
+# ----------------------------------------------------
+# 每个输出图片/关键帧拼图旁边写一个 <stem>.detections.json
+DETECTION_RECORD_SUFFIX = ".detections.json"
+RECORD_VERSION = 1
+
+# 注入 prompt 的检测条数上限（按置信度排序），避免 prompt 过长
+MAX_CONTEXT_DETECTIONS = int(os.environ.get("CHAT_MAX_CONTEXT_DETECTIONS", "15"))
+
+# 对话时是否附带图片：
+# always - 每次都发图片（默认，与原行为一致）
+# auto   - 只有第一轮（或没有检测记录时）发图片，后续追问只用文字版检测结果
+# never  - 只要有检测记录就不发图片
+IMAGE_MODES = ("always", "auto", "never")
+CHAT_IMAGE_MODE = os.environ.get("CHAT_IMAGE_MODE", "always").lower()
+
+# ----------------------------------------------------
+# 2. Building Records
+# ----------------------------------------------------
+
+def detection_record_path(output_path: str) -> str:
+    return os.path.splitext(output_path)[0] + DETECTION_RECORD_SUFFIX
+
+
+def mask_area_percentages(mask_data: np.ndarray, image_h: int, image_w: int) -> list:
+    """
+    Mask area as a percentage of the original image.
+    Masks live on the letterboxed inference canvas, so the padding is excluded
+    from the reference area.
+    """
+    if mask_data is None or len(mask_data) == 0:
+        return []
+    mh, mw = mask_data.shape[1:3]
+    gain = min(mh / image_h, mw / image_w)
+    image_area = max(image_h * gain * image_w * gain, 1.0)
+    areas = mask_data.reshape(len(mask_data), -1).sum(axis=1)
+    return [float(min(a / image_area * 100, 100.0)) for a in areas]
+
+
+def build_image_record(result, names: dict, image_h: int, image_w: int, model_name: str = "") -> dict:
+    """
+    Structured detections of one image: class, confidence, box normalized
+    to 0-1 (x1, y1, x2, y2) and mask area in percent (segmentation models).
+    """
+    detections = []
+    if len(result.boxes) > 0:
+        confs = result.boxes.conf.cpu().numpy().tolist()
+        class_ids = result.boxes.cls.cpu().numpy().astype(int).tolist()
+        boxes = result.boxes.xyxy.cpu().numpy()
+        areas = []
+        if getattr(result, "masks", None) is not None:
+            areas = mask_area_percentages(result.masks.data.cpu().numpy(), image_h, image_w)
+        scale = np.array([image_w, image_h, image_w, image_h], dtype=np.float32)
+        for j, (conf, class_id) in enumerate(zip(confs, class_ids)):
+            box = np.clip(boxes[j] / scale, 0.0, 1.0)
+            detections.append({
+                "class": names.get(class_id, f"Class {class_id}"),
+                "conf": round(float(conf), 3),
+                "box": [round(float(v), 4) for v in box],
+                "area_pct": round(areas[j], 2) if j < len(areas) else None,
+            })
+        detections.sort(key=lambda d: d["conf"], reverse=True)
+
+    return {
+        "version": RECORD_VERSION,
+        "source": "image",
+        "model": model_name,
+        "width": image_w,
+        "height": image_h,
+        "detections": detections,
+    }
+
+
+class VideoDetectionStats:
+    """Per-class counts, confidences and first/last appearance over the processed frames of a video."""
+
+    def __init__(self, fps: float):
+        self.fps = fps if fps and fps > 0 else 30.0
+        self.frames = 0
+        self.frames_with_detections = 0
+        self.last_frame_idx = -1
+        self.classes = defaultdict(lambda: {"count": 0, "frames": 0, "conf_sum": 0.0, "max_conf": 0.0,
+                                            "first_frame": None, "last_frame": None})
+
+    def add(self, frame_idx: int, class_names: list, confs: list) -> None:
+        self.frames += 1
+        self.last_frame_idx = frame_idx
+        if class_names:
+            self.frames_with_detections += 1
+        for name in set(class_names):
+            entry = self.classes[name]
+            entry["frames"] += 1
+            if entry["first_frame"] is None:
+                entry["first_frame"] = frame_idx
+            entry["last_frame"] = frame_idx
+        for name, conf in zip(class_names, confs):
+            entry = self.classes[name]
+            entry["count"] += 1
+            entry["conf_sum"] += conf
+            entry["max_conf"] = max(entry["max_conf"], conf)
+
+    def record(self, width: int, height: int, model_name: str = "", keyframes: list = None) -> dict:
+        classes = []
+        for name, e in sorted(self.classes.items(), key=lambda item: item[1]["count"], reverse=True):
+            classes.append({
+                "class": name,
+                "count": e["count"],
+                "frames": e["frames"],
+                "mean_conf": round(e["conf_sum"] / max(e["count"], 1), 3),
+                "max_conf": round(e["max_conf"], 3),
+                "first_seen_s": round(e["first_frame"] / self.fps, 2),
+                "last_seen_s": round(e["last_frame"] / self.fps, 2),
+            })
+        return {
+            "version": RECORD_VERSION,
+            "source": "video",
+            "model": model_name,
+            "width": width,
+            "height": height,
+            "duration_s": round((self.last_frame_idx + 1) / self.fps, 2),
+            "frames_processed": self.frames,
+            "frames_with_detections": self.frames_with_detections,
+            "classes": classes,
+            "keyframes": keyframes or [],
+        }
+
+
+def save_detection_record(output_path: str, record: dict) -> Union[str, None]:
+    path = detection_record_path(output_path)
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False, separators=(",", ":"))
+    except OSError as e:
+        print(f"DEBUG: Failed to write detection record {path}: {e}")
+        return None
+    return path
+
+
+def load_detection_record(image_path: Union[str, None]) -> Union[dict, None]:
+    """Record saved next to a context image (output image or keyframe contact sheet)."""
+    if not image_path:
+        return None
+    try:
+        with open(detection_record_path(image_path), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# ----------------------------------------------------
+# 3. Prompt Text
+# ----------------------------------------------------
+
+def _seconds(t: float) -> str:
+    return f"{int(t // 60):02d}:{t % 60:04.1f}"
+
+
+def format_detection_context(record: Union[dict, None]) -> Union[str, None]:
+    """Compact plain-text rendering of a detection record for the VLM prompt."""
+    if not record:
+        return None
+
+    if record.get("source") == "video":
+        lines = [f"YOLO detection results for the video ({record.get('frames_processed', 0)} frames analysed, "
+                 f"about {record.get('duration_s', 0):.1f} s, {record.get('width')}x{record.get('height')}; "
+                 f"{record.get('frames_with_detections', 0)} frames with findings):"]
+        if not record.get("classes"):
+            lines.append("- no objects detected")
+        for c in record.get("classes", [])[:MAX_CONTEXT_DETECTIONS]:
+            lines.append(f"- {c['class']}: {c['count']} detections in {c['frames']} frames, "
+                         f"mean conf {c['mean_conf']:.2f} (max {c['max_conf']:.2f}), "
+                         f"seen {_seconds(c['first_seen_s'])}-{_seconds(c['last_seen_s'])}")
+        if record.get("keyframes"):
+            lines.append("The attached image (if any) is a contact sheet of frames "
+                         + ", ".join(f"#{k}" for k in record["keyframes"]) + ".")
+        return "\n".join(lines)
+
+    detections = record.get("detections", [])
+    lines = [f"YOLO detection results for the image ({record.get('width')}x{record.get('height')}); "
+             f"boxes are [x1, y1, x2, y2] normalized to 0-1:"]
+    if not detections:
+        lines.append("- no objects detected")
+    for d in detections[:MAX_CONTEXT_DETECTIONS]:
+        line = f"- {d['class']} conf {d['conf']:.2f} box [{', '.join(f'{v:.3f}' for v in d['box'])}]"
+        if d.get("area_pct") is not None:
+            line += f" area {d['area_pct']:.2f}%"
+        lines.append(line)
+    if len(detections) > MAX_CONTEXT_DETECTIONS:
+        lines.append(f"- ... and {len(detections) - MAX_CONTEXT_DETECTIONS} more lower-confidence detections")
+    return "\n".join(lines)
+
+
+def detection_context_message(context_text: Union[str, None]) -> Union[dict, None]:
+    if not context_text:
+        return None
+    return {"role": "system", "content": context_text, "image_base64": None}
+
+
+def should_send_image(image_mode: Union[str, None], chat_history: list, has_record: bool) -> bool:
+    mode = (image_mode or CHAT_IMAGE_MODE).lower()
+    if mode not in IMAGE_MODES:
+        mode = "always"
+    # 没有检测记录时文字版上下文为空，只能发图片
+    if mode == "always" or not has_record:
+        return True
+    if mode == "auto":
+        return not chat_history
+    return False
@@ -0,0 +1,176 @@
+# media_serving.py
+
+import os
+import re
+import gzip
+import hashlib
+import mimetypes
+from typing import Dict, NamedTuple, Union
+
+from starlette.datastructures import Headers
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+try:
+    import brotli
+except ImportError:  # 可选依赖：没有时只提供 gzip
+    brotli = None
+
+# ----------------------------------------------------
+# 1. Configuration
+# ----------------------------------------------------
+IMMUTABLE_CACHE_CONTROL = "max-age=31536000, immutable"
+# 检测输出可能用同一个文件名重新生成（同一份上传换模型再跑），只能协商缓存
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+# 文件名里带内容哈希的文件永远不会变：报告按内容 key 命名，前端 bundle 由 vite 加哈希
+_CONTENT_ADDRESSED_MEDIA_RE = re.compile(r"^report_[0-9a-f]{16,}\.pdf$")
+_HASHED_ASSET_RE = re.compile(r"^.+-[A-Za-z0-9_-]{8}\.(js|css|woff2?|svg|png|jpg|webp)$")
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml", "application/xml")
+# 太小的文件压缩不划算
+MIN_COMPRESS_BYTES = 1024
+# vite 打包产物所在的目录：这里的路径不存在就是 404，不回退到 index.html
+SPA_ASSET_PREFIX = "assets/"
+
+# ----------------------------------------------------
+# 2. Media Files (/files, /reports)
+# ----------------------------------------------------
+
+def _strong_etag(stat_result: os.stat_result) -> str:
+    # 纳秒级 mtime + inode：原子替换（os.replace）后必然变化
+    raw = f"{stat_result.st_ino}-{stat_result.st_mtime_ns}-{stat_result.st_size}"
+    return '"' + hashlib.sha1(raw.encode("ascii")).hexdigest()[:20] + '"'
+
+
+class MediaFiles(StaticFiles):
+    """
+    StaticFiles with strong ETags and per-file cache policy. Content-addressed files
+    are cached as immutable; everything else is revalidated with If-None-Match.
+    Range requests (video seeking) are answered by FileResponse directly from disk.
+    """
+
+    def __init__(self, *args, cache_private: bool = True, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 医疗影像和报告不允许被共享缓存（CDN / 代理）保存
+        self.scope_prefix = "private, " if cache_private else "public, "
+
+    def lookup_path(self, path: str) -> tuple:
+        # 隐藏文件/目录（以 . 开头的路径段）一律不对外提供，哪怕其他模块把缓存放在了挂载目录下
+        if any(part.startswith(".") for part in re.split(r"[\\/]", path) if part):
+            return "", None
+        return super().lookup_path(path)
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> Response:
+        name = os.path.basename(full_path)
+        cache_control = IMMUTABLE_CACHE_CONTROL if _CONTENT_ADDRESSED_MEDIA_RE.match(name) else REVALIDATE_CACHE_CONTROL
+        headers = {"ETag": _strong_etag(stat_result), "Cache-Control": self.scope_prefix + cache_control}
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result, headers=headers)
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
+
+# ----------------------------------------------------
+# 3. Frontend Asset Index
+# ----------------------------------------------------
+
+class _Asset(NamedTuple):
+    media_type: str
+    etag: str
+    cache_control: str
+    variants: Dict[str, bytes]  # content-encoding ("identity" / "gzip" / "br") -> body
+
+
+def _accepted_encodings(header: str) -> set:
+    accepted = set()
+    for part in (header or "").split(","):
+        token, _, params = part.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q=") and q[2:].strip() in ("0", "0.0", "0.00", "0.000"):
+            continue
+        if token:
+            accepted.add(token.strip().lower())
+    return accepted
+
+
+class FrontendIndex:
+    """
+    The frontend bundle, loaded into memory once at startup with prebuilt
+    gzip/brotli variants. Requests never touch the filesystem, and unknown
+    paths fall back to index.html (SPA routing).
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.assets: Dict[str, _Asset] = {}
+        raw_bytes, stored_bytes = 0, 0
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                if filename.endswith((".gz", ".br")):
+                    continue
+                path = os.path.join(dirpath, filename)
+                rel_path = os.path.relpath(path, root).replace(os.sep, "/")
+                asset = self._load(path, filename)
+                self.assets[rel_path] = asset
+                raw_bytes += len(asset.variants["identity"])
+                stored_bytes += sum(len(v) for v in asset.variants.values())
+        self.index = self.assets.get("index.html")
+        print(f"DEBUG: Frontend index: {len(self.assets)} files, {raw_bytes / 1024:.0f} KB "
+              f"({stored_bytes / 1024:.0f} KB with gzip{'/br' if brotli else ''} variants)")
+
+    def _load(self, path: str, filename: str) -> _Asset:
+        with open(path, "rb") as f:
+            body = f.read()
+        media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        if media_type.startswith("text/") or media_type == "application/javascript":
+            media_type += "; charset=utf-8"
+        variants = {"identity": body}
+
+        if media_type.startswith(COMPRESSIBLE_TYPES) and len(body) >= MIN_COMPRESS_BYTES:
+            # 构建流程已经生成了 .gz / .br 时直接用（通常压缩率更高），否则启动时现压
+            for encoding, suffix in (("gzip", ".gz"), ("br", ".br")):
+                if os.path.exists(path + suffix):
+                    with open(path + suffix, "rb") as f:
+                        variants[encoding] = f.read()
+            if "gzip" not in variants:
+                variants["gzip"] = gzip.compress(body, compresslevel=9, mtime=0)
+            if "br" not in variants and brotli is not None:
+                variants["br"] = brotli.compress(body, quality=11)
+            # 压缩后反而更大的变体没有意义
+            variants = {k: v for k, v in variants.items() if k == "identity" or len(v) < len(body)}
+
+        etag = hashlib.sha256(body).hexdigest()[:20]
+        cache_control = "public, " + (IMMUTABLE_CACHE_CONTROL if _HASHED_ASSET_RE.match(filename)
+                                      else REVALIDATE_CACHE_CONTROL)
+        return _Asset(media_type, etag, cache_control, variants)
+
+    def lookup(self, path: str) -> Union[_Asset, None]:
+        path = path.lstrip("/")
+        asset = self.assets.get(path)
+        if asset is not None:
+            return asset
+        # 只有前端路由（不在 assets/ 下、没有扩展名）才回退到 index.html；
+        # 过期的哈希 bundle 等文件请求要得到 404，而不是 200 的 HTML（浏览器报 MIME 错误、缓存存错内容）
+        if path.startswith(SPA_ASSET_PREFIX) or os.path.splitext(path.rsplit("/", 1)[-1])[1]:
+            return None
+        return self.index
+
+    def response(self, path: str, request: Request) -> Response:
+        asset = self.lookup(path)
+        if asset is None:
+            return Response("Frontend missing." if self.index is None else "Not Found", status_code=404,
+                            headers={"Cache-Control": "no-store"})
+
+        accepted = _accepted_encodings(request.headers.get("accept-encoding"))
+        encoding = next((e for e in ("br", "gzip") if e in accepted and e in asset.variants), "identity")
+        # 每种编码的字节不同，ETag 也要不同
+        etag = f'"{asset.etag}"' if encoding == "identity" else f'"{asset.etag}-{encoding}"'
+        headers = {"ETag": etag, "Cache-Control": asset.cache_control, "Vary": "Accept-Encoding"}
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and etag in [t.strip().removeprefix("W/") for t in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(asset.variants[encoding], media_type=asset.media_type, headers=headers)
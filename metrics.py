@@ -0,0 +1,283 @@
+# metrics.py
+
+import bisect
+import threading
+from collections import OrderedDict, deque
+from typing import Callable, Sequence, Union
+
+# ----------------------------------------------------
+# 1. Configuration
+# ----------------------------------------------------
+# 延迟类指标的默认分桶（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# 分位数基于最近 N 个样本计算（分桶太粗，看不出 p99）
+RECENT_SAMPLES = 1024
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# ----------------------------------------------------
+# 2. Labels
+# ----------------------------------------------------
+
+class _Labeled:
+    """
+    Shared label handling: a metric declared with labelnames is a parent whose
+    labels(...) returns (and caches) one child per label-value combination.
+    A metric without labelnames records values itself.
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = OrderedDict()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, **labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._new_child()
+                self._children[key] = child
+            return child
+
+    def _series(self) -> list:
+        """[(label_dict, metric_with_values), ...]"""
+        if not self.labelnames:
+            return [({}, self)]
+        with self._lock:
+            items = list(self._children.items())
+        return [(dict(zip(self.labelnames, key)), child) for key, child in items]
+
+# ----------------------------------------------------
+# 3. Histogram
+# ----------------------------------------------------
+
+class Histogram(_Labeled):
+    """Cumulative-bucket histogram plus a window of recent samples for percentiles. Thread-safe."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS,
+                 labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)  # 最后一个是 +Inf
+        self._sum = 0.0
+        self._count = 0
+        self._recent = deque(maxlen=RECENT_SAMPLES)
+
+    def _new_child(self) -> "Histogram":
+        return Histogram(self.name, self.documentation, self.buckets)
+
+    def observe(self, value: float) -> None:
+        if value is None:
+            return
+        value = float(value)
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sum += value
+            self._count += 1
+            self._recent.append(value)
+
+    def cumulative_counts(self) -> list:
+        """[(upper_bound, cumulative_count), ...] ending with (inf, total)."""
+        with self._lock:
+            counts = list(self._counts)
+        result, running = [], 0
+        for bound, c in zip(self.buckets + (float("inf"),), counts):
+            running += c
+            result.append((bound, running))
+        return result
+
+    def snapshot(self) -> dict:
+        if self.labelnames:
+            return {_label_text(labels): child.snapshot() for labels, child in self._series()}
+        with self._lock:
+            samples = sorted(self._recent)
+            count, total = self._count, self._sum
+
+        def pick(q):
+            return samples[min(int(len(samples) * q / 100), len(samples) - 1)] if samples else 0.0
+
+        return {
+            "count": count,
+            "sum": round(total, 6),
+            "mean": round(total / count, 6) if count else 0.0,
+            "p50": round(pick(50), 6),
+            "p90": round(pick(90), 6),
+            "p99": round(pick(99), 6),
+            "max": round(samples[-1], 6) if samples else 0.0,
+        }
+
+    def _exposition(self, labels: dict) -> list:
+        lines = []
+        for bound, count in self.cumulative_counts():
+            le = "+Inf" if bound == float("inf") else _format_value(bound)
+            lines.append(f"{self.name}_bucket{_label_text(dict(labels, le=le))} {count}")
+        with self._lock:
+            total, count = self._sum, self._count
+        lines.append(f"{self.name}_sum{_label_text(labels)} {_format_value(total)}")
+        lines.append(f"{self.name}_count{_label_text(labels)} {count}")
+        return lines
+
+# ----------------------------------------------------
+# 4. Counter & Gauge
+# ----------------------------------------------------
+
+class Counter(_Labeled):
+    """Monotonically increasing count (requests, frames, errors)."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._value = 0.0
+
+    def _new_child(self) -> "Counter":
+        return Counter(self.name, self.documentation)
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+    def _exposition(self, labels: dict) -> list:
+        return [f"{self.name}{_label_text(labels)} {_format_value(self._value)}"]
+
+
+class Gauge(_Labeled):
+    """
+    Value that goes up and down (in-flight requests, queue depth). With `function`
+    the value is read at scrape time instead, so nothing has to be kept in sync.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 function: Union[Callable[[], Union[float, dict]], None] = None):
+        super().__init__(name, documentation, labelnames)
+        self._value = 0.0
+        # 带标签时 function 返回 {(label values...): value}
+        self._function = function
+
+    def _new_child(self) -> "Gauge":
+        return Gauge(self.name, self.documentation)
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self._value = float(value)
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self._value -= amount
+
+    @property
+    def value(self) -> float:
+        return float(self._function()) if self._function and not self.labelnames else self._value
+
+    def _series(self) -> list:
+        if self._function is None or not self.labelnames:
+            return super()._series()
+        try:
+            values = self._function() or {}
+        except Exception:
+            values = {}
+        series = []
+        for key, value in values.items():
+            key = key if isinstance(key, tuple) else (key,)
+            child = Gauge(self.name, self.documentation)
+            child._value = float(value)
+            series.append((dict(zip(self.labelnames, (str(k) for k in key))), child))
+        return series
+
+    def _exposition(self, labels: dict) -> list:
+        try:
+            value = self.value
+        except Exception:
+            return []
+        return [f"{self.name}{_label_text(labels)} {_format_value(value)}"]
+
+# ----------------------------------------------------
+# 5. Registry
+# ----------------------------------------------------
+_registry = OrderedDict()
+_registry_lock = threading.Lock()
+
+
+def _register(name: str, factory):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = factory()
+            _registry[name] = metric
+        return metric
+
+
+def histogram(name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS,
+              labelnames: Sequence[str] = ()) -> Histogram:
+    """Returns the histogram registered under `name`, creating it on first use."""
+    return _register(name, lambda: Histogram(name, documentation, buckets, labelnames))
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    return _register(name, lambda: Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = (),
+          function: Union[Callable, None] = None) -> Gauge:
+    return _register(name, lambda: Gauge(name, documentation, labelnames, function))
+
+
+def snapshot(prefix: str = "") -> dict:
+    """JSON-friendly percentiles of the registered histograms whose name starts with `prefix`."""
+    with _registry_lock:
+        metrics = [m for name, m in _registry.items() if name.startswith(prefix) and isinstance(m, Histogram)]
+    return {m.name: m.snapshot() for m in metrics}
+
+# ----------------------------------------------------
+# 6. Prometheus Text Exposition
+# ----------------------------------------------------
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels.items()) + "}"
+
+
+def render_prometheus() -> str:
+    """All registered metrics in the Prometheus text format (version 0.0.4)."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {_escape(metric.documentation)}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for labels, series in metric._series():
+            lines.extend(series._exposition(labels))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,126 @@
+# pipeline_metrics.py
+
+import time
+from contextlib import contextmanager
+
+from starlette.routing import Match
+
+from metrics import histogram, counter, gauge
+from request_profiling import active_profile
+
+# ----------------------------------------------------
+# 1. Stage Histograms
+# ----------------------------------------------------
+# pipeline 标签：image / video / realtime
+FRAME_RATE_BUCKETS = (0.5, 1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120, 240)
+
+UPLOAD_INGEST = histogram("upload_ingest_seconds", "Whole upload: receiving the body, hashing and writing it to disk.")
+UPLOAD_WRITE = histogram("upload_write_seconds", "Time spent in disk writes for one upload.")
+UPLOAD_BYTES = counter("upload_bytes_total", "Bytes received by uploads.")
+
+DECODE = histogram("image_decode_seconds", "Decoding one image or video frame.", labelnames=("pipeline",))
+INFERENCE = histogram("inference_seconds", "YOLO predict() on one image or frame.", labelnames=("pipeline",))
+PLOT = histogram("plot_seconds", "Drawing detections on one image or frame.", labelnames=("pipeline",))
+ENCODE = histogram("encode_seconds", "Encoding/writing one output: cv2.imwrite, VideoWriter.write or JPEG encode.",
+                   labelnames=("pipeline",))
+VIDEO_FPS = histogram("video_processing_fps", "Processed frames per second of one video job.", FRAME_RATE_BUCKETS)
+VIDEO_FRAMES = counter("video_frames_processed_total", "Video frames run through the model.")
+VIDEO_JOB = histogram("video_job_seconds", "Whole video job, first frame read to result.",
+                      (1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 3600))
+
+REPORT_RENDER = histogram("report_render_seconds", "Rendering one PDF report (cache misses only).")
+REPORTS = counter("reports_total", "Report requests by cache result.", labelnames=("cache",))
+
+# ----------------------------------------------------
+# 2. Outcomes & Gauges
+# ----------------------------------------------------
+DETECTION_JOBS = counter("detection_jobs_total", "Detection jobs by pipeline and outcome.",
+                         labelnames=("pipeline", "outcome"))
+
+VIDEO_JOBS_ACTIVE = gauge("video_jobs_active", "Video detection jobs currently running.")
+REALTIME_SESSIONS = gauge("realtime_sessions_active", "Open /ws/detect sessions.")
+REALTIME_DROPPED = counter("realtime_frames_dropped_total", "Realtime frames replaced by a newer one before processing.")
+
+# ----------------------------------------------------
+# 3. Helpers
+# ----------------------------------------------------
+
+@contextmanager
+def timed(metric, hot_path: str = None):
+    """
+    Observes the duration of the with-block on `metric` (a histogram or labeled child).
+    With `hot_path`, the same measurement also goes into the request profile when
+    one is active (see request_profiling); otherwise that costs one ContextVar lookup.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metric.observe(elapsed)
+        if hot_path is not None:
+            profile = active_profile.get()
+            if profile is not None:
+                profile.record(hot_path, elapsed)
+
+
+@contextmanager
+def tracked(metric):
+    """Increments a gauge for the duration of the with-block."""
+    metric.inc()
+    try:
+        yield
+    finally:
+        metric.dec()
+
+# ----------------------------------------------------
+# 4. HTTP Middleware
+# ----------------------------------------------------
+HTTP_REQUESTS = counter("http_requests_total", "HTTP requests by endpoint, method and status.",
+                        labelnames=("endpoint", "method", "status"))
+HTTP_DURATION = histogram("http_request_duration_seconds", "Request start to last body byte (streams included).",
+                          labelnames=("endpoint",))
+HTTP_IN_FLIGHT = gauge("http_requests_in_flight", "HTTP requests currently being handled.", labelnames=("endpoint",))
+
+# 挂载的静态目录按挂载点归类，避免每个文件名成为一个标签值
+def _endpoint(scope: dict) -> str:
+    app = scope.get("app")
+    for route in getattr(getattr(app, "router", None), "routes", ()):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", None) or "other"
+    return "other"
+
+
+class RequestMetricsMiddleware:
+    """
+    Pure ASGI middleware: counts requests by route template and status, tracks
+    in-flight requests and measures until the last body chunk, so streaming
+    endpoints (NDJSON video, chat, ZIP export) are measured end to end.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        endpoint = _endpoint(scope)
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        in_flight = HTTP_IN_FLIGHT.labels(endpoint=endpoint)
+        in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            in_flight.dec()
+            HTTP_REQUESTS.labels(endpoint=endpoint, method=scope.get("method", ""), status=status["code"]).inc()
+            HTTP_DURATION.labels(endpoint=endpoint).observe(time.perf_counter() - start)
@@ -0,0 +1,325 @@
+# qwen_backends.py
+
+import os
+import time
+import random
+import asyncio
+from collections import deque
+from typing import AsyncIterator, Callable, List, Union
+from urllib.parse import urlsplit
+
+from metrics import gauge
+
+# ----------------------------------------------------
+# 1. Configuration
+# ----------------------------------------------------
+DEFAULT_QWEN_API_URL = "http://61.169.118.10:8000/chat"
+# 多个后端用逗号分隔；未配置时退回单个 QWEN_API_URL
+QWEN_API_URLS = [u.strip() for u in os.environ.get(
+    "QWEN_API_URLS", os.environ.get("QWEN_API_URL", DEFAULT_QWEN_API_URL)).split(",") if u.strip()]
+if not QWEN_API_URLS:
+    # 配置成空字符串（或只有逗号）时用默认地址，不让 qwen_chat 导入时就崩
+    print(f"DEBUG: QWEN_API_URLS is empty, falling back to {DEFAULT_QWEN_API_URL}")
+    QWEN_API_URLS = [DEFAULT_QWEN_API_URL]
+
+# 主动健康检查：GET <scheme://host:port><QWEN_HEALTH_PATH>，空字符串表示关闭
+QWEN_HEALTH_PATH = os.environ.get("QWEN_HEALTH_PATH", "/health")
+HEALTH_CHECK_INTERVAL = float(os.environ.get("QWEN_HEALTH_INTERVAL", "10"))
+HEALTH_CHECK_TIMEOUT = 3.0
+
+# 熔断：连续失败 N 次后断开一段时间，之后放一个试探请求（half-open）
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("QWEN_CIRCUIT_FAILURES", "3"))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get("QWEN_CIRCUIT_OPEN_SECONDS", "30"))
+
+# 首 token 前失败时最多尝试几个后端
+MAX_ATTEMPTS = int(os.environ.get("QWEN_MAX_ATTEMPTS", "2"))
+
+# 对冲请求：首 token 迟迟不到时，向第二个后端再发一份，谁先出 token 用谁
+HEDGE_ENABLED = os.environ.get("QWEN_HEDGE", "0") == "1"
+HEDGE_PERCENTILE = float(os.environ.get("QWEN_HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_SAMPLES = 20
+# 样本不足时使用的默认对冲延迟（秒）
+HEDGE_DEFAULT_DELAY = float(os.environ.get("QWEN_HEDGE_DEFAULT_DELAY", "3"))
+TTFT_WINDOW = 200
+
+# ----------------------------------------------------
+# 2. Errors
+# ----------------------------------------------------
+
+class QwenUpstreamError(Exception):
+    """Non-200 answer from the Qwen backend; the message is shown to the user as-is."""
+
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def _uses_image_id(body: dict) -> bool:
+    return any(m.get("image_id") for m in body.get("messages", []) if isinstance(m, dict))
+
+
+# ----------------------------------------------------
+# 3. Backend State
+# ----------------------------------------------------
+
+class Backend:
+    def __init__(self, url: str):
+        self.url = url
+        parts = urlsplit(url)
+        self.health_url = f"{parts.scheme}://{parts.netloc}{QWEN_HEALTH_PATH}" if QWEN_HEALTH_PATH else None
+        self.outstanding = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.half_open_probe = False
+        self.ttft = deque(maxlen=TTFT_WINDOW)
+
+    def available(self, now: float) -> bool:
+        if not self.healthy:
+            return False
+        if self.open_until > now:
+            return False
+        # 熔断期刚过：只放行一个试探请求
+        if self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD and self.half_open_probe:
+            return False
+        return True
+
+    def record_success(self, ttft: Union[float, None]) -> None:
+        self.consecutive_failures = 0
+        self.half_open_probe = False
+        self.open_until = 0.0
+        if ttft is not None:
+            self.ttft.append(ttft)
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        self.half_open_probe = False
+        if self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+            self.open_until = time.monotonic() + CIRCUIT_OPEN_SECONDS
+            print(f"DEBUG: Circuit opened for {self.url} ({self.consecutive_failures} consecutive failures)")
+
+    def status(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "consecutive_failures": self.consecutive_failures,
+            "circuit_open": self.open_until > time.monotonic(),
+        }
+
+# ----------------------------------------------------
+# 4. Backend Pool
+# ----------------------------------------------------
+
+class BackendPool:
+    """
+    Least-outstanding-requests balancing over several Qwen-VL endpoints,
+    with active health checks, circuit breaking, failover before the first
+    token and optional hedged requests.
+    """
+
+    def __init__(self, urls: List[str]):
+        self.backends = [Backend(u) for u in urls]
+        self._health_task = None
+
+    # --- 选择后端 ---
+    def pick(self, exclude=()) -> Union[Backend, None]:
+        now = time.monotonic()
+        candidates = [b for b in self.backends if b not in exclude and b.available(now)]
+        if not candidates:
+            # 全部不可用时，不直接失败：挑熔断最早结束的那个试一下
+            fallback = [b for b in self.backends if b not in exclude]
+            if not fallback:
+                return None
+            chosen = min(fallback, key=lambda b: (b.open_until, b.outstanding))
+        else:
+            # 并发数相同时随机挑，避免总是压在列表第一个后端上
+            chosen = min(candidates, key=lambda b: (b.outstanding, random.random()))
+        if chosen.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+            chosen.half_open_probe = True
+        return chosen
+
+    def hedge_delay(self) -> float:
+        samples = sorted(t for b in self.backends for t in b.ttft)
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        index = min(int(len(samples) * HEDGE_PERCENTILE / 100), len(samples) - 1)
+        return samples[index]
+
+    def status(self) -> list:
+        return [b.status() for b in self.backends]
+
+    # --- 健康检查 ---
+    async def _check(self, client, backend: Backend) -> None:
+        try:
+            response = await client.get(backend.health_url, timeout=HEALTH_CHECK_TIMEOUT)
+            # 只要服务在应答（非 5xx）就认为是活的
+            healthy = response.status_code < 500
+        except Exception:
+            healthy = False
+        if healthy != backend.healthy:
+            print(f"DEBUG: Backend {backend.url} is now {'healthy' if healthy else 'unhealthy'}")
+        backend.healthy = healthy
+
+    async def _health_loop(self, client) -> None:
+        while True:
+            await asyncio.gather(*(self._check(client, b) for b in self.backends if b.health_url))
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+
+    def start_health_checks(self, client) -> None:
+        if QWEN_HEALTH_PATH and self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop(client))
+
+    async def stop_health_checks(self) -> None:
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+
+    # --- 单次尝试 ---
+    async def _attempt(self, client, backend: Backend, payload: Union[dict, Callable], parse_line: Callable,
+                       queue: asyncio.Queue, tag: int, attempt_timing=None) -> None:
+        backend.outstanding += 1
+        start = time.monotonic()
+        first = True
+        # 是否已经记录过成功/失败；没有记录就结束（被取消、4xx）时要释放试探名额
+        recorded = False
+        # httpx trace 扩展：记录 connect / TTFB（见 chat_metrics.AttemptTiming）
+        extensions = {"trace": attempt_timing.trace} if attempt_timing is not None else None
+        inline_images = False
+        try:
+            while True:
+                body = await payload(backend.url, inline_images) if callable(payload) else payload
+                async with client.stream("POST", backend.url, json=body, extensions=extensions) as response:
+                    if response.status_code != 200:
+                        text = (await response.aread()).decode("utf-8", errors="ignore")
+                        if response.status_code < 500 and not inline_images and _uses_image_id(body):
+                            # 后端不认识这个 image_id（过期、重启过）：在同一后端改用内联图片重发一次
+                            print(f"DEBUG: {backend.url} rejected image_id ({response.status_code}), resending inline")
+                            inline_images = True
+                            continue
+                        # 4xx 是请求本身的问题，换后端也没用
+                        retryable = response.status_code >= 500
+                        if retryable:
+                            backend.record_failure()
+                            recorded = True
+                        await queue.put((tag, "error", QwenUpstreamError(
+                            f"❌ API Error: Status {response.status_code} - {text}", retryable)))
+                        return
+                    async for line in response.aiter_lines():
+                        text = parse_line(line)
+                        if text:
+                            if first:
+                                backend.record_success(time.monotonic() - start)
+                                recorded = True
+                                first = False
+                            await queue.put((tag, "chunk", text))
+                break
+            if first:
+                backend.record_success(None)
+                recorded = True
+            await queue.put((tag, "done", None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            backend.record_failure()
+            recorded = True
+            await queue.put((tag, "error", e))
+        finally:
+            backend.outstanding -= 1
+            if not recorded:
+                # 否则 available() 永远返回 False，熔断过的后端再也拿不到流量
+                backend.half_open_probe = False
+
+    # --- 对外接口 ---
+    async def stream(self, client, payload: Union[dict, Callable], parse_line: Callable,
+                     timing=None) -> AsyncIterator[str]:
+        """
+        Streams one generation. Before the first token, a failed backend is
+        replaced by the next one (up to MAX_ATTEMPTS), and with hedging on a
+        second backend is raced once the wait exceeds the TTFT percentile.
+        After the first token the winning backend is used to the end.
+        `timing` (chat_metrics.ChatTiming, optional) receives per-attempt and per-chunk timings.
+        `payload` is the request body, or an async `payload(backend_url, inline_images)` that
+        builds it per backend (an uploaded image id is only valid on the backend that received it).
+        """
+        queue = asyncio.Queue()
+        tasks = {}
+        tried = []
+        attempt_timings = {}
+
+        def launch(backend: Backend) -> None:
+            tag = len(tried)
+            tried.append(backend)
+            print(f"DEBUG: Sending request to {backend.url}...")
+            attempt_timings[tag] = timing.new_attempt(backend.url) if timing is not None else None
+            tasks[tag] = asyncio.create_task(
+                self._attempt(client, backend, payload, parse_line, queue, tag, attempt_timings[tag]))
+
+        primary = self.pick()
+        if primary is None:
+            raise QwenUpstreamError("❌ No Qwen backend configured.", retryable=False)
+        launch(primary)
+
+        # 对冲会额外占用一次尝试机会
+        max_attempts = MAX_ATTEMPTS + (1 if HEDGE_ENABLED else 0)
+        winner = None
+        hedge_at = time.monotonic() + self.hedge_delay() if HEDGE_ENABLED and len(self.backends) > 1 else None
+        try:
+            while True:
+                timeout = None
+                if winner is None and hedge_at is not None:
+                    timeout = max(hedge_at - time.monotonic(), 0)
+                try:
+                    tag, kind, value = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    hedge_at = None
+                    hedge = self.pick(exclude=tried)
+                    if hedge is not None:
+                        print(f"DEBUG: First token slow, hedging to {hedge.url}")
+                        launch(hedge)
+                    continue
+
+                if winner is not None and tag != winner:
+                    continue
+
+                if kind == "chunk":
+                    if winner is None:
+                        winner = tag
+                        # 赢家确定，取消其余请求
+                        for other, task in tasks.items():
+                            if other != tag:
+                                task.cancel()
+                    if timing is not None:
+                        timing.upstream_chunk(value, attempt_timings[tag])
+                    yield value
+                elif kind == "done":
+                    return
+                else:
+                    tasks.pop(tag, None)
+                    if winner is not None:
+                        raise value
+                    still_running = any(not t.done() for t in tasks.values())
+                    retryable = getattr(value, "retryable", True)
+                    next_backend = self.pick(exclude=tried) if retryable and len(tried) < max_attempts else None
+                    if next_backend is None:
+                        if still_running:
+                            continue  # 另一路请求还在跑，等它
+                        raise value
+                    print(f"DEBUG: Backend {tried[tag].url} failed ({value}), failing over to {next_backend.url}")
+                    launch(next_backend)
+        finally:
+            for task in tasks.values():
+                task.cancel()
+
+
+backend_pool = BackendPool(QWEN_API_URLS)
+
+# 抓取时直接读后端状态，不需要额外维护
+gauge("qwen_backend_outstanding", "Requests in flight per Qwen backend.", ("backend",),
+      lambda: {b.url: b.outstanding for b in backend_pool.backends})
+gauge("qwen_backend_healthy", "1 if the backend passes health checks and its circuit is closed.", ("backend",),
+      lambda: {b.url: int(b.available(time.monotonic())) for b in backend_pool.backends})
@@ -1,121 +1,205 @@
 # qwen_chat.py (请直接完整覆盖此文件)
 
 import os
-import requests
-import base64
 import json
-from typing import List, Tuple, Iterator, Union
+import time
+import asyncio
+from typing import List, Tuple, AsyncIterator, Callable, Union
+
+import httpx
+
+from video_keyframes import resolve_context_image
+from chat_history import fit_history, summary_message
+from chat_metrics import ChatTiming
+from detection_context import (load_detection_record, format_detection_context,
+                               detection_context_message, should_send_image)
+from qwen_backends import backend_pool, QwenUpstreamError, QWEN_API_URLS
+from qwen_response_cache import cached_stream, response_cache_key
+from qwen_payload import get_image_payload, get_image_digest, forget_image_id
 
 # ----------------------------------------------------
 # 1. Configuration
 # ----------------------------------------------------
-QWEN_API_URL = "http://61.169.118.10:8000/chat" 
+# 后端地址列表见 qwen_backends.QWEN_API_URLS（QWEN_API_URL 保留为第一个地址）
+QWEN_API_URL = QWEN_API_URLS[0]
+QWEN_MODEL = "qwen3-vl"
+
+# 连接池：所有对话共享同一个 AsyncClient，复用 keep-alive 连接
+QWEN_MAX_CONNECTIONS = int(os.environ.get("QWEN_MAX_CONNECTIONS", "200"))
+QWEN_MAX_KEEPALIVE = int(os.environ.get("QWEN_MAX_KEEPALIVE", "50"))
+QWEN_KEEPALIVE_EXPIRY = float(os.environ.get("QWEN_KEEPALIVE_EXPIRY", "30"))
+
+# 超时（秒）：read 是两个数据块之间允许的最长间隔，沿用原来的 60s
+QWEN_CONNECT_TIMEOUT = float(os.environ.get("QWEN_CONNECT_TIMEOUT", "10"))
+QWEN_READ_TIMEOUT = float(os.environ.get("QWEN_READ_TIMEOUT", "60"))
+QWEN_WRITE_TIMEOUT = float(os.environ.get("QWEN_WRITE_TIMEOUT", "30"))
+QWEN_POOL_TIMEOUT = float(os.environ.get("QWEN_POOL_TIMEOUT", "10"))
+
+_async_client: Union[httpx.AsyncClient, None] = None
 
 # ----------------------------------------------------
-# 2. Helper Function
+# 2. Helper Functions
 # ----------------------------------------------------
-def encode_image_to_base64(image_path: str) -> str:
-    if not image_path or not os.path.exists(image_path):
+def get_async_client() -> httpx.AsyncClient:
+    """Shared pooled client, created lazily inside the running event loop."""
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=QWEN_MAX_CONNECTIONS,
+                max_keepalive_connections=QWEN_MAX_KEEPALIVE,
+                keepalive_expiry=QWEN_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(
+                connect=QWEN_CONNECT_TIMEOUT,
+                read=QWEN_READ_TIMEOUT,
+                write=QWEN_WRITE_TIMEOUT,
+                pool=QWEN_POOL_TIMEOUT,
+            ),
+            headers={"Content-Type": "application/json"},
+        )
+    return _async_client
+
+
+async def close_async_client() -> None:
+    global _async_client
+    await backend_pool.stop_health_checks()
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+def build_messages(message: str, chat_history: List[Tuple[str, str]], image_payload: dict = None,
+                   summary: Union[str, None] = None, detection_context: Union[str, None] = None) -> list:
+    messages = []
+    # 结构化检测结果（见 detection_context），纯文字模式下模型只靠它了解图像
+    if detection_context:
+        messages.append(detection_context_message(detection_context))
+    # 早期对话的滚动摘要（见 chat_history.fit_history）
+    if summary:
+        messages.append(summary_message(summary))
+    for h, a in chat_history:
+        messages.append({"role": "user", "content": str(h), "image_base64": None})
+        if a:
+            messages.append({"role": "assistant", "content": str(a), "image_base64": None})
+
+    # image_payload: {"image_base64": ...} 或 {"image_id": ...}（见 qwen_payload）
+    last_message = {"role": "user", "content": str(message), "image_base64": None}
+    last_message.update(image_payload or {})
+    messages.append(last_message)
+    return messages
+
+
+def parse_stream_line(line: str) -> Union[str, None]:
+    """
+    万能解析逻辑：兼容 `data:` 前缀的 SSE 行和裸 JSON 行，
+    以及 response / content / delta / text 多种字段名。
+    """
+    decoded_line = line.strip()
+    if not decoded_line:
+        return None
+
+    # 移除 data: 前缀（如果有）
+    json_content = decoded_line
+    if decoded_line.startswith('data:'):
+        json_content = decoded_line[5:].strip()
+
+    # 跳过结束符
+    if json_content == "[DONE]":
         return None
+
     try:
-        with open(image_path, "rb") as f:
-            return base64.b64encode(f.read()).decode("utf-8")
-    except Exception:
+        chunk = json.loads(json_content)
+        # 提取内容 (兼容多种字段名)
+        text = chunk.get("response", "") or chunk.get("content", "") or chunk.get("delta", "") or chunk.get("text", "")
+        return text or None
+    except (json.JSONDecodeError, AttributeError):
+        # 如果 JSON 解析失败，但只要不是空行，就直接当做文本返回！
+        # 这能防止因为格式不规范导致丢失信息
+        if "{" not in decoded_line:
+            return decoded_line
         return None
 
 # ----------------------------------------------------
 # 3. Core Functionality
 # ----------------------------------------------------
 
-def stream_qwen_response(
-    message: str, 
-    chat_history: List[Tuple[str, str]], 
+async def _stream_upstream(payload: Union[dict, Callable], timing: Union[ChatTiming, None] = None) -> AsyncIterator[str]:
+    # 负载均衡 / 熔断 / 故障转移 / 对冲都在 backend_pool 里处理
+    async for text in backend_pool.stream(get_async_client(), payload, parse_stream_line, timing):
+        yield text
+
+
+def start_backend_health_checks() -> None:
+    backend_pool.start_health_checks(get_async_client())
+
+
+async def astream_qwen_response(
+    message: str,
+    chat_history: List[Tuple[str, str]],
     context_path: Union[str, None],
-) -> Iterator[str]:
-    
-    # 1. 准备图片
-    image_base64_data = None
-    if context_path:
-        image_base64_data = encode_image_to_base64(context_path)
-
-    # 2. 构建消息
-    messages = []
-    for h, a in chat_history:
-        messages.append({"role": "user", "content": str(h), "image_base64": None})
-        if a:
-            messages.append({"role": "assistant", "content": str(a), "image_base64": None})
-            
-    messages.append({
-        "role": "user", 
-        "content": str(message), 
-        "image_base64": image_base64_data 
-    })
-
-    payload = {
-        "model": "qwen3-vl", 
-        "messages": messages,
-        "stream": True 
-    }
-    
+    image_mode: Union[str, None] = None,
+) -> AsyncIterator[str]:
+    """
+    Native async generator over the Qwen-VL stream. Each active chat is a
+    coroutine on the shared connection pool instead of a threadpool thread.
+    Identical requests are served from the response cache or share one
+    in-flight upstream generation. Every request logs a latency breakdown
+    (see chat_metrics.ChatTiming) and feeds the chat histograms.
+    image_mode: always / auto / never (see detection_context.CHAT_IMAGE_MODE);
+    when the image is skipped the model answers from the detection record text.
+    """
+
+    timing = ChatTiming()
+
+    async def produce() -> AsyncIterator[str]:
+        # 构建消息：最近几轮逐字保留，更早的折叠成摘要，prompt 长度不再随对话无限增长
+        summary, recent_history = fit_history(chat_history)
+
+        async def build_payload(backend_url: str, inline_images: bool = False) -> dict:
+            build_started = time.perf_counter()
+            # 准备图片：同一张图在整段对话里只编码一次；上传得到的 image_id 只对上传到的那个后端有效
+            if inline_images and image_path:
+                # 后端拒绝了缓存的 image_id：作废后这次改为内联
+                forget_image_id(image_path, backend_url)
+            image_payload = await get_image_payload(
+                image_path, get_async_client(), backend_url, inline_images) if image_path else None
+            payload = {
+                "model": QWEN_MODEL,
+                "messages": build_messages(message, recent_history, image_payload, summary, context_text),
+                "stream": True
+            }
+            timing.payload_built(build_started)
+            return payload
+
+        async for text in _stream_upstream(build_payload, timing):
+            yield text
+
+    outcome = "cancelled"
+    # ChatTiming 已经计入 chat_streams_active：从这里起任何 await 上的断开都必须走到 finish()
     try:
-        print(f"DEBUG: Sending request to {QWEN_API_URL}...")
-        
-        with requests.post(
-            QWEN_API_URL, 
-            headers={"Content-Type": "application/json"}, 
-            json=payload,
-            timeout=60, 
-            stream=True
-        ) as response:
-            
-            # 如果状态码不是 200，直接把错误吐给前端
-            if response.status_code != 200:
-                error_msg = f"❌ API Error: Status {response.status_code} - {response.text}"
-                print(error_msg)
-                yield error_msg
-                return
-
-            print("DEBUG: API connected, receiving stream...")
-
-            # --- 核心修改：万能解析逻辑 ---
-            for line in response.iter_lines():
-                if not line:
-                    continue
-                    
-                # 解码
-                decoded_line = line.decode('utf-8', errors='ignore').strip()
-                # 打印原始数据看看到底返回了啥（这行日志会救你的命）
-                # print(f"RAW DATA: {decoded_line}") 
-                
-                if not decoded_line:
-                    continue
-
-                # 移除 data: 前缀（如果有）
-                json_content = decoded_line
-                if decoded_line.startswith('data:'):
-                    json_content = decoded_line[5:].strip()
-
-                # 跳过结束符
-                if json_content == "[DONE]":
-                    continue
-
-                try:
-                    # 尝试解析 JSON
-                    chunk = json.loads(json_content)
-                    
-                    # 提取内容 (兼容多种字段名)
-                    text = chunk.get("response", "") or chunk.get("content", "") or chunk.get("delta", "") or chunk.get("text", "")
-                    
-                    # 如果解析到了文字，yield 出去
-                    if text:
-                        yield text
-                        
-                except json.JSONDecodeError:
-                    # 如果 JSON 解析失败，但只要不是空行，就直接当做文本返回！
-                    # 这能防止因为格式不规范导致丢失信息
-                    if len(decoded_line) > 0 and "{" not in decoded_line:
-                         yield decoded_line
-            
+        # 视频上下文改用关键帧拼图，避免把整段 MP4 塞进每次请求
+        image_path = resolve_context_image(context_path) if context_path else None
+        record = await asyncio.to_thread(load_detection_record, image_path) if image_path else None
+        context_text = format_detection_context(record)
+        if image_path and not should_send_image(image_mode, chat_history, record is not None):
+            image_path = None
+        image_digest = await asyncio.to_thread(get_image_digest, image_path) if image_path else None
+        cache_key = response_cache_key(message, chat_history, image_digest, QWEN_MODEL, context_text)
+        timing.image_sent = image_path is not None
+
+        async for text in cached_stream(cache_key, produce):
+            yield text
+            # yield 返回说明上一块已交给客户端连接（StreamingResponse 发送完才会取下一块）
+            timing.chunk_sent()
+        outcome = "ok"
+    except QwenUpstreamError as e:
+        outcome = "upstream_error"
+        print(str(e))
+        yield str(e)
     except Exception as e:
+        outcome = "connection_error"
         print(f"DEBUG: Connection Exception: {e}")
-        yield f"[Connection Error: {str(e)}]"
\ No newline at end of file
+        yield f"[Connection Error: {str(e)}]"
+    finally:
+        timing.finish(outcome)
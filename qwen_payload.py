@@ -0,0 +1,247 @@
+# qwen_payload.py
+
+import os
+import time
+import base64
+import hashlib
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Union
+from urllib.parse import urlsplit
+
+import cv2
+import numpy as np
+
+# ----------------------------------------------------
+# 1. Configuration
+# ----------------------------------------------------
+# base64 结果的 LRU 缓存上限（按字节计）
+PAYLOAD_CACHE_MAX_BYTES = int(os.environ.get("QWEN_PAYLOAD_CACHE_MB", "64")) * 1024 * 1024
+
+# 可选：后端支持“先上传图片、后续按 ID 引用”时配置此地址
+# 约定：POST {"image_base64": "..."} -> {"image_id": "..."}
+# image_id 只在收到上传的那个后端有效：
+# - 以 / 开头的路径（如 /upload_image）拼在每个后端自己的 scheme://host:port 后面
+# - 完整 URL 只用于同一 host:port 的后端，其余后端一律内联 base64
+QWEN_IMAGE_UPLOAD_URL = os.environ.get("QWEN_IMAGE_UPLOAD_URL", "")
+# 上传失败后暂停使用该上传接口的时间（秒），期间退回内联 base64
+IMAGE_UPLOAD_RETRY_SECONDS = 300
+# 后端可能清理或重启后丢掉图片：image_id 只复用这么久，之后重新上传
+IMAGE_ID_TTL_SECONDS = float(os.environ.get("QWEN_IMAGE_ID_TTL_SECONDS", "1800"))
+MAX_IMAGE_IDS = 4096
+
+# 发给 VLM 之前的缩放/重压缩：模型自己也会缩到输入尺寸，没必要传原图
+# 最长边与总像素预算（默认约 1MP，对应 Qwen-VL 常用的 max_pixels = 1280*28*28）
+QWEN_IMAGE_MAX_EDGE = int(os.environ.get("QWEN_IMAGE_MAX_EDGE", "1280"))
+QWEN_IMAGE_MAX_PIXELS = int(os.environ.get("QWEN_IMAGE_MAX_PIXELS", str(1280 * 28 * 28)))
+# jpeg / webp / png（png 表示不重压缩，只缩放）
+QWEN_IMAGE_FORMAT = os.environ.get("QWEN_IMAGE_FORMAT", "jpeg").lower()
+# 质量偏高一些，保证检测框上的小字标签依然清晰
+QWEN_IMAGE_QUALITY = int(os.environ.get("QWEN_IMAGE_QUALITY", "90"))
+
+# ----------------------------------------------------
+# 2. Image Preprocessing
+# ----------------------------------------------------
+
+def _encode_params() -> tuple:
+    if QWEN_IMAGE_FORMAT == "webp":
+        return ".webp", [cv2.IMWRITE_WEBP_QUALITY, QWEN_IMAGE_QUALITY]
+    if QWEN_IMAGE_FORMAT == "png":
+        return ".png", [cv2.IMWRITE_PNG_COMPRESSION, 3]
+    # 4:4:4 不做色度下采样，彩色标注框和文字边缘不会发糊
+    return ".jpg", [cv2.IMWRITE_JPEG_QUALITY, QWEN_IMAGE_QUALITY,
+                    cv2.IMWRITE_JPEG_SAMPLING_FACTOR, cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444]
+
+
+def prepare_image_bytes(image_path: str) -> Union[bytes, None]:
+    """
+    Resizes the context image to the VLM budget (max edge and max pixels) and
+    recompresses it. Falls back to the original bytes when that is smaller.
+    """
+    try:
+        with open(image_path, "rb") as f:
+            original = f.read()
+    except OSError:
+        return None
+
+    image = cv2.imdecode(np.frombuffer(original, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return original
+
+    h, w = image.shape[:2]
+    scale = min(1.0, QWEN_IMAGE_MAX_EDGE / max(h, w), (QWEN_IMAGE_MAX_PIXELS / (h * w)) ** 0.5)
+    if scale < 1.0:
+        # INTER_AREA 缩小时对细线和文字最友好
+        image = cv2.resize(image, (max(int(w * scale), 1), max(int(h * scale), 1)), interpolation=cv2.INTER_AREA)
+
+    ext, params = _encode_params()
+    ok, buf = cv2.imencode(ext, image, params)
+    if not ok:
+        return original
+    encoded = buf.tobytes()
+    if scale >= 1.0 and len(encoded) >= len(original):
+        return original
+    return encoded
+
+# ----------------------------------------------------
+# 3. Encoded Payload Cache
+# ----------------------------------------------------
+_cache = OrderedDict()   # (abs_path, mtime_ns, size) -> base64 str
+_cache_bytes = 0
+_image_ids = OrderedDict()  # (上传地址, 同一个 key) -> (image_id, 过期时间)
+_upload_disabled_until = {}  # 上传地址 -> 恢复尝试的时间
+_digests = OrderedDict()  # 同一个 key -> 文件内容的 sha256
+MAX_DIGESTS = 4096
+_lock = threading.Lock()
+
+
+def _file_key(image_path: str) -> Union[tuple, None]:
+    try:
+        st = os.stat(image_path)
+    except OSError:
+        return None
+    # 文件被覆盖（mtime/size 变化）时自然失效
+    return (os.path.abspath(image_path), st.st_mtime_ns, st.st_size)
+
+
+def encode_image_to_base64(image_path: str) -> str:
+    if not image_path or not os.path.exists(image_path):
+        return None
+    try:
+        with open(image_path, "rb") as f:
+            return base64.b64encode(f.read()).decode("utf-8")
+    except Exception:
+        return None
+
+
+def get_image_digest(image_path: str) -> Union[str, None]:
+    """SHA-256 of the file contents, cached per (path, mtime, size)."""
+    key = _file_key(image_path) if image_path else None
+    if key is None:
+        return None
+    with _lock:
+        digest = _digests.get(key)
+    if digest:
+        return digest
+
+    hasher = hashlib.sha256()
+    try:
+        with open(image_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                hasher.update(block)
+    except OSError:
+        return None
+    digest = hasher.hexdigest()
+    with _lock:
+        _digests[key] = digest
+        while len(_digests) > MAX_DIGESTS:
+            _digests.popitem(last=False)
+    return digest
+
+
+def get_encoded_image(image_path: str) -> Union[str, None]:
+    """base64 of the VLM-ready version of image_path, served from the LRU cache when the file is unchanged."""
+    global _cache_bytes
+    key = _file_key(image_path) if image_path else None
+    if key is None:
+        return None
+
+    with _lock:
+        cached = _cache.get(key)
+        if cached is not None:
+            _cache.move_to_end(key)
+            return cached
+
+    prepared = prepare_image_bytes(image_path)
+    encoded = base64.b64encode(prepared).decode("utf-8") if prepared else None
+    if encoded is None or len(encoded) > PAYLOAD_CACHE_MAX_BYTES:
+        return encoded
+
+    with _lock:
+        if key not in _cache:
+            _cache[key] = encoded
+            _cache_bytes += len(encoded)
+            # 按字节淘汰最久未使用的条目
+            while _cache_bytes > PAYLOAD_CACHE_MAX_BYTES and _cache:
+                _, evicted = _cache.popitem(last=False)
+                _cache_bytes -= len(evicted)
+    return encoded
+
+
+def upload_url_for(backend_url: Union[str, None]) -> Union[str, None]:
+    """The image upload endpoint that belongs to backend_url, or None when images must go inline."""
+    if not QWEN_IMAGE_UPLOAD_URL or not backend_url:
+        return None
+    backend = urlsplit(backend_url)
+    if QWEN_IMAGE_UPLOAD_URL.startswith("/"):
+        return f"{backend.scheme}://{backend.netloc}{QWEN_IMAGE_UPLOAD_URL}"
+    upload = urlsplit(QWEN_IMAGE_UPLOAD_URL)
+    if (upload.scheme, upload.netloc) == (backend.scheme, backend.netloc):
+        return QWEN_IMAGE_UPLOAD_URL
+    return None
+
+
+def _cached_image_id(id_key: tuple) -> Union[str, None]:
+    with _lock:
+        entry = _image_ids.get(id_key)
+        if entry is None:
+            return None
+        image_id, expires = entry
+        if expires <= time.monotonic():
+            del _image_ids[id_key]
+            return None
+        return image_id
+
+
+def forget_image_id(image_path: Union[str, None], backend_url: Union[str, None]) -> None:
+    """Drops the cached id of this image for this backend (e.g. the backend rejected it)."""
+    upload_url = upload_url_for(backend_url)
+    key = _file_key(image_path) if image_path else None
+    if upload_url and key is not None:
+        with _lock:
+            _image_ids.pop((upload_url, key), None)
+
+
+async def _upload_image(client, upload_url: str, key: tuple, encoded: str) -> Union[str, None]:
+    """Uploads once and remembers the backend image id for this file version."""
+    try:
+        response = await client.post(upload_url, json={"image_base64": encoded})
+        response.raise_for_status()
+        image_id = response.json().get("image_id")
+    except Exception as e:
+        print(f"DEBUG: Image upload to {upload_url} failed, falling back to inline base64: {e}")
+        _upload_disabled_until[upload_url] = time.monotonic() + IMAGE_UPLOAD_RETRY_SECONDS
+        return None
+
+    if image_id:
+        with _lock:
+            _image_ids[(upload_url, key)] = (image_id, time.monotonic() + IMAGE_ID_TTL_SECONDS)
+            while len(_image_ids) > MAX_IMAGE_IDS:
+                _image_ids.popitem(last=False)
+    return image_id
+
+
+async def get_image_payload(image_path: Union[str, None], client=None, backend_url: Union[str, None] = None,
+                            inline: bool = False) -> dict:
+    """
+    Image fields for the last user message sent to backend_url.
+    - {"image_id": "..."} if that backend supports uploads and already has this image
+    - {"image_base64": "..."} otherwise, or when inline=True (from the encoded-payload cache)
+    """
+    key = _file_key(image_path) if image_path else None
+    if key is None:
+        return {"image_base64": None}
+
+    upload_url = upload_url_for(backend_url) if client is not None and not inline else None
+    if upload_url:
+        image_id = _cached_image_id((upload_url, key))
+        if image_id:
+            return {"image_base64": None, "image_id": image_id}
+
+    encoded = await asyncio.to_thread(get_encoded_image, image_path)
+    if encoded and upload_url and time.monotonic() >= _upload_disabled_until.get(upload_url, 0.0):
+        image_id = await _upload_image(client, upload_url, key, encoded)
+        if image_id:
+            return {"image_base64": None, "image_id": image_id}
+    return {"image_base64": encoded}
@@ -0,0 +1,177 @@
+# qwen_response_cache.py
+
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import AsyncIterator, Callable, List, Tuple, Union
+
+# ----------------------------------------------------
+# 1. Configuration
+# ----------------------------------------------------
+RESPONSE_CACHE_ENABLED = os.environ.get("QWEN_RESPONSE_CACHE", "1") != "0"
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("QWEN_RESPONSE_CACHE_TTL", "600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("QWEN_RESPONSE_CACHE_ENTRIES", "512"))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("QWEN_RESPONSE_CACHE_MB", "16")) * 1024 * 1024
+
+_TRAILING_PUNCT_RE = re.compile(r"[\s。．.！!？?]+$")
+
+# ----------------------------------------------------
+# 2. Cache Key
+# ----------------------------------------------------
+
+def normalize_message(message: str) -> str:
+    """Case, whitespace and trailing punctuation do not change the question."""
+    text = " ".join(str(message).split()).lower()
+    return _TRAILING_PUNCT_RE.sub("", text)
+
+
+def response_cache_key(message: str, chat_history: List[Tuple[str, str]],
+                       image_digest: Union[str, None], model: str, context_text: Union[str, None] = None) -> str:
+    history_hash = hashlib.sha256(
+        json.dumps([[str(h), str(a)] for h, a in chat_history], ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+    # 文字版检测结果也是 prompt 的一部分（纯文字模式下它就是唯一的图像信息）
+    context_hash = hashlib.sha256(context_text.encode("utf-8")).hexdigest() if context_text else ""
+    raw = "\x00".join([normalize_message(message), history_hash, image_digest or "", model, context_hash])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+# ----------------------------------------------------
+# 3. Completed Responses (TTL + LRU)
+# ----------------------------------------------------
+_cache = OrderedDict()  # key -> (expires_at, chunks tuple, size)
+_cache_bytes = 0
+
+
+def _cache_get(key: str) -> Union[tuple, None]:
+    global _cache_bytes
+    entry = _cache.get(key)
+    if entry is None:
+        return None
+    expires_at, chunks, size = entry
+    if expires_at < time.monotonic():
+        del _cache[key]
+        _cache_bytes -= size
+        return None
+    _cache.move_to_end(key)
+    return chunks
+
+
+def _cache_put(key: str, chunks: list) -> None:
+    global _cache_bytes
+    size = sum(len(c.encode("utf-8")) for c in chunks)
+    if size > RESPONSE_CACHE_MAX_BYTES:
+        return
+    if key in _cache:
+        _cache_bytes -= _cache.pop(key)[2]
+    _cache[key] = (time.monotonic() + RESPONSE_CACHE_TTL_SECONDS, tuple(chunks), size)
+    _cache_bytes += size
+    while _cache and (len(_cache) > RESPONSE_CACHE_MAX_ENTRIES or _cache_bytes > RESPONSE_CACHE_MAX_BYTES):
+        _, (_, _, evicted_size) = _cache.popitem(last=False)
+        _cache_bytes -= evicted_size
+
+# ----------------------------------------------------
+# 4. In-flight Coalescing (singleflight)
+# ----------------------------------------------------
+
+class _Flight:
+    """One upstream generation whose chunks are fanned out to every waiting request."""
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.cond = asyncio.Condition()
+        # 正在接收这份回答的请求数；降到 0 时取消上游
+        self.subscribers = 0
+        self.task = None
+
+
+_inflight = {}
+# 持有后台任务的引用，防止被垃圾回收
+_pump_tasks = set()
+
+
+async def _pump(key: str, flight: _Flight, producer: Callable[[], AsyncIterator[str]]) -> None:
+    completed = False
+    try:
+        async for chunk in producer():
+            async with flight.cond:
+                flight.chunks.append(chunk)
+                flight.cond.notify_all()
+        completed = True
+    except Exception as e:
+        flight.error = e
+    finally:
+        if not completed and flight.error is None:
+            flight.error = RuntimeError("Upstream generation was cancelled.")
+        async with flight.cond:
+            flight.done = True
+            flight.cond.notify_all()
+        if _inflight.get(key) is flight:
+            del _inflight[key]
+        # 只缓存完整且成功的回答（被取消的半截回答直接丢弃）
+        if completed and flight.chunks:
+            _cache_put(key, flight.chunks)
+
+
+async def _follow(flight: _Flight) -> AsyncIterator[str]:
+    index = 0
+    while True:
+        async with flight.cond:
+            while index >= len(flight.chunks) and not flight.done:
+                await flight.cond.wait()
+            new_chunks = flight.chunks[index:]
+            done = flight.done
+        for chunk in new_chunks:
+            yield chunk
+        index += len(new_chunks)
+        if done and index >= len(flight.chunks):
+            if flight.error is not None:
+                raise flight.error
+            return
+
+
+async def cached_stream(key: str, producer: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+    """
+    Streams the response for `key`:
+    - cache hit: replays the stored chunks
+    - identical request already running: joins it and receives the same chunks
+    - otherwise: starts `producer()` in a background task that the others can join
+    The upstream task keeps running if the first client disconnects, so joined
+    clients still get the full answer (and it still lands in the cache). Once
+    every client has disconnected it is cancelled and the partial answer dropped.
+    """
+    if not RESPONSE_CACHE_ENABLED:
+        async for chunk in producer():
+            yield chunk
+        return
+
+    cached = _cache_get(key)
+    if cached is not None:
+        for chunk in cached:
+            yield chunk
+        return
+
+    flight = _inflight.get(key)
+    if flight is None:
+        flight = _Flight()
+        _inflight[key] = flight
+        flight.task = asyncio.create_task(_pump(key, flight, producer))
+        _pump_tasks.add(flight.task)
+        flight.task.add_done_callback(_pump_tasks.discard)
+
+    flight.subscribers += 1
+    try:
+        async for chunk in _follow(flight):
+            yield chunk
+    finally:
+        flight.subscribers -= 1
+        if flight.subscribers == 0 and not flight.done:
+            # 没人再等这份回答：别让上游继续占着后端生成，新的相同请求重新发起
+            if _inflight.get(key) is flight:
+                del _inflight[key]
+            flight.task.cancel()
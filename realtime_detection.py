@@ -0,0 +1,175 @@
+# realtime_detection.py
+
+import json
+import time
+import asyncio
+import threading
+
+import cv2
+import numpy as np
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+import yolo_state
+from annotation_renderer import render_result
+from pipeline_metrics import timed, DECODE, INFERENCE, PLOT, ENCODE, REALTIME_SESSIONS, REALTIME_DROPPED
+
+# ----------------------------------------------------
+# 1. Configuration
+# ----------------------------------------------------
+REALTIME_CONF = 0.25
+# 回传标注帧时的 JPEG 质量（实时场景优先速度）
+ANNOTATED_JPEG_QUALITY = 70
+
+# 多个 WebSocket 会话共用同一个模型，推理需要串行
+_model_lock = threading.Lock()
+
+# ----------------------------------------------------
+# 2. Single Frame Detection
+# ----------------------------------------------------
+
+def detect_frame(frame: np.ndarray, annotate: bool = False) -> tuple:
+    """
+    Runs the loaded model on one BGR frame.
+    :return: (detections, annotated_jpeg_bytes or None, inference_ms)
+    """
+    start = time.perf_counter()
+    with _model_lock:
+        result = yolo_state.current_model.predict(source=frame, save=False, conf=REALTIME_CONF, verbose=False)[0]
+    inference_ms = (time.perf_counter() - start) * 1000
+    # 含等待模型锁的时间：多个会话争用同一个模型时这里会变长
+    INFERENCE.labels(pipeline="realtime").observe(inference_ms / 1000)
+
+    detections = []
+    if len(result.boxes) > 0:
+        boxes = result.boxes.xyxy.cpu().numpy().round(1).tolist()
+        confs = result.boxes.conf.cpu().numpy().tolist()
+        classes = result.boxes.cls.cpu().numpy().astype(int).tolist()
+        for box, conf, cls_id in zip(boxes, confs, classes):
+            detections.append({
+                "class_id": cls_id,
+                "name": yolo_state.current_model.names.get(cls_id, str(cls_id)),
+                "conf": round(conf, 3),
+                "box": box,
+            })
+
+    annotated = None
+    if annotate:
+        with timed(PLOT.labels(pipeline="realtime")):
+            plotted = render_result(result, yolo_state.current_model.names)
+        with timed(ENCODE.labels(pipeline="realtime")):
+            ok, buf = cv2.imencode(".jpg", plotted, [cv2.IMWRITE_JPEG_QUALITY, ANNOTATED_JPEG_QUALITY])
+        annotated = buf.tobytes() if ok else None
+    return detections, annotated, inference_ms
+
+
+def detect_jpeg(jpeg: bytes, annotate: bool = False) -> tuple:
+    """
+    Decodes one JPEG frame and runs detect_frame on it, both in the calling (worker) thread.
+    :return: (detections or None if the frame could not be decoded, annotated_jpeg_bytes or None,
+              decode_ms, inference_ms)
+    """
+    start = time.perf_counter()
+    frame = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+    decode_ms = (time.perf_counter() - start) * 1000
+    DECODE.labels(pipeline="realtime").observe(decode_ms / 1000)
+    if frame is None:
+        return None, None, decode_ms, 0.0
+    detections, annotated, inference_ms = detect_frame(frame, annotate)
+    return detections, annotated, decode_ms, inference_ms
+
+# ----------------------------------------------------
+# 3. WebSocket Session
+# ----------------------------------------------------
+
+async def run_session(websocket: WebSocket, annotate: bool = False) -> None:
+    """
+    Real-time loop for one client.
+    Binary messages are JPEG frames; text messages are JSON controls, e.g. {"annotate": true}.
+    Only the newest frame is kept: if inference falls behind, older unprocessed
+    frames are dropped, so latency stays bounded instead of a queue building up.
+
+    Replies per processed frame:
+    - {"type": "detections", "seq": n, "detections": [...], "dropped": k,
+       "latency_ms": {"queue": .., "decode": .., "inference": .., "total": ..}}
+    - followed by one binary message with the annotated JPEG when annotate is on.
+    """
+    await websocket.accept()
+    REALTIME_SESSIONS.inc()
+
+    state = {"frame": None, "seq": 0, "received_at": 0.0, "dropped": 0, "annotate": annotate, "closed": False}
+    frame_ready = asyncio.Event()
+
+    async def receiver():
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message.get("bytes") is not None:
+                    # 上一帧还没处理就被新帧覆盖 -> 计为丢帧
+                    if state["frame"] is not None:
+                        state["dropped"] += 1
+                        REALTIME_DROPPED.inc()
+                    state["frame"] = message["bytes"]
+                    state["seq"] += 1
+                    state["received_at"] = time.perf_counter()
+                    frame_ready.set()
+                elif message.get("text"):
+                    try:
+                        control = json.loads(message["text"])
+                        if "annotate" in control:
+                            state["annotate"] = bool(control["annotate"])
+                    except json.JSONDecodeError:
+                        pass
+        except WebSocketDisconnect:
+            pass
+        finally:
+            state["closed"] = True
+            frame_ready.set()
+
+    receive_task = asyncio.create_task(receiver())
+    try:
+        while True:
+            await frame_ready.wait()
+            frame_ready.clear()
+            if state["closed"]:
+                break
+            jpeg, seq, received_at = state["frame"], state["seq"], state["received_at"]
+            state["frame"] = None
+            if jpeg is None:
+                continue
+
+            picked_at = time.perf_counter()
+            try:
+                # 解码和推理放在同一次 to_thread 里：大帧解码也不占用事件循环
+                detections, annotated, decode_ms, inference_ms = await asyncio.to_thread(
+                    detect_jpeg, jpeg, state["annotate"])
+            except Exception as e:
+                # 单帧推理失败（模型被换掉、predict 报错）只报告这一帧，会话继续
+                print(f"DEBUG: Realtime inference failed on frame {seq}: {e}")
+                await websocket.send_text(json.dumps({"type": "error", "seq": seq, "message": f"Inference failed: {e}"}))
+                continue
+            if detections is None:
+                await websocket.send_text(json.dumps({"type": "error", "seq": seq, "message": "Could not decode frame."}))
+                continue
+            done_at = time.perf_counter()
+
+            await websocket.send_text(json.dumps({
+                "type": "detections",
+                "seq": seq,
+                "detections": detections,
+                "dropped": state["dropped"],
+                "latency_ms": {
+                    "queue": round((picked_at - received_at) * 1000, 2),
+                    "decode": round(decode_ms, 2),
+                    "inference": round(inference_ms, 2),
+                    "total": round((done_at - received_at) * 1000, 2),
+                },
+            }))
+            if annotated is not None:
+                await websocket.send_bytes(annotated)
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        REALTIME_SESSIONS.dec()
+        receive_task.cancel()
@@ -0,0 +1,152 @@
+# report_export.py
+
+import os
+import re
+import json
+import asyncio
+import zipfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from typing import AsyncIterator, List, Tuple, Union
+
+from metrics import gauge
+
+# ----------------------------------------------------
+# 1. Configuration
+# ----------------------------------------------------
+# 渲染进程数：PDF 渲染是纯 CPU 的同步代码，多进程才能真正并行
+REPORT_EXPORT_WORKERS = int(os.environ.get("REPORT_EXPORT_WORKERS", str(min(4, os.cpu_count() or 1))))
+# 单次导出的最大报告数
+MAX_EXPORT_RECORDS = int(os.environ.get("MAX_EXPORT_RECORDS", "200"))
+
+_SAFE_NAME_RE = re.compile(r"[^\w\-.]+")
+
+_pool: Union[ProcessPoolExecutor, None] = None
+
+# 已提交给进程池、还没渲染完的报告数（子进程里的指标不会回传，这里在主进程统计排队深度）
+EXPORT_QUEUE = gauge("report_export_queue_depth", "Reports submitted to the export pool and not yet finished.")
+
+# ----------------------------------------------------
+# 2. Process Pool
+# ----------------------------------------------------
+
+def _render_in_worker(chat_history: List[Tuple[str, str]], context_path: Union[str, None]) -> bytes:
+    # 在子进程里导入：字体等只在每个工作进程启动时解析一次
+    from report_generator import get_or_render_report
+    try:
+        # 已经生成过的同一份报告直接复用；新渲染的不落盘，只进 ZIP
+        return get_or_render_report(chat_history, context_path, save=False)[0]
+    except Exception as e:
+        # 部分第三方异常无法在进程间反序列化，会把整个进程池标记为损坏；统一转成普通异常
+        raise RuntimeError(f"{type(e).__name__}: {e}") from None
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn：主进程里有事件循环和后台线程，fork 出来的子进程状态不安全
+        _pool = ProcessPoolExecutor(max_workers=REPORT_EXPORT_WORKERS,
+                                    mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def shutdown_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+# ----------------------------------------------------
+# 3. Streaming ZIP
+# ----------------------------------------------------
+
+class _ChunkSink:
+    """Write-only, non-seekable file object; zipfile then uses data descriptors and never seeks back."""
+
+    def __init__(self):
+        self._chunks = []
+        self._written = 0
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        self._written += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._written
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _entry_name(index: int, name: Union[str, None]) -> str:
+    stem = _SAFE_NAME_RE.sub("_", name).strip("._") if name else ""
+    return f"{index + 1:03d}_{stem or 'report'}.pdf"
+
+
+async def stream_report_zip(records: List[dict]) -> AsyncIterator[bytes]:
+    """
+    Renders every record ({"name", "history", "context_path"}) on the process pool
+    and yields ZIP bytes as each PDF finishes (completion order, not input order).
+    A failed record is listed in manifest.json instead of aborting the batch.
+    """
+    loop = asyncio.get_running_loop()
+    pool = get_pool()
+
+    async def render(index: int, record: dict):
+        EXPORT_QUEUE.inc()
+        try:
+            pdf_bytes = await loop.run_in_executor(pool, _render_in_worker, record["history"], record.get("context_path"))
+            return index, pdf_bytes, None
+        except BrokenProcessPool as e:
+            shutdown_pool()
+            return index, None, f"Render worker crashed: {e}"
+        except Exception as e:
+            return index, None, str(e)
+        finally:
+            EXPORT_QUEUE.dec()
+
+    sink = _ChunkSink()
+    # PDF 本身已压缩，ZIP 里直接存储，省掉一次无效的 deflate
+    zf = zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED)
+    manifest = []
+    tasks = [asyncio.ensure_future(render(i, r)) for i, r in enumerate(records)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            index, pdf_bytes, error = await next_done
+            record = records[index]
+            entry = {"index": index, "name": record.get("name"), "context_path": record.get("context_path")}
+            if error is None:
+                entry["file"] = _entry_name(index, record.get("name"))
+                entry["bytes"] = len(pdf_bytes)
+                zf.writestr(entry["file"], pdf_bytes)
+            else:
+                print(f"DEBUG: Report export failed for record {index}: {error}")
+                entry["error"] = error
+            manifest.append(entry)
+            data = sink.drain()
+            if data:
+                yield data
+
+        manifest.sort(key=lambda e: e["index"])
+        summary = {
+            "generated_at": datetime.now().isoformat(timespec="seconds"),
+            "total": len(records),
+            "succeeded": sum(1 for e in manifest if "error" not in e),
+            "failed": sum(1 for e in manifest if "error" in e),
+            "reports": manifest,
+        }
+        zf.writestr("manifest.json", json.dumps(summary, ensure_ascii=False, indent=2))
+        zf.close()
+        yield sink.drain()
+    finally:
+        # 客户端中途断开时，取消还没开始的渲染
+        for task in tasks:
+            task.cancel()
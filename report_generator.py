@@ -1,8 +1,20 @@
 # report_generator.py (覆盖此文件)
 
 import os
+import io
+import json
+import hashlib
+import threading
 from fpdf import FPDF
+from fpdf.enums import TextEmphasis
+from fpdf.fonts import TTFFont, SubsetMap
+from fontTools import ttLib
 from datetime import datetime
+from report_images import prepare_report_image, fit_image_mm, REPORT_IMAGE_DPI, REPORT_IMAGE_JPEG_QUALITY
+from qwen_payload import get_image_digest
+import storage_lifecycle
+from pipeline_metrics import timed, REPORT_RENDER, REPORTS
+from request_profiling import hot_path
 from typing import List, Tuple
 import markdown 
 import re 
@@ -15,17 +27,81 @@ CHINESE_FONT_PATH = os.path.join(os.path.dirname(__file__), "NotoSansSC-Regular.
 FONT_NAME = 'Chinese'
 FONT_LOADED = False
 
+# ----------------------------------------------------
+# Shared Font Cache
+# ----------------------------------------------------
+# 中文字体只在启动时解析一次（cmap / 字宽表遍历数万个字形，是报告生成的主要耗时），
+# 之后每份报告复用解析结果。嵌入 PDF 时 fpdf2 只会写入本报告实际用到的字形（子集化）。
+_font_bytes = None
+_font_template = None
+
+
+def _load_shared_font() -> None:
+    global _font_bytes, _font_template, FONT_LOADED
+    if not os.path.exists(CHINESE_FONT_PATH):
+        return
+    try:
+        with open(CHINESE_FONT_PATH, "rb") as f:
+            _font_bytes = f.read()
+        _font_template = TTFFont(FPDF(), CHINESE_FONT_PATH, FONT_NAME.lower(), "")
+        FONT_LOADED = True
+        print(f"DEBUG: Report font parsed once: {CHINESE_FONT_PATH} ({len(_font_template.cmap)} glyphs)")
+    except Exception as e:
+        print(f"DEBUG: Failed to load report font {CHINESE_FONT_PATH}: {e}")
+        _font_bytes, _font_template = None, None
+
+
+def _font_for_document(pdf: FPDF) -> TTFFont:
+    """
+    Per-document view of the shared font: metrics, cmap and glyph ids are shared,
+    while the used-glyph map and the fontTools object (subset in place on output)
+    are per document.
+    """
+    font = TTFFont.__new__(TTFFont)
+    for attr in TTFFont.__slots__:
+        if hasattr(_font_template, attr):
+            setattr(font, attr, getattr(_font_template, attr))
+    font.i = len(pdf.fonts) + 1
+    font.fontkey = FONT_NAME.lower()
+    # lazy=True 只读表目录，真正的字形数据在输出子集化时才按需读取
+    font.ttfont = ttLib.TTFont(io.BytesIO(_font_bytes), recalcTimestamp=False, lazy=True)
+    font.subset = SubsetMap(font)
+    font.missing_glyphs = []
+    font.biggest_size_pt = 0
+    font._hbfont = None
+    font.color_font = None
+    return font
+
+
+_load_shared_font()
+
+
 class PDFReport(FPDF):
     def __init__(self, orientation='P', unit='mm', format='A4'):
         super().__init__(orientation, unit, format)
         global FONT_LOADED
-        if os.path.exists(CHINESE_FONT_PATH):
+        if _font_template is not None:
             try:
-                self.add_font(FONT_NAME, '', CHINESE_FONT_PATH, uni=True)
-                self.add_font(FONT_NAME, 'B', CHINESE_FONT_PATH, uni=True)
-                FONT_LOADED = True
-            except Exception:
-                pass
+                font = _font_for_document(self)
+                self.fonts[font.fontkey] = font
+                if font.is_cff and font.is_cid_keyed:
+                    self._set_min_pdf_version("1.6")
+            except Exception as e:
+                # fpdf2 内部结构变化时退回到逐份解析
+                print(f"DEBUG: Shared font unavailable ({e}), parsing the font for this report")
+                try:
+                    self.add_font(FONT_NAME, '', CHINESE_FONT_PATH)
+                except Exception:
+                    FONT_LOADED = False
+
+    def set_font(self, family=None, style="", size=0):
+        # 原先把同一个字体文件再注册一次作为 'B'，PDF 里会重复嵌入一份；
+        # 现在粗体/斜体直接映射到常规字形（显示效果与原来相同），只嵌入一份子集
+        if FONT_LOADED and (family or self.font_family or "").lower() == FONT_NAME.lower():
+            if isinstance(style, TextEmphasis):
+                style = style.style
+            style = style.upper().replace("B", "").replace("I", "")
+        super().set_font(family, style, size)
 
     def header(self):
         if FONT_LOADED:
@@ -40,7 +116,8 @@ class PDFReport(FPDF):
         self.set_font('Arial', 'I', 8)
         self.cell(0, 10, f'Page {self.page_no()}/{{nb}}', 0, 0, 'C')
 
-def create_medical_report(chat_history: List[Tuple[str, str]], image_context_path: str) -> str:
+def render_medical_report(chat_history: List[Tuple[str, str]], image_context_path: str) -> bytes:
+    """Renders the report entirely in memory and returns the PDF bytes."""
     global FONT_LOADED
     pdf = PDFReport()
     pdf.alias_nb_pages()
@@ -55,19 +132,22 @@ def create_medical_report(chat_history: List[Tuple[str, str]], image_context_pat
     pdf.set_font(font_style, '', 10)
     pdf.cell(0, 8, f'Time: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}', 0, 1)
     
+    # 打印分辨率的 JPEG（有缓存）；视频取关键帧拼图或中间帧
+    report_image = prepare_report_image(image_context_path) if image_context_path else None
     if image_context_path and os.path.exists(image_context_path):
         file_name = os.path.basename(image_context_path)
         pdf.cell(0, 8, f'Image Analyzed: {file_name}', 0, 1)
         pdf.ln(2)
-        
-        # 修复重叠的核心逻辑：
-        # 1. 记录当前 Y 坐标
-        start_y = pdf.get_y()
-        # 2. 放置图片，限制最大高度 100mm
-        pdf.image(image_context_path, x=15, y=start_y, w=150)
-        # 3. 手动计算图片实际占用的高度。这里假设宽度占满按比例缩放，
-        # 为了安全起见，我们直接给足够的空间。
-        pdf.set_y(start_y + 110) # 强制下移 110mm，确保不覆盖
+
+        if report_image:
+            jpeg_path, width_px, height_px = report_image
+            # 按真实宽高比计算占用高度，不再固定下移 110mm
+            w_mm, h_mm = fit_image_mm(width_px, height_px)
+            if pdf.get_y() + h_mm > pdf.page_break_trigger:
+                pdf.add_page()
+            start_y = pdf.get_y()
+            pdf.image(jpeg_path, x=(pdf.w - w_mm) / 2, y=start_y, w=w_mm, h=h_mm)
+            pdf.set_y(start_y + h_mm)
     else:
         pdf.cell(0, 8, 'Image Analyzed: None', 0, 1)
     
@@ -83,7 +163,8 @@ def create_medical_report(chat_history: List[Tuple[str, str]], image_context_pat
         # User
         pdf.set_text_color(0, 50, 160)
         user_html = font_tag + f'<b>Patient:</b> {user_msg}</font>'
-        pdf.write_html(user_html)
+        with hot_path("pdf.write_html"):
+            pdf.write_html(user_html)
         pdf.ln(5)
 
         # AI
@@ -95,7 +176,8 @@ def create_medical_report(chat_history: List[Tuple[str, str]], image_context_pat
              if ai_html.startswith('<p>'): ai_html = ai_html[3:-4]
              
              final_html = font_tag + f'<b>AI Assistant:</b> {ai_html}</font>'
-             pdf.write_html(final_html)
+             with hot_path("pdf.write_html"):
+                 pdf.write_html(final_html)
         pdf.ln(8) # 段落间距
 
     pdf.ln(10)
@@ -110,9 +192,101 @@ def create_medical_report(chat_history: List[Tuple[str, str]], image_context_pat
     disclaimer = "本报告仅供参考，不构成医疗诊断建议。请务必咨询专业医生。\nThis report is for reference only."
     pdf.multi_cell(0, 5, disclaimer)
 
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    report_filename = f'report_{timestamp}.pdf'
-    report_path = os.path.join(REPORT_DIR, report_filename)
-    pdf.output(report_path)
+    with hot_path("pdf.output"):
+        return bytes(pdf.output())
+
+
+def report_filename(pdf_bytes: bytes) -> str:
+    # 按内容哈希命名：同一秒内生成的两份报告不会再互相覆盖
+    return f"report_{hashlib.sha256(pdf_bytes).hexdigest()[:16]}.pdf"
+
+
+def save_report_bytes(pdf_bytes: bytes, filename: str = None) -> str:
+    report_path = os.path.join(REPORT_DIR, filename or report_filename(pdf_bytes))
+    if not os.path.exists(report_path):
+        tmp_path = f"{report_path}.partial-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, "wb") as f:
+            f.write(pdf_bytes)
+        os.replace(tmp_path, report_path)
+    return report_path
+
+# ----------------------------------------------------
+# Report Deduplication
+# ----------------------------------------------------
+# 对话、图片、模板都没变时，重复点击“生成报告”直接返回已有 PDF
+# 修改报告版式时递增，旧版本的报告自然失效
+REPORT_TEMPLATE_VERSION = "3"
+REPORT_CACHE_MAX_AGE_HOURS = float(os.environ.get("REPORT_CACHE_MAX_AGE_HOURS", "168"))
+REPORT_CACHE_MAX_MB = int(os.environ.get("REPORT_CACHE_MAX_MB", "512"))
+REPORT_EVICTION_INTERVAL_SECONDS = 60
+# 报告目录的配额和过期由 storage_lifecycle 统一执行（mtime 在命中时刷新，即 LRU）
+storage_lifecycle.register_directory("reports", REPORT_DIR, REPORT_CACHE_MAX_MB, REPORT_CACHE_MAX_AGE_HOURS)
 
-    return report_path
\ No newline at end of file
+# 按 key 分段加锁：同一份报告并发请求只渲染一次，锁的数量固定
+_key_locks = [threading.Lock() for _ in range(64)]
+
+
+def report_cache_key(chat_history: List[Tuple[str, str]], image_context_path: str) -> str:
+    history_json = json.dumps([[str(u), str(a or "")] for u, a in chat_history], ensure_ascii=False)
+    image_digest = get_image_digest(image_context_path) if image_context_path else None
+    raw = "\x00".join([
+        REPORT_TEMPLATE_VERSION,
+        # 字体和图片分辨率也会改变输出
+        "cjk" if FONT_LOADED else "core",
+        f"{REPORT_IMAGE_DPI}/{REPORT_IMAGE_JPEG_QUALITY}",
+        history_json,
+        image_digest or "",
+    ])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def cached_report_filename(key: str) -> str:
+    return f"report_{key[:24]}.pdf"
+
+
+def _key_lock(key: str) -> threading.Lock:
+    return _key_locks[int(key[:8], 16) % len(_key_locks)]
+
+
+def evict_stale_reports(force: bool = False) -> int:
+    """Deletes reports older than the max age, then the least recently used ones over the size budget."""
+    if force:
+        return storage_lifecycle.sweep("reports").get("removed", 0)
+    storage_lifecycle.maybe_sweep("reports", REPORT_EVICTION_INTERVAL_SECONDS)
+    return 0
+
+
+def get_or_render_report(chat_history: List[Tuple[str, str]], image_context_path: str, save: bool = True) -> tuple:
+    """
+    :return: (pdf_bytes, report_path or None, cache_hit)
+    Identical requests (same history, same image content, same template version)
+    return the stored PDF without rendering. Concurrent identical requests render once.
+    """
+    key = report_cache_key(chat_history, image_context_path)
+    filename = cached_report_filename(key)
+    report_path = os.path.join(REPORT_DIR, filename)
+
+    with _key_lock(key):
+        try:
+            with open(report_path, "rb") as f:
+                pdf_bytes = f.read()
+            os.utime(report_path)  # 记录最近访问，供 LRU 淘汰
+            REPORTS.labels(cache="hit").inc()
+            return pdf_bytes, report_path, True
+        except OSError:
+            pass
+
+        with timed(REPORT_RENDER, "render_medical_report"):
+            pdf_bytes = render_medical_report(chat_history, image_context_path)
+        REPORTS.labels(cache="miss").inc()
+        if not save:
+            return pdf_bytes, None, False
+        save_report_bytes(pdf_bytes, filename)
+
+    evict_stale_reports()
+    return pdf_bytes, report_path, False
+
+
+def create_medical_report(chat_history: List[Tuple[str, str]], image_context_path: str) -> str:
+    """Renders the report (or reuses an identical one) in REPORT_DIR; returns the file path."""
+    return get_or_render_report(chat_history, image_context_path)[1]
@@ -0,0 +1,136 @@
+# report_images.py
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Union
+
+import cv2
+import numpy as np
+
+from video_keyframes import is_video_path, resolve_context_image
+import storage_lifecycle
+
+# ----------------------------------------------------
+# 1. Configuration
+# ----------------------------------------------------
+# 报告里的图片按打印分辨率准备：150mm 宽 @ 150 DPI ≈ 886px，原图再大也看不出区别
+REPORT_IMAGE_WIDTH_MM = 150
+REPORT_IMAGE_MAX_HEIGHT_MM = 120
+REPORT_IMAGE_DPI = int(os.environ.get("REPORT_IMAGE_DPI", "150"))
+REPORT_IMAGE_JPEG_QUALITY = int(os.environ.get("REPORT_IMAGE_JPEG_QUALITY", "85"))
+
+# 缓存的是检测图的高分辨率副本，不能放在公开挂载的 reports/ 或 temp_qwen_input/ 下面
+REPORT_IMAGE_CACHE_DIR = os.environ.get("REPORT_IMAGE_CACHE_DIR", "report_image_cache")
+MAX_CACHED_ENTRIES = 1024
+# 磁盘上的 JPEG 缓存随时可以重新生成，配额交给 storage_lifecycle
+storage_lifecycle.register_directory("report_images", REPORT_IMAGE_CACHE_DIR, 256, 168)
+
+# ----------------------------------------------------
+# 2. Helper Functions
+# ----------------------------------------------------
+
+def _max_pixels() -> tuple:
+    per_mm = REPORT_IMAGE_DPI / 25.4
+    return int(REPORT_IMAGE_WIDTH_MM * per_mm), int(REPORT_IMAGE_MAX_HEIGHT_MM * per_mm)
+
+
+def _representative_frame(video_path: str) -> Union[np.ndarray, None]:
+    """Middle frame of a video, used when no keyframe contact sheet exists."""
+    cap = cv2.VideoCapture(video_path)
+    try:
+        if not cap.isOpened():
+            return None
+        total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if total > 1:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, total // 2)
+        ret, frame = cap.read()
+        if not ret and total > 1:
+            # 部分容器不支持精确跳转，退回第一帧
+            cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = cap.read()
+        return frame if ret else None
+    finally:
+        cap.release()
+
+
+def _load_source(context_path: str) -> Union[np.ndarray, None]:
+    if is_video_path(context_path):
+        # 视频优先用关键帧拼图，没有时取中间一帧
+        sheet_path = resolve_context_image(context_path)
+        if sheet_path:
+            return cv2.imread(sheet_path, cv2.IMREAD_COLOR)
+        return _representative_frame(context_path)
+    return cv2.imread(context_path, cv2.IMREAD_COLOR)
+
+# ----------------------------------------------------
+# 3. Cached Print-resolution JPEG
+# ----------------------------------------------------
+_cache = OrderedDict()  # (abs_path, mtime_ns, size, dpi, quality) -> (jpeg_path, width_px, height_px)
+_lock = threading.Lock()
+
+
+def prepare_report_image(context_path: Union[str, None]) -> Union[tuple, None]:
+    """
+    Print-ready JPEG for the report's context image or video.
+    :return: (jpeg_path, width_px, height_px), or None if nothing can be embedded.
+    The JPEG is cached on disk per source file version, so repeated reports
+    for the same image skip decoding and resizing entirely.
+    """
+    if not context_path or not os.path.exists(context_path):
+        return None
+    try:
+        st = os.stat(context_path)
+    except OSError:
+        return None
+    key = (os.path.abspath(context_path), st.st_mtime_ns, st.st_size, REPORT_IMAGE_DPI, REPORT_IMAGE_JPEG_QUALITY)
+
+    with _lock:
+        cached = _cache.get(key)
+        if cached is not None and os.path.exists(cached[0]):
+            _cache.move_to_end(key)
+            return cached
+
+    name = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+    jpeg_path = os.path.join(REPORT_IMAGE_CACHE_DIR, f"{name}.jpg")
+
+    image = None
+    if os.path.exists(jpeg_path):
+        # 进程重启后内存缓存为空，但磁盘上的 JPEG 还在
+        image = cv2.imread(jpeg_path, cv2.IMREAD_COLOR)
+    if image is None:
+        image = _load_source(context_path)
+        if image is None:
+            return None
+        max_w, max_h = _max_pixels()
+        h, w = image.shape[:2]
+        scale = min(1.0, max_w / w, max_h / h)
+        if scale < 1.0:
+            image = cv2.resize(image, (max(int(w * scale), 1), max(int(h * scale), 1)), interpolation=cv2.INTER_AREA)
+        ok, buf = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, REPORT_IMAGE_JPEG_QUALITY])
+        if not ok:
+            return None
+        os.makedirs(REPORT_IMAGE_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{jpeg_path}.partial-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, "wb") as f:
+            f.write(buf.tobytes())
+        os.replace(tmp_path, jpeg_path)
+
+    entry = (jpeg_path, image.shape[1], image.shape[0])
+    with _lock:
+        _cache[key] = entry
+        while len(_cache) > MAX_CACHED_ENTRIES:
+            _cache.popitem(last=False)
+    return entry
+
+
+def fit_image_mm(width_px: int, height_px: int, max_width_mm: float = REPORT_IMAGE_WIDTH_MM,
+                 max_height_mm: float = REPORT_IMAGE_MAX_HEIGHT_MM) -> tuple:
+    """Placement size in mm that keeps the real aspect ratio within the given box."""
+    w_mm = max_width_mm
+    h_mm = w_mm * height_px / max(width_px, 1)
+    if h_mm > max_height_mm:
+        h_mm = max_height_mm
+        w_mm = h_mm * width_px / max(height_px, 1)
+    return w_mm, h_mm
@@ -0,0 +1,189 @@
+# request_profiling.py
+
+import os
+import json
+import hmac
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator, Union
+
+try:
+    import pyinstrument
+except ImportError:  # 可选依赖：没有时退回 cProfile（确定性分析，开销更大）
+    pyinstrument = None
+
+# ----------------------------------------------------
+# 1. Configuration
+# ----------------------------------------------------
+# 管理员令牌：未设置时整个功能关闭，任何请求头都不会触发分析
+PROFILE_ADMIN_TOKEN = os.environ.get("PROFILE_ADMIN_TOKEN", "")
+PROFILE_HEADER = "x-profile-token"
+# pyinstrument 采样间隔（秒）
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", "0.001"))
+PROFILE_SUFFIX = ".profile"
+
+# 当前请求的分析对象；热路径只在这里不为 None 时才记录
+active_profile: ContextVar = ContextVar("active_profile", default=None)
+
+# 同一时刻只允许一个分析器运行（3.12 起 cProfile 全局只能有一个）
+_profiler_lock = threading.Lock()
+
+# ----------------------------------------------------
+# 2. Request Profile
+# ----------------------------------------------------
+
+class RequestProfile:
+    """
+    Profile of one opted-in request. The profiler only runs inside call() and
+    wrap_generator() steps, so work on the event loop between steps (other
+    requests) is not attributed to this one. Hot paths add their own timings.
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.started = time.perf_counter()
+        self.cpu_seconds = 0.0
+        self.timings = {}
+        self.error = None
+        self._lock = threading.Lock()
+        self._owns_profiler = _profiler_lock.acquire(blocking=False)
+        if not self._owns_profiler:
+            self.error = "Another request is being profiled; only hot-path timings were recorded."
+        self._profiler = None
+        if self._owns_profiler:
+            if pyinstrument is not None:
+                self._profiler = pyinstrument.Profiler(interval=PROFILE_SAMPLE_INTERVAL, async_mode="disabled")
+            else:
+                self._profiler = cProfile.Profile()
+
+    def record(self, name: str, seconds: float) -> None:
+        with self._lock:
+            entry = self.timings.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            entry["count"] += 1
+            entry["total_ms"] += seconds * 1000
+            entry["max_ms"] = max(entry["max_ms"], seconds * 1000)
+
+    @contextmanager
+    def _running(self):
+        token = active_profile.set(self)
+        cpu_started = time.thread_time()
+        try:
+            if self._profiler is not None:
+                if pyinstrument is not None:
+                    self._profiler.start()
+                else:
+                    self._profiler.enable()
+        except (RuntimeError, ValueError) as e:
+            # 其他工具（调试器、覆盖率）占用了 profile 钩子
+            self.error = f"Profiler unavailable: {e}"
+            self._profiler = None
+        try:
+            yield
+        finally:
+            if self._profiler is not None:
+                if pyinstrument is not None:
+                    self._profiler.stop()
+                else:
+                    self._profiler.disable()
+            self.cpu_seconds += time.thread_time() - cpu_started
+            active_profile.reset(token)
+
+    def call(self, fn: Callable, *args, **kwargs):
+        with self._running():
+            return fn(*args, **kwargs)
+
+    def wrap_generator(self, generator: Iterator) -> Iterator:
+        """Profiles each step of a (sync) streaming generator, whichever worker thread runs it."""
+        while True:
+            with self._running():
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+            yield item
+
+    def finish(self, output_path: str) -> dict:
+        """
+        Writes the profile next to output_path:
+        <stem>.profile.html (pyinstrument) or <stem>.profile.prof (cProfile, e.g. for snakeviz),
+        plus <stem>.profile.json with the hot-path timings.
+        :return: summary dict with the written paths
+        """
+        stem = os.path.splitext(output_path)[0] + PROFILE_SUFFIX
+        summary = {
+            "kind": self.kind,
+            "wall_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "cpu_ms": round(self.cpu_seconds * 1000, 1),
+            "profiler": None,
+            "stats_path": None,
+            "summary_path": stem + ".json",
+            "timings": {name: {k: round(v, 2) if isinstance(v, float) else v for k, v in entry.items()}
+                        for name, entry in sorted(self.timings.items(), key=lambda kv: -kv[1]["total_ms"])},
+            "error": self.error,
+        }
+        try:
+            if self._profiler is not None and pyinstrument is not None:
+                summary["profiler"] = "pyinstrument"
+                summary["stats_path"] = stem + ".html"
+                with open(summary["stats_path"], "w", encoding="utf-8") as f:
+                    f.write(self._profiler.output_html())
+            elif self._profiler is not None:
+                summary["profiler"] = "cProfile"
+                summary["stats_path"] = stem + ".prof"
+                stats = pstats.Stats(self._profiler)
+                stats.dump_stats(summary["stats_path"])
+                summary["top_functions"] = _top_functions(stats)
+            with open(summary["summary_path"], "w", encoding="utf-8") as f:
+                json.dump(summary, f, indent=2)
+        finally:
+            if self._owns_profiler:
+                self._owns_profiler = False
+                _profiler_lock.release()
+        print(f"DEBUG: Request profile ({self.kind}) written to {summary['stats_path'] or summary['summary_path']}")
+        return summary
+
+    def abort(self) -> None:
+        if self._owns_profiler:
+            self._owns_profiler = False
+            _profiler_lock.release()
+
+
+def _top_functions(stats: pstats.Stats, limit: int = 15) -> list:
+    rows = []
+    for (filename, line, name), (_, calls, _, cumulative, _) in stats.stats.items():
+        rows.append({"function": f"{os.path.basename(filename)}:{line}({name})", "calls": calls,
+                     "cumulative_ms": round(cumulative * 1000, 2)})
+    return sorted(rows, key=lambda r: -r["cumulative_ms"])[:limit]
+
+# ----------------------------------------------------
+# 3. Entry Points
+# ----------------------------------------------------
+
+def profile_requested(headers) -> bool:
+    if not PROFILE_ADMIN_TOKEN:
+        return False
+    token = headers.get(PROFILE_HEADER)
+    return bool(token) and hmac.compare_digest(token.encode("utf-8"), PROFILE_ADMIN_TOKEN.encode("utf-8"))
+
+
+def start_profile(headers, kind: str) -> Union[RequestProfile, None]:
+    """A RequestProfile if the request carries the admin profiling header, else None."""
+    return RequestProfile(kind) if profile_requested(headers) else None
+
+
+@contextmanager
+def hot_path(name: str):
+    """Times a hot-path call into the active request profile; nothing is measured when none is active."""
+    profile = active_profile.get()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.record(name, time.perf_counter() - started)
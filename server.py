@@ -1,27 +1,57 @@
 # server.py (Full Overwrite - Final Fix)
 
 import os
+import asyncio
 import shutil
 import traceback
 from typing import List, Optional
-from fastapi import FastAPI, UploadFile, File
-# 🔥 修复：这里补上了 FileResponse
-from fastapi.responses import StreamingResponse, JSONResponse, HTMLResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, UploadFile, File, Form, Request, WebSocket
+from fastapi.responses import StreamingResponse, JSONResponse, HTMLResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import uvicorn
 import json
+from contextlib import asynccontextmanager
+from datetime import datetime
 
 from yolo_state import TEMP_DIR
 import yolo_state
 from yolo_image_processor import process_model_and_image
 # 注意：process_video_entry 现在是一个生成器
-from yolo_video_processor import process_video_entry
-from qwen_chat import stream_qwen_response 
-from report_generator import create_medical_report
+from yolo_video_processor import process_video_entry, new_job_id
+from video_streaming import hls_output_dir
+from upload_ingest import (
+    ingest_upload_file, ingest_request_body, UploadTooLarge,
+    MAX_IMAGE_BYTES, MAX_VIDEO_BYTES, MAX_MODEL_BYTES,
+)
+import chunked_upload
+from chunked_upload import ChunkedUploadError
+import realtime_detection
+from qwen_chat import astream_qwen_response, close_async_client, start_backend_health_checks
+from qwen_backends import backend_pool
+import metrics
+from pipeline_metrics import RequestMetricsMiddleware
+import storage_lifecycle
+from request_profiling import start_profile
+from media_serving import MediaFiles, FrontendIndex
+from report_generator import get_or_render_report, report_filename
+import report_export
+from report_export import stream_report_zip, MAX_EXPORT_RECORDS
+
+@asynccontextmanager
+async def lifespan(app):
+    # 后台定期探测各个 Qwen 后端
+    start_backend_health_checks()
+    # 后台按配额 / 过期时间清理上传、输出和报告目录
+    storage_lifecycle.start_background_sweeper()
+    yield
+    await storage_lifecycle.stop_background_sweeper()
+    # 关闭共享的 Qwen 连接池
+    await close_async_client()
+    # 关闭批量导出的渲染进程池
+    report_export.shutdown_pool()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -29,13 +59,33 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # 跨域时前端需要读到 inline 报告的落盘地址
+    expose_headers=["X-Report-URL", "X-Report-Cache", "X-Profile-URL"],
 )
+# 按路由模板统计请求数 / 状态码 / 耗时 / 在途请求（流式响应统计到最后一个字节）
+app.add_middleware(RequestMetricsMiddleware)
 
 os.makedirs(TEMP_DIR, exist_ok=True)
 UPLOAD_DIR = "uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 REPORT_DIR = "reports"
 os.makedirs(REPORT_DIR, exist_ok=True)
+# 默认配额 / 过期时间，可用 STORAGE_UPLOADS_MAX_MB、STORAGE_TEMP_TTL_HOURS 等覆盖（reports 见 report_generator）
+storage_lifecycle.register_directory("uploads", UPLOAD_DIR, 20 * 1024, 72)
+storage_lifecycle.register_directory("temp", TEMP_DIR, 10 * 1024, 72)
+# 长时间没有新分片的上传会话随存储清理一起回收，不再只在有人新建上传时才清理
+storage_lifecycle.add_cleanup("uploads", lambda: chunked_upload.cleanup_stale_sessions(UPLOAD_DIR))
+
+@app.middleware("http")
+async def track_media_access(request: Request, call_next):
+    # 被前端访问过的输出按最近访问时间参与 LRU 淘汰
+    response = await call_next(request)
+    path = request.url.path
+    # 只记录真实存在的文件（2xx / 304）；随便编的文件名不能让访问记录无限增长
+    if (path.startswith("/files/") or path.startswith("/reports/")) and \
+            (200 <= response.status_code < 300 or response.status_code == 304):
+        storage_lifecycle.touch(path)
+    return response
 
 class MockFileObj:
     def __init__(self, path):
@@ -45,119 +95,369 @@ def ensure_model_loaded():
     if yolo_state.current_model is None:
         yolo_state.load_model(None)
 
+def files_url(path):
+    """把 TEMP_DIR 下的文件路径转换成 /files 挂载点的 URL"""
+    rel_path = os.path.relpath(os.path.abspath(path), os.path.abspath(TEMP_DIR))
+    return "/files/" + rel_path.replace(os.sep, "/")
+
+def finish_profile(profile, output_path):
+    """写出分析结果（放在输出文件旁边），返回给前端的摘要，带可下载的 URL"""
+    summary = profile.finish(output_path)
+    for key in ("stats_path", "summary_path"):
+        path = summary.get(key)
+        url = None
+        if path and os.path.abspath(path).startswith(os.path.abspath(TEMP_DIR) + os.sep):
+            url = files_url(path)
+        elif path and os.path.dirname(os.path.abspath(path)) == os.path.abspath(REPORT_DIR):
+            url = f"/reports/{os.path.basename(path)}"
+        summary[key.replace("_path", "_url")] = url
+    return summary
+
 # --- APIs ---
 
 @app.post("/api/upload_model")
 async def upload_model(file: UploadFile = File(...)):
     try:
-        file_path = os.path.join(UPLOAD_DIR, file.filename)
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        result = yolo_state.load_model(MockFileObj(file_path))
+        ingested = await ingest_upload_file(file, UPLOAD_DIR, MAX_MODEL_BYTES)
+        result = yolo_state.load_model(MockFileObj(ingested.path))
         return {"status": result}
+    except UploadTooLarge as e:
+        return JSONResponse(status_code=413, content={"status": str(e)})
     except Exception as e:
         return JSONResponse(status_code=500, content={"status": str(e)})
 
+def run_image_detection(saved_input_paths, request_headers=None):
+    """对已落盘的图片执行检测，返回给前端的 JSON 数据"""
+    current_model_mock = MockFileObj(yolo_state.current_model_path) if yolo_state.current_model_path else None
+    # 带管理员分析头的请求：检测过程在分析器里跑（没有时不做任何额外工作）
+    profile = start_profile(request_headers, "detect_image") if request_headers is not None else None
+    # 检测期间输入和输出都不能被后台清理删掉
+    with storage_lifecycle.in_use(*saved_input_paths):
+        try:
+            if profile is None:
+                _, text, conf, context_path, saved_output_paths = process_model_and_image(current_model_mock, saved_input_paths)
+            else:
+                _, text, conf, context_path, saved_output_paths = profile.call(
+                    process_model_and_image, current_model_mock, saved_input_paths)
+        except BaseException:
+            if profile is not None:
+                profile.abort()
+            raise
+    # 返回的 context_path 接下来会被对话使用
+    storage_lifecycle.reference(context_path)
+    
+    results_urls = [f"/files/{os.path.basename(p)}" for p in saved_output_paths]
+    response = {
+        "images": results_urls, "text": text, "conf": conf, 
+        "context_path": context_path
+    }
+    if profile is not None:
+        response["profile"] = finish_profile(profile, context_path or os.path.join(TEMP_DIR, os.path.basename(saved_input_paths[0])))
+    return response
+
 @app.post("/api/detect_image")
-async def detect_image(files: List[UploadFile] = File(...)):
+async def detect_image(request: Request, files: List[UploadFile] = File(...)):
     try:
         ensure_model_loaded()
         saved_input_paths = []
         for file in files:
-            path = os.path.join(UPLOAD_DIR, file.filename)
-            with open(path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            saved_input_paths.append(path)
-        
-        current_model_mock = MockFileObj(yolo_state.current_model_path) if yolo_state.current_model_path else None
-        _, text, conf, context_path, saved_output_paths = process_model_and_image(current_model_mock, saved_input_paths)
-        
-        results_urls = [f"/files/{os.path.basename(p)}" for p in saved_output_paths]
-        return {
-            "images": results_urls, "text": text, "conf": conf, 
-            "context_path": context_path
-        }
+            # 按内容哈希命名：同名文件不会互相覆盖，重复上传不会多存一份
+            ingested = await ingest_upload_file(file, UPLOAD_DIR, MAX_IMAGE_BYTES)
+            saved_input_paths.append(ingested.path)
+        return run_image_detection(saved_input_paths, request.headers)
+    except UploadTooLarge as e:
+        return JSONResponse(status_code=413, content={"text": str(e)})
     except Exception as e:
         traceback.print_exc()
         return JSONResponse(status_code=500, content={"text": str(e)})
 
+def video_detection_response(input_path, stream=False, request_headers=None):
+    """对已落盘的视频启动检测，返回 NDJSON 流式响应"""
+    current_model_mock = MockFileObj(yolo_state.current_model_path) if yolo_state.current_model_path else None
+
+    # 上传按内容哈希命名，同一个视频可能同时被处理多次：每个任务的输出和 HLS 目录都带任务 ID
+    job_id = new_job_id()
+    # 流式模式：HLS 分片直接写进 TEMP_DIR，处理过程中就能通过 /files 播放
+    stream_dir = None
+    if stream:
+        base_name = os.path.splitext(os.path.basename(input_path))[0]
+        stream_dir = hls_output_dir(TEMP_DIR, f"{base_name}_{job_id}")
+    
+    # 这里的生成器负责产生 SSE 数据流
+    job = {"output_path": None}
+
+    def video_stream_generator():
+        with storage_lifecycle.in_use(input_path):
+            profile = start_profile(request_headers, "detect_video") if request_headers is not None else None
+            if profile is None:
+                yield from process_video_chunks()
+                return
+            # 分析模式：每一步都在分析器里跑，结束后多发一行 {"type": "profile", ...}
+            try:
+                yield from profile.wrap_generator(process_video_chunks())
+            except BaseException:
+                profile.abort()
+                raise
+            summary = finish_profile(profile, job["output_path"] or os.path.join(TEMP_DIR, os.path.basename(input_path)))
+            yield json.dumps({"type": "profile", "profile": summary}) + "\n"
+
+    def process_video_chunks():
+        generator = process_video_entry(current_model_mock, input_path, stream_dir=stream_dir, job_id=job_id)
+        for chunk in generator:
+            # 检查是否是结果数据，如果是，需要移动文件
+            try:
+                data = json.loads(chunk)
+                if data["type"] == "stream":
+                    yield json.dumps({"type": "stream", "playlist_url": files_url(data["playlist_path"])}) + "\n"
+                elif data["type"] == "result":
+                    output_path = data["data"]["output_path"]
+                    if output_path and os.path.exists(output_path):
+                        filename = os.path.basename(output_path)
+                        final_path = os.path.join(TEMP_DIR, filename)
+                        if os.path.abspath(output_path) != os.path.abspath(final_path):
+                            shutil.move(output_path, final_path)
+                        job["output_path"] = final_path
+                        # 更新 URL 给前端
+                        data["data"]["video_url"] = f"/files/{filename}"
+                        # 有关键帧拼图时保持不变，否则才退回到视频本身
+                        if data["data"].get("context_path") == output_path:
+                            data["data"]["context_path"] = final_path
+                        data["data"]["keyframe_urls"] = [files_url(p) for p in data["data"].pop("keyframe_paths", [])]
+                        playlist_path = data["data"].pop("playlist_path", None)
+                        data["data"]["playlist_url"] = files_url(playlist_path) if playlist_path else None
+                        storage_lifecycle.reference(data["data"].get("context_path"))
+                        yield json.dumps(data) + "\n"
+                    else:
+                        yield json.dumps({"type": "error", "message": "Output file generation failed"}) + "\n"
+                else:
+                    yield chunk # 进度或错误直接转发
+            except:
+                yield chunk
+
+    return StreamingResponse(video_stream_generator(), media_type="application/x-ndjson")
+
 # 🔥 核心修改：流式视频接口
 @app.post("/api/detect_video")
-async def detect_video(file: UploadFile = File(...)):
+async def detect_video(request: Request, file: UploadFile = File(...), stream: bool = Form(False)):
     try:
         ensure_model_loaded()
-        input_path = os.path.join(UPLOAD_DIR, file.filename)
-        with open(input_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        current_model_mock = MockFileObj(yolo_state.current_model_path) if yolo_state.current_model_path else None
-        
-        # 这里的生成器负责产生 SSE 数据流
-        def video_stream_generator():
-            generator = process_video_entry(current_model_mock, input_path)
-            for chunk in generator:
-                # 检查是否是结果数据，如果是，需要移动文件
-                try:
-                    data = json.loads(chunk)
-                    if data["type"] == "result":
-                        output_path = data["data"]["output_path"]
-                        if output_path and os.path.exists(output_path):
-                            filename = os.path.basename(output_path)
-                            final_path = os.path.join(TEMP_DIR, filename)
-                            if os.path.abspath(output_path) != os.path.abspath(final_path):
-                                shutil.move(output_path, final_path)
-                            # 更新 URL 给前端
-                            data["data"]["video_url"] = f"/files/{filename}"
-                            data["data"]["context_path"] = final_path
-                            yield json.dumps(data) + "\n"
-                        else:
-                            yield json.dumps({"type": "error", "message": "Output file generation failed"}) + "\n"
-                    else:
-                        yield chunk # 进度或错误直接转发
-                except:
-                    yield chunk
+        ingested = await ingest_upload_file(file, UPLOAD_DIR, MAX_VIDEO_BYTES)
+        return video_detection_response(ingested.path, stream, request.headers)
+    except UploadTooLarge as e:
+        return JSONResponse(status_code=413, content={"error": str(e)})
+    except Exception as e:
+        traceback.print_exc()
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+# 原始请求体上传：边收边写盘边算哈希，省掉 multipart 先缓存再拷贝的一整遍
+# 用法: POST /api/detect_video_stream?filename=xxx.mp4&stream=true  (body 为视频二进制)
+@app.post("/api/detect_video_stream")
+async def detect_video_stream(request: Request, filename: str, stream: bool = False):
+    try:
+        ensure_model_loaded()
+        ingested = await ingest_request_body(request, filename, UPLOAD_DIR, MAX_VIDEO_BYTES)
+        return video_detection_response(ingested.path, stream, request.headers)
+    except UploadTooLarge as e:
+        return JSONResponse(status_code=413, content={"error": str(e)})
+    except Exception as e:
+        traceback.print_exc()
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+# ----------------------------------------------------
+# 断点续传：initiate -> PUT chunks -> complete
+# ----------------------------------------------------
+class UploadInitRequest(BaseModel):
+    filename: str
+    size: int
+    kind: str  # "image" | "video"
+    chunk_size: Optional[int] = None
+    sha256: Optional[str] = None  # 可选：整个文件的 SHA-256，用于组装后校验
+
+@app.post("/api/uploads")
+async def init_chunked_upload(request: UploadInitRequest):
+    try:
+        session = chunked_upload.create_session(
+            UPLOAD_DIR, request.filename, request.size, request.kind,
+            chunk_size=request.chunk_size, sha256=request.sha256,
+        )
+        return {"upload_id": session["upload_id"], "chunk_size": session["chunk_size"], "total_chunks": session["total_chunks"]}
+    except ChunkedUploadError as e:
+        return JSONResponse(status_code=e.status_code, content={"error": str(e)})
+
+@app.get("/api/uploads/{upload_id}")
+async def chunked_upload_status(upload_id: str):
+    # 客户端断线重连后先查询，只重传 missing 里的分片
+    try:
+        session = chunked_upload.load_session(UPLOAD_DIR, upload_id)
+        return chunked_upload.session_status(session)
+    except ChunkedUploadError as e:
+        return JSONResponse(status_code=e.status_code, content={"error": str(e)})
 
-        return StreamingResponse(video_stream_generator(), media_type="application/x-ndjson")
+@app.put("/api/uploads/{upload_id}/chunks/{index}")
+async def put_upload_chunk(upload_id: str, index: int, request: Request):
+    try:
+        session = chunked_upload.load_session(UPLOAD_DIR, upload_id)
+        await chunked_upload.write_chunk(session, index, request.stream(), request.headers.get("x-chunk-sha256"))
+        return {"index": index, "missing": chunked_upload.missing_chunks(session)}
+    except ChunkedUploadError as e:
+        return JSONResponse(status_code=e.status_code, content={"error": str(e)})
 
+@app.post("/api/uploads/{upload_id}/complete")
+async def complete_chunked_upload(upload_id: str, request: Request, stream: bool = False):
+    try:
+        session = chunked_upload.load_session(UPLOAD_DIR, upload_id)
+        ensure_model_loaded()
+        ingested = await chunked_upload.assemble(session, UPLOAD_DIR)
+        # 组装完成后交给原有的图片/视频处理流程
+        if session["kind"] == "video":
+            return video_detection_response(ingested.path, stream, request.headers)
+        return run_image_detection([ingested.path], request.headers)
+    except ChunkedUploadError as e:
+        return JSONResponse(status_code=e.status_code, content={"error": str(e)})
     except Exception as e:
         traceback.print_exc()
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+# 实时检测：客户端逐帧发送 JPEG，服务端逐帧返回检测结果（处理不过来时只保留最新帧）
+@app.websocket("/ws/detect")
+async def ws_detect(websocket: WebSocket, annotate: bool = False):
+    ensure_model_loaded()
+    if yolo_state.current_model is None:
+        # 没有模型时不建立会话：能发 HTTP 拒绝响应就带上原因，否则用关闭原因
+        message = "No model loaded. Upload a .pt model or place the default model next to server.py."
+        try:
+            await websocket.send_denial_response(JSONResponse(status_code=503, content={"error": message}))
+        except RuntimeError:
+            await websocket.close(code=1011, reason=message)
+        return
+    await realtime_detection.run_session(websocket, annotate=annotate)
+
 class ChatRequest(BaseModel):
     message: str
     history: List[List[str]] 
     context_path: Optional[str] = None
+    # always / auto / never：追问时是否重复发送图片（见 detection_context）
+    image_mode: Optional[str] = None
 
 @app.post("/api/chat_stream")
 async def chat_stream(request: ChatRequest):
-    def robust_generator():
+    # 会话还在用这个上下文：续期，避免被后台清理；不在托管目录里的路径直接拒绝
+    if request.context_path and not storage_lifecycle.reference(request.context_path):
+        return JSONResponse(status_code=400, content={"error": "Unknown context_path."})
+    # 原生异步生成器：每个对话只占一个协程，不再占用线程池线程
+    async def robust_generator():
         try:
             formatted_history = []
             for h in request.history:
                 if isinstance(h, list) and len(h) >= 2:
                     formatted_history.append((str(h[0]), str(h[1])))
-            iterator = stream_qwen_response(request.message, formatted_history, request.context_path)
-            for chunk in iterator:
+            async for chunk in astream_qwen_response(request.message, formatted_history, request.context_path,
+                                                   request.image_mode):
                 yield chunk
         except Exception as e:
             yield f" [System Error: {str(e)}]"
-    return StreamingResponse(robust_generator(), media_type="text/plain")
+    # 禁止反向代理（nginx 等）缓冲，否则客户端看到的首 token 会被攒批延后
+    return StreamingResponse(robust_generator(), media_type="text/plain",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/api/qwen_backends")
+async def qwen_backends_status():
+    return {"backends": backend_pool.status()}
+
+@app.get("/api/chat_metrics")
+async def chat_metrics_snapshot():
+    """对话延迟直方图（秒；tokens_per_second 除外）：count / mean / p50 / p90 / p99 / max"""
+    return metrics.snapshot("chat_")
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus 抓取入口：各阶段延迟直方图、在途请求 / 队列深度 / 已加载模型、按接口和结果的计数"""
+    return Response(content=metrics.render_prometheus(), media_type=metrics.PROMETHEUS_CONTENT_TYPE)
+
+@app.get("/api/storage")
+async def storage_status():
+    """各受管目录的占用、配额、过期时间和受保护条目数"""
+    return await asyncio.to_thread(storage_lifecycle.usage)
 
 @app.post("/api/generate_report")
-async def generate_report(request: ChatRequest):
+async def generate_report(request: ChatRequest, raw_request: Request, inline: bool = False, save: bool = False):
+    """
+    默认：写入 reports/ 并返回 {"report_url": ...}（与原接口一致）
+    ?inline=true：直接在响应里返回 PDF 字节，省去落盘和第二次请求；
+    再加 &save=true 时同时落盘，地址放在 X-Report-URL 头里
+    相同的对话 + 图片 + 模板版本直接返回已有 PDF（cached / X-Report-Cache）
+    带 X-Profile-Token 时渲染过程在分析器里跑，结果见 "profile" / X-Profile-URL
+    """
+    if request.context_path and not storage_lifecycle.reference(request.context_path):
+        return JSONResponse(status_code=400, content={"error": "Unknown context_path."})
+    profile = None
     try:
         formatted_history = [(h[0], h[1]) for h in request.history]
-        report_path = create_medical_report(formatted_history, request.context_path)
-        filename = os.path.basename(report_path)
-        return {"report_url": f"/reports/{filename}"}
+        # 渲染是 CPU 密集的同步代码，放到线程里，不阻塞事件循环；
+        # 对话和图片都没变时直接复用已生成的 PDF
+        args = (get_or_render_report, formatted_history, request.context_path, not inline or save)
+        profile = start_profile(raw_request.headers, "generate_report")
+        if profile is not None:
+            args = (profile.call,) + args
+        pdf_bytes, report_path, cache_hit = await asyncio.to_thread(*args)
+
+        filename = os.path.basename(report_path) if report_path else report_filename(pdf_bytes)
+        profile_summary = None
+        if profile is not None:
+            profile_summary = finish_profile(profile, os.path.join(REPORT_DIR, filename))
+            profile = None
+        if not inline:
+            response = {"report_url": f"/reports/{filename}", "cached": cache_hit}
+            if profile_summary is not None:
+                response["profile"] = profile_summary
+            return response
+
+        headers = {"Content-Disposition": f'inline; filename="{filename}"',
+                   "X-Report-Cache": "hit" if cache_hit else "miss"}
+        if report_path:
+            headers["X-Report-URL"] = f"/reports/{filename}"
+        if profile_summary is not None and profile_summary.get("summary_url"):
+            headers["X-Profile-URL"] = profile_summary["summary_url"]
+        return Response(content=pdf_bytes, media_type="application/pdf", headers=headers)
     except Exception as e:
+        if profile is not None:
+            profile.abort()
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+class ReportExportRecord(BaseModel):
+    name: Optional[str] = None
+    history: List[List[str]]
+    context_path: Optional[str] = None
+
+class ReportExportRequest(BaseModel):
+    records: List[ReportExportRecord]
+
+@app.post("/api/export_reports")
+async def export_reports(request: ReportExportRequest):
+    """批量导出：多进程并行渲染，每完成一份就写进流式 ZIP；失败的记录写在 manifest.json 里"""
+    if not request.records:
+        return JSONResponse(status_code=400, content={"error": "No records to export."})
+    if len(request.records) > MAX_EXPORT_RECORDS:
+        return JSONResponse(status_code=413, content={"error": f"Too many records (max {MAX_EXPORT_RECORDS})."})
+
+    records = [{
+        "name": r.name,
+        "history": [(str(h[0]), str(h[1])) for h in r.history if len(h) >= 2],
+        "context_path": r.context_path,
+    } for r in request.records]
+    for index, r in enumerate(records):
+        if r["context_path"] and not storage_lifecycle.reference(r["context_path"]):
+            return JSONResponse(status_code=400, content={"error": f"Unknown context_path in record {index + 1}."})
+    filename = f"reports_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+    return StreamingResponse(stream_report_zip(records), media_type="application/zip",
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
 # ----------------------------------------------------
 # 挂载静态文件 (核心修改)
 # ----------------------------------------------------
-app.mount("/files", StaticFiles(directory=TEMP_DIR), name="files")
-app.mount("/reports", StaticFiles(directory=REPORT_DIR), name="reports")
+# 强 ETag + 缓存策略；视频拖动进度条时的 Range 请求直接从磁盘按段读取
+app.mount("/files", MediaFiles(directory=TEMP_DIR), name="files")
+app.mount("/reports", MediaFiles(directory=REPORT_DIR), name="reports")
 
 # 挂载前端 (Web UI 用)
 # 假设你已经按照第1步整理好了 frontend_build 文件夹
@@ -165,19 +465,13 @@ frontend_dir = "frontend_build"
 
 if os.path.exists(frontend_dir) and os.path.exists(os.path.join(frontend_dir, "index.html")):
     print(f"✅ Frontend loaded from: {frontend_dir}")
-    
-    # 挂载 assets (为了确保 JS/CSS 路径正确)
-    assets_dir = os.path.join(frontend_dir, "assets")
-    if os.path.exists(assets_dir):
-        app.mount("/assets", StaticFiles(directory=assets_dir), name="assets")
-
-    # SPA 路由兜底 (解决刷新 404)
-    @app.get("/{full_path:path}")
-    async def serve_spa(full_path: str):
-        file_path = os.path.join(frontend_dir, full_path)
-        if os.path.exists(file_path) and os.path.isfile(file_path):
-            return FileResponse(file_path)
-        return FileResponse(os.path.join(frontend_dir, "index.html"))
+    # 启动时把整个 bundle（含 gzip / brotli 版本）读进内存，请求时不再访问文件系统
+    frontend_index = FrontendIndex(frontend_dir)
+
+    # SPA 路由兜底 (解决刷新 404)；/assets/* 也由这里直接从内存返回，不存在的文件返回 404
+    @app.api_route("/{full_path:path}", methods=["GET", "HEAD"])
+    async def serve_spa(full_path: str, request: Request):
+        return frontend_index.response(full_path, request)
 else:
     print(f"⚠️ Frontend NOT found in {frontend_dir}")
     @app.get("/")
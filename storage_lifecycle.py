@@ -0,0 +1,365 @@
+# storage_lifecycle.py
+
+import os
+import re
+import time
+import shutil
+import asyncio
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, NamedTuple, Union
+
+# ----------------------------------------------------
+# 1. Configuration
+# ----------------------------------------------------
+# 后台清理间隔
+STORAGE_SWEEP_INTERVAL_SECONDS = float(os.environ.get("STORAGE_SWEEP_INTERVAL_SECONDS", "300"))
+# 对话/报告用到的 context_path 在最后一次使用后保留多久（前端会话通常不会比这更长）
+CONTEXT_LEASE_SECONDS = float(os.environ.get("STORAGE_CONTEXT_LEASE_HOURS", "24")) * 3600
+# 刚写入的文件一律不删：检测刚结束、响应还没发给前端时还来不及登记引用
+MIN_AGE_SECONDS = float(os.environ.get("STORAGE_MIN_AGE_SECONDS", "600"))
+# 写到一半的临时文件（.partial-*）多久没有再写入就算被遗弃（进程崩溃、连接断开后没清理）
+PARTIAL_MAX_AGE_SECONDS = float(os.environ.get("STORAGE_PARTIAL_MAX_AGE_HOURS", "6")) * 3600
+
+# 一次检测的所有产物（上传原件、标注图、处理后视频、关键帧、检测记录、HLS 目录）
+# 文件名里都带着上传内容的 SHA-256，按它分组：引用其中任何一个就保护整组
+_GROUP_RE = re.compile(r"[0-9a-f]{64}")
+
+# ----------------------------------------------------
+# 2. Policies
+# ----------------------------------------------------
+
+class StoragePolicy(NamedTuple):
+    name: str
+    directory: str
+    max_bytes: int        # 0 = 不限
+    ttl_seconds: float    # 0 = 不过期
+
+
+_policies: Dict[str, StoragePolicy] = {}
+# 目录里由其他模块自己管理的内容（分片上传会话等）：每次 sweep 前先调用它们的清理函数
+_cleanups: Dict[str, List[Callable[[], object]]] = {}
+
+
+def register_directory(name: str, directory: str, max_mb: int, ttl_hours: float) -> StoragePolicy:
+    """
+    Puts a directory under lifecycle management. The defaults can be overridden
+    per directory with STORAGE_<NAME>_MAX_MB and STORAGE_<NAME>_TTL_HOURS (0 disables).
+    """
+    prefix = f"STORAGE_{name.upper()}_"
+    max_mb = int(os.environ.get(prefix + "MAX_MB", str(max_mb)))
+    ttl_hours = float(os.environ.get(prefix + "TTL_HOURS", str(ttl_hours)))
+    policy = StoragePolicy(name, directory, max_mb * 1024 * 1024, ttl_hours * 3600)
+    _policies[name] = policy
+    return policy
+
+
+def add_cleanup(name: str, cleanup: Callable[[], object]) -> None:
+    """Runs `cleanup` at the start of every sweep of directory `name`."""
+    _cleanups.setdefault(name, []).append(cleanup)
+
+# ----------------------------------------------------
+# 3. Access Tracking & References
+# ----------------------------------------------------
+# 很多部署用 noatime 挂载，文件系统的 atime 不可靠，所以访问时间记在内存里；
+# 进程重启后退回到 mtime
+_lock = threading.Lock()
+_last_access: Dict[str, float] = {}
+_pins: Dict[str, int] = {}          # 正在运行的任务引用的分组 -> 引用计数
+_leases: Dict[str, float] = {}      # 对话 context_path 的分组 -> 租约到期时间
+_last_sweep: Dict[str, float] = {}
+
+
+def group_key(path: str) -> str:
+    """Eviction unit of a file: the upload hash it was derived from, or its own name."""
+    match = _GROUP_RE.search(path.replace(os.sep, "/"))
+    return match.group(0) if match else os.path.basename(path.rstrip("/" + os.sep))
+
+
+def touch(path: Union[str, None]) -> None:
+    """
+    Records an access (served, used as chat context, report cache hit).
+    Only call it for files that exist: every key stays in memory until sweep() deletes the group.
+    """
+    if path:
+        _last_access[group_key(path)] = time.time()
+
+
+def is_managed(path: Union[str, None]) -> bool:
+    """True if path is an existing file or directory inside one of the managed directories."""
+    if not path:
+        return False
+    real = os.path.realpath(path)
+    if not os.path.exists(real):
+        return False
+    for policy in list(_policies.values()):
+        root = os.path.realpath(policy.directory)
+        if real != root and real.startswith(root + os.sep):
+            return True
+    return False
+
+
+def reference(path: Union[str, None]) -> bool:
+    """
+    Marks a context_path as in use by a chat session for the next CONTEXT_LEASE_SECONDS.
+    context_path comes from the client: paths outside the managed directories, or that
+    do not exist, are not recorded and False is returned.
+    """
+    if not is_managed(path):
+        return False
+    now = time.time()
+    key = group_key(path)
+    with _lock:
+        _last_access[key] = now
+        _leases[key] = now + CONTEXT_LEASE_SECONDS
+    return True
+
+
+@contextmanager
+def in_use(*paths: str):
+    """Protects the given files (and their whole group) from eviction while a job runs."""
+    keys = [group_key(p) for p in paths if p]
+    with _lock:
+        for key in keys:
+            _pins[key] = _pins.get(key, 0) + 1
+    try:
+        yield
+    finally:
+        now = time.time()
+        with _lock:
+            for key in keys:
+                _last_access[key] = now
+                _pins[key] -= 1
+                if _pins[key] <= 0:
+                    del _pins[key]
+
+
+def _is_protected(key: str, now: float) -> bool:
+    # 调用方持有 _lock
+    if key in _pins:
+        return True
+    expires = _leases.get(key)
+    if expires is None:
+        return False
+    if expires < now:
+        del _leases[key]
+        return False
+    return True
+
+# ----------------------------------------------------
+# 4. Eviction
+# ----------------------------------------------------
+
+class _Entry(NamedTuple):
+    path: str
+    key: str
+    size: int
+    last_access: float
+    is_dir: bool
+    # "group"：按 TTL / LRU 淘汰；"partial"：写到一半的临时文件，按空闲时间回收；
+    # "private"：其他隐藏条目（分片上传会话等），由所属模块清理，只计入配额
+    kind: str = "group"
+
+
+def _dir_usage(path: str) -> tuple:
+    """(total bytes, newest mtime) of a directory tree, e.g. an HLS output directory."""
+    size, newest = 0, os.path.getmtime(path)
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            size += st.st_size
+            newest = max(newest, st.st_mtime)
+    return size, newest
+
+
+def _scan(directory: str) -> List[_Entry]:
+    entries = []
+    try:
+        iterator = list(os.scandir(directory))
+    except OSError:
+        return entries
+    for entry in iterator:
+        if ".partial-" in entry.name:
+            kind = "partial"
+        elif entry.name.startswith("."):
+            kind = "private"
+        else:
+            kind = "group"
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                size, mtime = _dir_usage(entry.path)
+                is_dir = True
+            else:
+                st = entry.stat(follow_symlinks=False)
+                size, mtime, is_dir = st.st_size, st.st_mtime, False
+        except OSError:
+            continue
+        if kind != "group":
+            entries.append(_Entry(entry.path, entry.name, size, mtime, is_dir, kind))
+            continue
+        key = group_key(entry.name)
+        entries.append(_Entry(entry.path, key, size, max(mtime, _last_access.get(key, 0.0)), is_dir))
+    return entries
+
+
+def _remove(entry: _Entry) -> bool:
+    try:
+        if entry.is_dir:
+            shutil.rmtree(entry.path)
+        else:
+            os.remove(entry.path)
+    except OSError:
+        return False
+    return True
+
+
+def sweep(name: str) -> dict:
+    """
+    Enforces one directory's policy: deletes entries past the TTL, then the least
+    recently used ones until the directory fits its byte quota. Entries referenced
+    by a running job or a live chat context, or younger than MIN_AGE_SECONDS, are kept.
+    Abandoned .partial-* files are removed after PARTIAL_MAX_AGE_SECONDS; hidden
+    entries count towards the quota but are cleaned up by the module that owns them.
+    """
+    policy = _policies.get(name)
+    if policy is None:
+        return {}
+    for cleanup in _cleanups.get(name, ()):
+        try:
+            cleanup()
+        except Exception as e:
+            print(f"DEBUG: Storage cleanup hook for [{name}] failed: {e}")
+    now = time.time()
+    _last_sweep[name] = now
+    scanned = _scan(policy.directory)
+    total = sum(e.size for e in scanned)
+    removed, freed = 0, 0
+
+    for entry in scanned:
+        if entry.kind == "partial" and now - entry.last_access > PARTIAL_MAX_AGE_SECONDS and _remove(entry):
+            removed += 1
+            freed += entry.size
+            total -= entry.size
+
+    entries = [e for e in scanned if e.kind == "group"]
+    # 分组在本目录里还剩几个条目；删完最后一个时清掉它的访问记录
+    remaining: Dict[str, int] = {}
+    for entry in entries:
+        remaining[entry.key] = remaining.get(entry.key, 0) + 1
+
+    for entry in sorted(entries, key=lambda e: e.last_access):
+        idle = now - entry.last_access
+        expired = policy.ttl_seconds and idle > policy.ttl_seconds
+        over_quota = policy.max_bytes and total > policy.max_bytes
+        if not expired and not over_quota:
+            # 按访问时间升序：后面的条目更新，既不会过期也不需要再腾空间
+            break
+        if idle < MIN_AGE_SECONDS:
+            break
+        # 删除前在锁内再确认一次，避免扫描之后刚被任务引用
+        with _lock:
+            if _is_protected(entry.key, now):
+                continue
+            if not _remove(entry):
+                continue
+            remaining[entry.key] -= 1
+            if not remaining[entry.key]:
+                _last_access.pop(entry.key, None)
+                _leases.pop(entry.key, None)
+        removed += 1
+        freed += entry.size
+        total -= entry.size
+
+    if removed:
+        print(f"DEBUG: Storage sweep [{name}] removed {removed} entries, freed {freed / 1024 / 1024:.1f} MB, "
+              f"now {total / 1024 / 1024:.1f} MB")
+    return {"removed": removed, "freed_bytes": freed, "used_bytes": total}
+
+
+def maybe_sweep(name: str, min_interval: float = 60.0) -> None:
+    """Opportunistic, throttled sweep right after a write; a no-op for unregistered directories."""
+    if name in _policies and time.time() - _last_sweep.get(name, 0.0) >= min_interval:
+        sweep(name)
+
+
+def prune_records() -> int:
+    """
+    Drops expired leases and access records of groups that no longer have any file
+    in a managed directory (deleted elsewhere, or never existed). Pins are left alone:
+    they belong to running jobs and are released by in_use().
+    """
+    present = set()
+    for policy in list(_policies.values()):
+        present.update(e.key for e in _scan(policy.directory) if e.kind == "group")
+    now = time.time()
+    with _lock:
+        stale = [k for k, expires in _leases.items() if expires < now]
+        for key in stale:
+            del _leases[key]
+        orphans = [k for k in _last_access if k not in present and k not in _pins and k not in _leases]
+        for key in orphans:
+            del _last_access[key]
+    return len(stale) + len(orphans)
+
+
+def sweep_all() -> dict:
+    result = {name: sweep(name) for name in list(_policies)}
+    prune_records()
+    return result
+
+
+def usage() -> dict:
+    """Current usage per managed directory, for the storage status endpoint."""
+    now = time.time()
+    result = {}
+    for name, policy in _policies.items():
+        scanned = _scan(policy.directory)
+        entries = [e for e in scanned if e.kind == "group"]
+        with _lock:
+            protected = sum(1 for e in entries if _is_protected(e.key, now))
+        result[name] = {
+            "directory": policy.directory,
+            "used_bytes": sum(e.size for e in scanned),
+            "unmanaged_bytes": sum(e.size for e in scanned if e.kind != "group"),
+            "max_bytes": policy.max_bytes,
+            "ttl_hours": policy.ttl_seconds / 3600,
+            "entries": len(entries),
+            "protected_entries": protected,
+            "last_sweep": _last_sweep.get(name),
+        }
+    return result
+
+# ----------------------------------------------------
+# 5. Background Sweeper
+# ----------------------------------------------------
+_sweeper_task = None
+
+
+async def _sweep_loop() -> None:
+    while True:
+        try:
+            # 遍历目录是阻塞 IO，放到线程里
+            await asyncio.to_thread(sweep_all)
+        except Exception as e:
+            print(f"DEBUG: Storage sweep failed: {e}")
+        await asyncio.sleep(STORAGE_SWEEP_INTERVAL_SECONDS)
+
+
+def start_background_sweeper() -> None:
+    global _sweeper_task
+    if _sweeper_task is None and STORAGE_SWEEP_INTERVAL_SECONDS > 0:
+        _sweeper_task = asyncio.create_task(_sweep_loop())
+
+
+async def stop_background_sweeper() -> None:
+    global _sweeper_task
+    if _sweeper_task is not None:
+        _sweeper_task.cancel()
+        try:
+            await _sweeper_task
+        except asyncio.CancelledError:
+            pass
+        _sweeper_task = None
@@ -0,0 +1,104 @@
+# tests/test_chunked_upload.py
+
+import os
+import asyncio
+import hashlib
+
+import pytest
+
+import chunked_upload
+from chunked_upload import ChunkedUploadError, MIN_CHUNK_SIZE
+
+CHUNK = MIN_CHUNK_SIZE
+
+
+@pytest.fixture
+def upload_dir(tmp_path):
+    return str(tmp_path / "uploads")
+
+
+async def _body(data: bytes):
+    # 模拟 request.stream()：分几次到达
+    for i in range(0, len(data), 64 * 1024):
+        yield data[i:i + 64 * 1024]
+
+
+def _payload(size: int) -> bytes:
+    return bytes(i % 251 for i in range(size))
+
+
+def _put(session: dict, index: int, data: bytes) -> None:
+    piece = data[index * session["chunk_size"]:(index + 1) * session["chunk_size"]]
+    asyncio.run(chunked_upload.write_chunk(session, index, _body(piece)))
+
+
+def test_out_of_order_chunks_assemble_in_order(upload_dir):
+    data = _payload(CHUNK * 2 + 1000)
+    meta = chunked_upload.create_session(upload_dir, "scan.jpg", len(data), "image", CHUNK,
+                                         hashlib.sha256(data).hexdigest())
+    session = chunked_upload.load_session(upload_dir, meta["upload_id"])
+    for index in (2, 0, 1):
+        _put(session, index, data)
+    assert chunked_upload.missing_chunks(session) == []
+
+    ingested = asyncio.run(chunked_upload.assemble(session, upload_dir))
+    with open(ingested.path, "rb") as f:
+        assert f.read() == data
+    assert not os.path.exists(session["dir"])
+
+
+def test_missing_chunk_is_rejected(upload_dir):
+    data = _payload(CHUNK * 3)
+    meta = chunked_upload.create_session(upload_dir, "scan.jpg", len(data), "image", CHUNK)
+    session = chunked_upload.load_session(upload_dir, meta["upload_id"])
+    _put(session, 0, data)
+    _put(session, 2, data)
+
+    with pytest.raises(ChunkedUploadError) as e:
+        asyncio.run(chunked_upload.assemble(session, upload_dir))
+    assert e.value.status_code == 409 and "[1]" in str(e.value)
+    # 会话保留，客户端可以补传
+    assert chunked_upload.session_status(session)["missing"] == [1]
+
+
+def test_oversize_upload_and_chunk_are_rejected(upload_dir):
+    with pytest.raises(ChunkedUploadError) as e:
+        chunked_upload.create_session(upload_dir, "big.jpg", chunked_upload.MAX_BYTES_BY_KIND["image"] + 1, "image")
+    assert e.value.status_code == 413
+
+    meta = chunked_upload.create_session(upload_dir, "scan.jpg", CHUNK + 10, "image", CHUNK)
+    session = chunked_upload.load_session(upload_dir, meta["upload_id"])
+    with pytest.raises(ChunkedUploadError):
+        asyncio.run(chunked_upload.write_chunk(session, 1, _body(b"x" * 11)))
+    assert chunked_upload.received_chunks(session) == []
+
+
+def test_open_session_limits(upload_dir, monkeypatch):
+    monkeypatch.setattr(chunked_upload, "MAX_OPEN_SESSIONS", 2)
+    monkeypatch.setattr(chunked_upload, "MAX_OPEN_SESSION_BYTES", CHUNK * 3)
+    chunked_upload.create_session(upload_dir, "a.jpg", CHUNK * 2, "image", CHUNK)
+    with pytest.raises(ChunkedUploadError) as e:
+        chunked_upload.create_session(upload_dir, "b.jpg", CHUNK * 2, "image", CHUNK)
+    assert e.value.status_code == 507
+    chunked_upload.create_session(upload_dir, "c.jpg", CHUNK, "image", CHUNK)
+    with pytest.raises(ChunkedUploadError) as e:
+        chunked_upload.create_session(upload_dir, "d.jpg", 10, "image", CHUNK)
+    assert e.value.status_code == 429
+
+
+def test_repeated_complete_assembles_once(upload_dir):
+    data = _payload(CHUNK + 500)
+    meta = chunked_upload.create_session(upload_dir, "scan.jpg", len(data), "image", CHUNK)
+    session = chunked_upload.load_session(upload_dir, meta["upload_id"])
+    _put(session, 0, data)
+    _put(session, 1, data)
+
+    async def complete_twice():
+        return await asyncio.gather(chunked_upload.assemble(dict(session), upload_dir),
+                                    chunked_upload.assemble(dict(session), upload_dir),
+                                    return_exceptions=True)
+
+    results = asyncio.run(complete_twice())
+    errors = [r for r in results if isinstance(r, ChunkedUploadError)]
+    assert len(errors) == 1 and errors[0].status_code == 409
+    assert chunked_upload._assembly_locks == {}
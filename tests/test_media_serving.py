@@ -0,0 +1,60 @@
+# tests/test_media_serving.py
+
+import os
+
+import pytest
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.routing import Mount, Route
+from starlette.testclient import TestClient
+
+from media_serving import FrontendIndex, MediaFiles, brotli
+
+
+@pytest.fixture
+def client(tmp_path):
+    os.makedirs(tmp_path / "assets")
+    (tmp_path / "index.html").write_text("<!doctype html><div id=app></div>", encoding="utf-8")
+    (tmp_path / "assets" / "index-AbCd1234.js").write_text("console.log('bundle');\n" * 200, encoding="utf-8")
+    index = FrontendIndex(str(tmp_path))
+
+    async def serve(request: Request):
+        return index.response(request.path_params["full_path"], request)
+
+    return TestClient(Starlette(routes=[Route("/{full_path:path}", serve, methods=["GET", "HEAD"])]))
+
+
+def test_spa_routes_fall_back_to_index(client):
+    for path in ("/", "/history", "/reports/view/3"):
+        response = client.get(path)
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/html")
+
+
+def test_missing_files_are_404_not_index(client):
+    for path in ("/assets/index-Old00000.js", "/assets/logo", "/favicon.ico", "/robots.txt"):
+        response = client.get(path)
+        assert response.status_code == 404, path
+        assert "html" not in response.headers.get("content-type", "")
+
+
+def test_hashed_asset_is_immutable_and_compressed(client):
+    response = client.get("/assets/index-AbCd1234.js", headers={"Accept-Encoding": "gzip, br"})
+    assert response.status_code == 200
+    assert "immutable" in response.headers["cache-control"]
+    assert response.headers["content-encoding"] == ("br" if brotli is not None else "gzip")
+    assert client.get("/assets/index-AbCd1234.js",
+                      headers={"Accept-Encoding": "gzip, br",
+                               "If-None-Match": response.headers["etag"]}).status_code == 304
+
+
+def test_media_files_never_serve_hidden_paths(tmp_path):
+    os.makedirs(tmp_path / ".image_cache")
+    (tmp_path / ".image_cache" / "scan.jpg").write_bytes(b"patient image")
+    (tmp_path / "report_0123456789abcdef.pdf").write_bytes(b"%PDF-1.4")
+    client = TestClient(Starlette(routes=[Mount("/reports", MediaFiles(directory=str(tmp_path)))]))
+
+    assert client.get("/reports/.image_cache/scan.jpg").status_code == 404
+    response = client.get("/reports/report_0123456789abcdef.pdf")
+    assert response.status_code == 200
+    assert "immutable" in response.headers["cache-control"]
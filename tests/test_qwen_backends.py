@@ -0,0 +1,123 @@
+# tests/test_qwen_backends.py
+
+import asyncio
+from contextlib import asynccontextmanager
+
+import qwen_backends
+from qwen_backends import BackendPool, CIRCUIT_FAILURE_THRESHOLD
+
+
+class _Response:
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+
+    async def aread(self) -> bytes:
+        return b"bad request"
+
+    async def aiter_lines(self):
+        return
+        yield
+
+
+class _Client:
+    """Stands in for httpx.AsyncClient: either hangs before answering or answers with a fixed status."""
+
+    def __init__(self, status_code=None):
+        self.status_code = status_code
+        self.started = asyncio.Event()
+
+    @asynccontextmanager
+    async def stream(self, method, url, **kwargs):
+        self.started.set()
+        if self.status_code is None:
+            await asyncio.Event().wait()
+        yield _Response(self.status_code)
+
+
+def _tripped_pool() -> BackendPool:
+    pool = BackendPool(["http://backend-a/chat"])
+    backend = pool.backends[0]
+    # 熔断期已过，等待试探请求
+    backend.consecutive_failures = CIRCUIT_FAILURE_THRESHOLD
+    backend.open_until = 0.0
+    return pool
+
+
+def test_cancelled_probe_releases_half_open_slot():
+    async def run():
+        pool = _tripped_pool()
+        backend = pool.pick()
+        assert backend.half_open_probe
+        client = _Client()
+        task = asyncio.create_task(pool._attempt(client, backend, {}, lambda line: line, asyncio.Queue(), 0))
+        await client.started.wait()
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return backend
+
+    backend = asyncio.run(run())
+    assert not backend.half_open_probe
+    assert backend.outstanding == 0
+    assert backend.available(qwen_backends.time.monotonic())
+
+
+def test_client_error_probe_releases_half_open_slot():
+    async def run():
+        pool = _tripped_pool()
+        backend = pool.pick()
+        queue = asyncio.Queue()
+        await pool._attempt(_Client(status_code=400), backend, {}, lambda line: line, queue, 0)
+        return backend, await queue.get()
+
+    backend, (_, kind, error) = asyncio.run(run())
+    assert kind == "error" and not error.retryable
+    assert not backend.half_open_probe
+    assert backend.available(qwen_backends.time.monotonic())
+
+
+class _RejectingClient:
+    """Answers 400 to bodies that reference an image id and streams one line otherwise."""
+
+    def __init__(self):
+        self.bodies = []
+
+    @asynccontextmanager
+    async def stream(self, method, url, json=None, **kwargs):
+        self.bodies.append(json)
+        if any(m.get("image_id") for m in json["messages"]):
+            yield _Response(400)
+        else:
+            response = _Response(200)
+            response.aiter_lines = lambda: _lines("hello")
+            yield response
+
+
+async def _lines(*lines):
+    for line in lines:
+        yield line
+
+
+def test_rejected_image_id_is_resent_inline_to_the_same_backend():
+    calls = []
+
+    async def build(backend_url, inline_images):
+        calls.append((backend_url, inline_images))
+        image = {"image_base64": "aGk="} if inline_images else {"image_base64": None, "image_id": "stale"}
+        return {"messages": [{"role": "user", "content": "hi", **image}]}
+
+    async def run():
+        pool = BackendPool(["http://backend-a/chat"])
+        queue = asyncio.Queue()
+        client = _RejectingClient()
+        await pool._attempt(client, pool.backends[0], build, lambda line: line, queue, 0)
+        return pool.backends[0], client, [await queue.get(), await queue.get()]
+
+    backend, client, events = asyncio.run(run())
+    assert calls == [("http://backend-a/chat", False), ("http://backend-a/chat", True)]
+    assert len(client.bodies) == 2
+    assert [kind for _, kind, _ in events] == ["chunk", "done"]
+    assert backend.consecutive_failures == 0
+    assert backend.outstanding == 0
@@ -0,0 +1,80 @@
+# tests/test_qwen_payload.py
+
+import asyncio
+
+import cv2
+import numpy as np
+import pytest
+
+import qwen_payload
+
+
+class _Response:
+    def __init__(self, image_id: str):
+        self.image_id = image_id
+
+    def raise_for_status(self) -> None:
+        pass
+
+    def json(self) -> dict:
+        return {"image_id": self.image_id}
+
+
+class _UploadClient:
+    """Stands in for httpx.AsyncClient.post on the image upload endpoint."""
+
+    def __init__(self):
+        self.uploads = []
+
+    async def post(self, url, json=None):
+        self.uploads.append(url)
+        return _Response(f"id-{len(self.uploads)}")
+
+
+@pytest.fixture
+def image(tmp_path, monkeypatch):
+    monkeypatch.setattr(qwen_payload, "QWEN_IMAGE_UPLOAD_URL", "/upload_image")
+    monkeypatch.setattr(qwen_payload, "_image_ids", qwen_payload.OrderedDict())
+    monkeypatch.setattr(qwen_payload, "_upload_disabled_until", {})
+    path = tmp_path / "frame.jpg"
+    cv2.imwrite(str(path), np.zeros((8, 8, 3), dtype=np.uint8))
+    return str(path)
+
+
+def _payload(image, client, backend_url, inline=False) -> dict:
+    return asyncio.run(qwen_payload.get_image_payload(image, client, backend_url, inline))
+
+
+def test_image_ids_are_kept_per_backend(image):
+    client = _UploadClient()
+    a = _payload(image, client, "http://backend-a:8000/chat")
+    b = _payload(image, client, "http://backend-b:8000/chat")
+    again = _payload(image, client, "http://backend-a:8000/chat")
+
+    assert client.uploads == ["http://backend-a:8000/upload_image", "http://backend-b:8000/upload_image"]
+    assert a["image_id"] == again["image_id"] == "id-1"
+    assert b["image_id"] == "id-2"
+
+
+def test_absolute_upload_url_only_serves_its_own_backend(image, monkeypatch):
+    monkeypatch.setattr(qwen_payload, "QWEN_IMAGE_UPLOAD_URL", "http://backend-a:8000/upload_image")
+    client = _UploadClient()
+
+    assert _payload(image, client, "http://backend-a:8000/chat")["image_id"] == "id-1"
+    other = _payload(image, client, "http://backend-b:8000/chat")
+    assert "image_id" not in other and other["image_base64"]
+    assert len(client.uploads) == 1
+
+
+def test_expired_or_forgotten_image_id_is_uploaded_again(image, monkeypatch):
+    client = _UploadClient()
+    backend = "http://backend-a:8000/chat"
+    monkeypatch.setattr(qwen_payload, "IMAGE_ID_TTL_SECONDS", -1)
+    _payload(image, client, backend)
+    assert _payload(image, client, backend)["image_id"] == "id-2"
+
+    qwen_payload.forget_image_id(image, backend)
+    inline = _payload(image, client, backend, inline=True)
+    assert "image_id" not in inline and inline["image_base64"]
+    assert len(client.uploads) == 2
+    assert not qwen_payload._image_ids
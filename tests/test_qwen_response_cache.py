@@ -0,0 +1,84 @@
+# tests/test_qwen_response_cache.py
+
+import asyncio
+
+import pytest
+
+import qwen_response_cache
+from qwen_response_cache import cached_stream
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    monkeypatch.setattr(qwen_response_cache, "RESPONSE_CACHE_ENABLED", True)
+    monkeypatch.setattr(qwen_response_cache, "_cache", qwen_response_cache.OrderedDict())
+    monkeypatch.setattr(qwen_response_cache, "_cache_bytes", 0)
+    monkeypatch.setattr(qwen_response_cache, "_inflight", {})
+
+
+async def _collect(stream) -> list:
+    return [chunk async for chunk in stream]
+
+
+def test_identical_requests_share_one_upstream_generation():
+    calls = []
+
+    async def run():
+        release = asyncio.Event()
+
+        async def producer():
+            calls.append(1)
+            yield "a"
+            await release.wait()
+            yield "b"
+
+        first = asyncio.create_task(_collect(cached_stream("k", producer)))
+        second = asyncio.create_task(_collect(cached_stream("k", producer)))
+        await asyncio.sleep(0.01)
+        release.set()
+        return await first, await second, await _collect(cached_stream("k", producer))
+
+    first, second, replay = asyncio.run(run())
+    assert first == second == replay == ["a", "b"]
+    assert len(calls) == 1
+
+
+def test_upstream_is_cancelled_when_the_last_client_leaves():
+    cancelled = []
+
+    async def run():
+        async def producer():
+            yield "partial"
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                cancelled.append(1)
+                raise
+
+        stream = cached_stream("k", producer)
+        assert await stream.__anext__() == "partial"
+        await stream.aclose()
+        await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert cancelled == [1]
+    assert not qwen_response_cache._inflight
+    assert qwen_response_cache._cache_get("k") is None
+
+
+def test_entries_expire_and_least_recently_used_is_evicted(monkeypatch):
+    monkeypatch.setattr(qwen_response_cache, "RESPONSE_CACHE_MAX_ENTRIES", 2)
+    put, get = qwen_response_cache._cache_put, qwen_response_cache._cache_get
+
+    put("a", ["1"])
+    put("b", ["2"])
+    assert get("a") == ("1",)
+    put("c", ["3"])
+    assert get("b") is None
+    assert get("a") == ("1",) and get("c") == ("3",)
+
+    monkeypatch.setattr(qwen_response_cache, "RESPONSE_CACHE_TTL_SECONDS", -1)
+    put("d", ["4"])
+    assert get("d") is None
+    assert list(qwen_response_cache._cache) == ["c"]
+    assert qwen_response_cache._cache_bytes == 1
@@ -0,0 +1,45 @@
+# tests/test_report_generator.py
+
+import os
+
+import pytest
+
+import report_generator
+
+# 仓库里的中文字体不一定随代码分发，没有时用系统自带的 DejaVu 验证同一条共享字体路径
+_FONT_CANDIDATES = (report_generator.CHINESE_FONT_PATH, "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf")
+TEST_FONT = next((p for p in _FONT_CANDIDATES if os.path.exists(p)), None)
+
+
+@pytest.fixture
+def shared_font(monkeypatch, tmp_path):
+    if TEST_FONT is None:
+        pytest.skip("no TrueType font available")
+    monkeypatch.chdir(tmp_path)
+    # monkeypatch 记录原值，测试结束后恢复模块状态
+    for name in ("_font_bytes", "_font_template", "FONT_LOADED"):
+        monkeypatch.setattr(report_generator, name, getattr(report_generator, name))
+    monkeypatch.setattr(report_generator, "CHINESE_FONT_PATH", TEST_FONT)
+    report_generator._load_shared_font()
+    assert report_generator.FONT_LOADED
+
+    # 逐份解析的回退路径会调用 add_font；记录下来，确保走的是共享字体
+    reparsed = []
+    monkeypatch.setattr(report_generator.PDFReport, "add_font", lambda self, *a, **k: reparsed.append(a))
+    return reparsed
+
+
+def test_two_reports_share_the_parsed_font(shared_font):
+    history = [("Is the region significant?", "**Likely benign.** Follow up in 6 months.")]
+    template_glyphs = len(list(report_generator._font_template.subset.items()))
+    first = report_generator.render_medical_report(history, None)
+    second = report_generator.render_medical_report(history + [("Any other finding?", "No.")], None)
+
+    assert report_generator.FONT_LOADED
+    assert shared_font == []
+    for pdf_bytes in (first, second):
+        assert pdf_bytes.startswith(b"%PDF-")
+        # 字体以子集形式嵌入
+        assert b"/FontFile2" in pdf_bytes
+    # 子集是每份报告各自的，用到的字形不会写回共享模板
+    assert len(list(report_generator._font_template.subset.items())) == template_glyphs
@@ -0,0 +1,111 @@
+# tests/test_storage_lifecycle.py
+
+import os
+import time
+
+import pytest
+
+import storage_lifecycle as sl
+
+SHA_A = "a" * 64
+SHA_B = "b" * 64
+
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    """A fresh, isolated lifecycle state with one managed directory "temp"."""
+    for name in ("_policies", "_last_access", "_pins", "_leases", "_last_sweep"):
+        monkeypatch.setattr(sl, name, {})
+    monkeypatch.setattr(sl, "MIN_AGE_SECONDS", 0)
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("temp")
+    sl.register_directory("temp", "temp", 0, 1)
+    return tmp_path
+
+
+def make_file(path: str, age: float = 0, size: int = 100) -> str:
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    stamp = time.time() - age
+    os.utime(path, (stamp, stamp))
+    return path
+
+
+def test_reference_rejects_unknown_paths(store):
+    outside = make_file("outside.jpg")
+    assert not sl.reference(os.path.join("temp", SHA_A + ".jpg"))   # 不存在
+    assert not sl.reference(outside)                                 # 不在托管目录里
+    assert not sl.reference("temp/../outside.jpg")
+    assert sl._leases == {} and sl._last_access == {}
+
+    inside = make_file(os.path.join("temp", SHA_A + ".jpg"))
+    assert sl.reference(inside)
+    assert SHA_A in sl._leases
+
+
+def test_prune_drops_orphan_records_and_expired_leases(store):
+    kept = make_file(os.path.join("temp", SHA_A + ".jpg"))
+    sl.touch(kept)
+    sl._last_access["deleted-elsewhere"] = time.time()
+    sl._leases[SHA_B] = time.time() - 1
+    sl._last_access[SHA_B] = time.time()
+
+    sl.sweep_all()
+    assert set(sl._last_access) == {SHA_A}
+    assert sl._leases == {}
+
+
+def test_sweep_keeps_pinned_and_leased_groups(store):
+    # 同一分组的多个产物：上传原件 + HLS 目录
+    pinned = make_file(os.path.join("temp", SHA_A + ".mp4"), age=7200)
+    os.makedirs(os.path.join("temp", SHA_A + "_hls"))
+    make_file(os.path.join("temp", SHA_A + "_hls", "seg0.ts"), age=7200)
+    leased = make_file(os.path.join("temp", "qwen_input_" + SHA_B + ".jpg"), age=7200)
+    orphan = make_file(os.path.join("temp", "c" * 64 + ".jpg"), age=7200)
+    assert sl.reference(leased)
+    sl._last_access[SHA_B] = time.time() - 7200
+
+    with sl.in_use(pinned):
+        result = sl.sweep("temp")
+
+    assert result["removed"] == 1
+    assert not os.path.exists(orphan)
+    assert os.path.exists(pinned) and os.path.isdir(os.path.join("temp", SHA_A + "_hls"))
+    assert os.path.exists(leased)
+
+
+def test_sweep_evicts_least_recently_used_groups_over_quota(store):
+    sl._policies["temp"] = sl._policies["temp"]._replace(ttl_seconds=0, max_bytes=250)
+    oldest = make_file(os.path.join("temp", "1" * 64 + ".jpg"), age=300)
+    touched = make_file(os.path.join("temp", "2" * 64 + ".jpg"), age=200)
+    newest = make_file(os.path.join("temp", "3" * 64 + ".jpg"), age=100)
+    sl.touch(touched)
+
+    sl.sweep("temp")
+    assert not os.path.exists(oldest)
+    assert os.path.exists(touched) and os.path.exists(newest)
+
+
+def test_min_age_protects_fresh_groups(store, monkeypatch):
+    monkeypatch.setattr(sl, "MIN_AGE_SECONDS", 600)
+    sl._policies["temp"] = sl._policies["temp"]._replace(ttl_seconds=0, max_bytes=1)
+    fresh = make_file(os.path.join("temp", SHA_A + ".jpg"), age=10)
+    assert sl.sweep("temp")["removed"] == 0
+    assert os.path.exists(fresh)
+
+
+def test_hidden_entries_count_towards_quota_and_partials_expire(store):
+    sl._policies["temp"] = sl._policies["temp"]._replace(ttl_seconds=0, max_bytes=1000)
+    os.makedirs(os.path.join("temp", ".chunked", "session"))
+    make_file(os.path.join("temp", ".chunked", "session", "000000.part"), size=900)
+    abandoned = make_file(os.path.join("temp", ".partial-dead.mp4"), age=sl.PARTIAL_MAX_AGE_SECONDS + 60)
+    writing = make_file(os.path.join("temp", ".partial-live.mp4"), age=5)
+    group = make_file(os.path.join("temp", SHA_A + ".jpg"), age=7200, size=200)
+
+    result = sl.sweep("temp")
+    assert not os.path.exists(abandoned)
+    assert os.path.exists(writing)
+    # 分片会话由 chunked_upload 自己清理，但它占的空间让普通分组被挤出配额
+    assert os.path.isdir(os.path.join("temp", ".chunked"))
+    assert not os.path.exists(group)
+    assert result["used_bytes"] == 1000
@@ -0,0 +1,488 @@
+# tools/benchmark.py
+#
+# 可复现的离线基准测试（CPU）：图片检测、视频检测、对话流式、报告渲染四条链路。
+# 输入全部现场合成（固定随机种子），YOLO 用不需要下载的小模型（默认由 yolo11n.yaml 随机初始化），
+# 对话走进程内启动的 tools/mock_qwen_server.py，不访问任何外部服务。
+# 每条链路在独立子进程里跑，分别统计延迟分位数、吞吐和峰值 RSS，结果写成 JSON，
+# 可与基线结果对比，超出阈值的指标标记为回归（退出码 1，便于接入 CI）。
+#
+# 用法:
+#   python tools/benchmark.py --output bench/baseline.json
+#   python tools/benchmark.py --output bench/new.json --baseline bench/baseline.json --threshold 0.15
+#   python tools/benchmark.py --pipelines image,report --quick
+#   python tools/benchmark.py --compare bench/new.json --baseline bench/baseline.json
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PIPELINES = ("image", "video", "chat", "report")
+SEED = 1234
+
+# 各链路的测试用例：(名称, 参数)
+IMAGE_CASES = [("640x480", (640, 480)), ("1280x720", (1280, 720)), ("1920x1080", (1920, 1080))]
+VIDEO_CASES = [("480p_5s", (854, 480, 5)), ("720p_5s", (1280, 720, 5)), ("480p_20s", (854, 480, 20))]
+CHAT_CASES = [("text_c1", (False, 1)), ("image_c1", (True, 1)), ("image_c8", (True, 8))]
+REPORT_CASES = [("2_turns", (2, False)), ("20_turns", (20, False)), ("2_turns_image", (2, True))]
+
+# 对比时各指标的方向：True = 越大越好
+METRIC_DIRECTIONS = {
+    "p50_ms": False, "p90_ms": False, "p99_ms": False,
+    "throughput_per_s": True, "frames_per_s": True, "ttft_p50_ms": False, "ttft_p99_ms": False,
+    "peak_rss_mb": False,
+}
+
+# ----------------------------------------------------
+# 1. Synthetic Inputs
+# ----------------------------------------------------
+
+def synthetic_image(width: int, height: int, rng: np.random.RandomState) -> np.ndarray:
+    """Gradient background with a few blob-like 'findings'; deterministic for a given rng state."""
+    import cv2
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    base = (60 + 120 * (0.6 * x + 0.4 * y)).astype(np.uint8)
+    image = cv2.merge([base, (base * 0.8).astype(np.uint8), (base * 0.9).astype(np.uint8)])
+    for _ in range(6):
+        center = (int(rng.randint(0, width)), int(rng.randint(0, height)))
+        axes = (int(rng.randint(width // 40, width // 8)), int(rng.randint(height // 40, height // 8)))
+        color = tuple(int(c) for c in rng.randint(0, 255, 3))
+        cv2.ellipse(image, center, axes, float(rng.randint(0, 180)), 0, 360, color, -1)
+    noise = rng.randint(0, 12, image.shape, dtype=np.uint8)
+    return cv2.add(image, noise)
+
+
+def synthetic_video(path: str, width: int, height: int, seconds: float, fps: int = 30) -> int:
+    """Writes a video with moving blobs; returns the number of frames."""
+    import cv2
+    rng = np.random.RandomState(SEED)
+    background = synthetic_image(width, height, rng)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    n_frames = int(seconds * fps)
+    radius = max(height // 12, 4)
+    for i in range(n_frames):
+        frame = background.copy()
+        t = i / max(n_frames - 1, 1)
+        cv2.circle(frame, (int(width * (0.1 + 0.8 * t)), height // 2), radius, (40, 40, 200), -1)
+        cv2.circle(frame, (width // 3, int(height * (0.9 - 0.8 * t))), radius // 2, (200, 60, 40), -1)
+        writer.write(frame)
+    writer.release()
+    return n_frames
+
+# ----------------------------------------------------
+# 2. Helpers
+# ----------------------------------------------------
+
+def latency_stats(seconds: list) -> dict:
+    ms = np.asarray(seconds, dtype=np.float64) * 1000
+    if ms.size == 0:
+        return {"n": 0}
+    return {
+        "n": int(ms.size),
+        "mean_ms": round(float(ms.mean()), 2),
+        "p50_ms": round(float(np.percentile(ms, 50)), 2),
+        "p90_ms": round(float(np.percentile(ms, 90)), 2),
+        "p99_ms": round(float(np.percentile(ms, 99)), 2),
+        "max_ms": round(float(ms.max()), 2),
+    }
+
+
+def peak_rss_mb() -> float:
+    # Linux 上 ru_maxrss 单位是 KB，macOS 上是字节
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def load_tiny_model(model_spec: str) -> None:
+    """Loads the benchmark model into yolo_state so the pipelines treat it as already loaded."""
+    import yolo_state
+    from ultralytics import YOLO
+    model = YOLO(model_spec)
+    yolo_state.current_model = model
+    yolo_state.current_model_path = model_spec
+
+
+class _ModelFile:
+    """Same stand-in for an uploaded model file as server.py passes to the processors."""
+
+    def __init__(self, path):
+        self.name = path
+
+# ----------------------------------------------------
+# 3. Pipelines (run inside the worker process)
+# ----------------------------------------------------
+
+def bench_image(args, workdir: str) -> dict:
+    import cv2
+    import yolo_state
+    from yolo_image_processor import process_model_and_image
+    load_tiny_model(args.model)
+    model_file = _ModelFile(yolo_state.current_model_path)
+    rng = np.random.RandomState(SEED)
+    cases = {}
+    for name, (width, height) in IMAGE_CASES:
+        paths = []
+        for i in range(max(args.iterations, 1)):
+            path = os.path.join(workdir, f"img_{name}_{i}.jpg")
+            cv2.imwrite(path, synthetic_image(width, height, rng), [cv2.IMWRITE_JPEG_QUALITY, 92])
+            paths.append(path)
+        for path in paths[:args.warmup]:
+            process_model_and_image(model_file, [path])
+        samples = []
+        started = time.perf_counter()
+        for path in paths:
+            t0 = time.perf_counter()
+            _, text, _, _, outputs = process_model_and_image(model_file, [path])
+            samples.append(time.perf_counter() - t0)
+            if not outputs:
+                raise RuntimeError(f"Image inference failed: {text}")
+        wall = time.perf_counter() - started
+        cases[name] = dict(latency_stats(samples), throughput_per_s=round(len(samples) / wall, 2))
+    return cases
+
+
+def bench_video(args, workdir: str) -> dict:
+    import yolo_state
+    from yolo_video_processor import process_video_entry
+    load_tiny_model(args.model)
+    cases = {}
+    repeats = max(1, args.iterations // 10)
+    for name, (width, height, seconds) in VIDEO_CASES:
+        if args.quick:
+            seconds = min(seconds, 2)
+        path = os.path.join(workdir, f"video_{name}.mp4")
+        n_frames = synthetic_video(path, width, height, seconds)
+        samples, processed = [], 0
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            frames, result = 0, None
+            for chunk in process_video_entry(_ModelFile(yolo_state.current_model_path), path):
+                data = json.loads(chunk)
+                if data["type"] == "progress":
+                    frames += 1
+                elif data["type"] == "result":
+                    result = data["data"]
+                elif data["type"] == "error":
+                    raise RuntimeError(f"Video processing failed: {data['message']}")
+            samples.append(time.perf_counter() - t0)
+            processed = frames
+            if result is None:
+                raise RuntimeError("Video processing produced no result")
+        cases[name] = dict(latency_stats(samples), input_frames=n_frames, processed_frames=processed,
+                           frames_per_s=round(processed * len(samples) / sum(samples), 2))
+    return cases
+
+
+def _start_mock_qwen(port: int):
+    """Runs tools/mock_qwen_server.py in a background thread of this process."""
+    import uvicorn
+    sys.path.insert(0, os.path.join(REPO_DIR, "tools"))
+    from mock_qwen_server import build_app
+    mock_args = argparse.Namespace(ttft=0.02, ttft_jitter=0.0, image_delay=0.01, tokens_per_sec=0.0, tokens=80,
+                                   field="response", format="sse", error_rate=0.0, error_status=503, abort_rate=0.0)
+    server = uvicorn.Server(uvicorn.Config(build_app(mock_args), host="127.0.0.1", port=port, log_level="error"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.time() + 10
+    while not server.started:
+        if time.time() > deadline:
+            raise RuntimeError("Mock Qwen server did not start")
+        time.sleep(0.05)
+    return server
+
+
+def bench_chat(args, workdir: str) -> dict:
+    import asyncio
+    import cv2
+    import random
+    random.seed(SEED)
+    server = _start_mock_qwen(args.mock_port)
+    from qwen_chat import astream_qwen_response, close_async_client
+    import metrics
+
+    image_path = os.path.join(workdir, "chat_context.jpg")
+    cv2.imwrite(image_path, synthetic_image(1280, 720, np.random.RandomState(SEED)))
+    history = [(f"Earlier question {i}?", f"Earlier answer {i}. " * 8) for i in range(4)]
+    counter = iter(range(10 ** 9))
+
+    async def one_chat(with_image: bool) -> tuple:
+        # 每个问题都不同，避免命中响应缓存
+        message = f"What does the detection show? (#{next(counter)})"
+        t0 = time.perf_counter()
+        ttft, text = None, []
+        async for chunk in astream_qwen_response(message, history, image_path if with_image else None):
+            if ttft is None:
+                ttft = time.perf_counter() - t0
+            text.append(chunk)
+        answer = "".join(text)
+        if not answer.strip() or answer.startswith("❌") or "[Connection Error" in answer:
+            raise RuntimeError(f"Chat failed: {answer[:200]}")
+        return ttft, time.perf_counter() - t0
+
+    async def run_case(with_image: bool, concurrency: int) -> dict:
+        for _ in range(args.warmup):
+            await one_chat(with_image)
+        total = max(args.iterations, concurrency)
+        remaining = iter(range(total))
+        ttfts, totals = [], []
+
+        async def worker():
+            for _ in remaining:
+                ttft, elapsed = await one_chat(with_image)
+                ttfts.append(ttft)
+                totals.append(elapsed)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall = time.perf_counter() - started
+        ttft_stats = latency_stats(ttfts)
+        return dict(latency_stats(totals), ttft_p50_ms=ttft_stats["p50_ms"], ttft_p99_ms=ttft_stats["p99_ms"],
+                    throughput_per_s=round(len(totals) / wall, 2), concurrency=concurrency)
+
+    async def run_all() -> dict:
+        try:
+            return {name: await run_case(with_image, concurrency) for name, (with_image, concurrency) in CHAT_CASES}
+        finally:
+            await close_async_client()
+
+    try:
+        cases = asyncio.run(run_all())
+    finally:
+        server.should_exit = True
+    # 服务端视角：请求组装（图片编码）耗时，和上面客户端视角对照
+    payload = metrics.snapshot("chat_payload_build").get("chat_payload_build_seconds", {})
+    cases["_server"] = {"payload_build_p50_ms": round(payload.get("p50", 0) * 1000, 2),
+                        "payload_build_p99_ms": round(payload.get("p99", 0) * 1000, 2)}
+    return cases
+
+
+def bench_report(args, workdir: str) -> dict:
+    import cv2
+    import report_generator
+    if not report_generator.FONT_LOADED:
+        # 报告标题是中文，没有字体时渲染直接失败；测出来的数字也不代表线上
+        raise RuntimeError(f"Report font not found: {report_generator.CHINESE_FONT_PATH}")
+    image_path = os.path.join(workdir, "report_context.jpg")
+    cv2.imwrite(image_path, synthetic_image(1920, 1080, np.random.RandomState(SEED)))
+    cases = {}
+    for name, (turns, with_image) in REPORT_CASES:
+        history = [(f"问题 {i}：区域 {i} 的病灶是否需要关注？",
+                    f"**回答 {i}。** 标注区域边界清晰，建议结合临床进一步检查。 " * 4) for i in range(turns)]
+        context = image_path if with_image else None
+        for _ in range(args.warmup):
+            report_generator.render_medical_report(history, context)
+        samples, size = [], 0
+        started = time.perf_counter()
+        for _ in range(max(args.iterations, 1)):
+            # 直接渲染，绕过内容去重缓存
+            t0 = time.perf_counter()
+            size = len(report_generator.render_medical_report(history, context))
+            samples.append(time.perf_counter() - t0)
+        wall = time.perf_counter() - started
+        cases[name] = dict(latency_stats(samples), throughput_per_s=round(len(samples) / wall, 2), pdf_bytes=size)
+    return cases
+
+
+BENCHMARKS = {"image": bench_image, "video": bench_video, "chat": bench_chat, "report": bench_report}
+
+
+def run_worker(args) -> None:
+    """Entry point of the per-pipeline subprocess: writes {"cases", "peak_rss_mb"} to args.worker_output."""
+    workdir = tempfile.mkdtemp(prefix=f"bench_{args.worker}_")
+    # 所有输出（TEMP_DIR、reports、uploads）都落在临时目录里，不污染仓库
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    if args.threads:
+        import torch
+        torch.set_num_threads(args.threads)
+    try:
+        started = time.perf_counter()
+        cases = BENCHMARKS[args.worker](args, workdir)
+        result = {"cases": cases, "wall_seconds": round(time.perf_counter() - started, 2),
+                  "peak_rss_mb": peak_rss_mb()}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    with open(args.worker_output, "w", encoding="utf-8") as f:
+        json.dump(result, f)
+
+# ----------------------------------------------------
+# 4. Orchestration & Baseline Comparison
+# ----------------------------------------------------
+
+def environment() -> dict:
+    info = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+    try:
+        info["git_commit"] = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                                            capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        info["git_commit"] = None
+    for module in ("cv2", "numpy", "torch", "ultralytics", "fpdf"):
+        try:
+            info[module] = __import__(module).__version__
+        except Exception:
+            info[module] = None
+    return info
+
+
+def run_pipeline(name: str, args) -> dict:
+    output = tempfile.NamedTemporaryFile(prefix=f"bench_{name}_", suffix=".json", delete=False).name
+    cmd = [sys.executable, os.path.abspath(__file__), "--worker", name, "--worker-output", output,
+           "--model", args.model, "--iterations", str(args.iterations), "--warmup", str(args.warmup),
+           "--mock-port", str(args.mock_port), "--threads", str(args.threads)]
+    if args.quick:
+        cmd.append("--quick")
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES="", PYTHONHASHSEED=str(SEED),
+               # 后台任务和网络探测会干扰计时
+               STORAGE_SWEEP_INTERVAL_SECONDS="0", QWEN_HEALTH_PATH="",
+               QWEN_API_URLS=f"http://127.0.0.1:{args.mock_port}/chat")
+    print(f"[{name}] running...", flush=True)
+    proc = subprocess.run(cmd, env=env, capture_output=not args.verbose, text=True)
+    try:
+        if proc.returncode != 0:
+            tail = (proc.stderr or "")[-2000:] if not args.verbose else ""
+            return {"error": f"worker exited with {proc.returncode}", "stderr_tail": tail}
+        with open(output, "r", encoding="utf-8") as f:
+            return json.load(f)
+    finally:
+        if os.path.exists(output):
+            os.remove(output)
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    """Per-metric relative change against the baseline; entries past the threshold are regressions."""
+    rows = []
+    for pipeline, result in current.get("results", {}).items():
+        base = baseline.get("results", {}).get(pipeline)
+        if not base or "error" in result or "error" in base:
+            continue
+        pairs = [("peak_rss_mb", result.get("peak_rss_mb"), base.get("peak_rss_mb"), "")]
+        for case, metrics in result.get("cases", {}).items():
+            for metric, value in metrics.items():
+                if metric in METRIC_DIRECTIONS:
+                    pairs.append((metric, value, base.get("cases", {}).get(case, {}).get(metric), case))
+        for metric, value, old, case in pairs:
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or old == 0:
+                continue
+            change = (value - old) / old
+            worse = -change if METRIC_DIRECTIONS[metric] else change
+            rows.append({"pipeline": pipeline, "case": case, "metric": metric, "baseline": old, "current": value,
+                         "change_pct": round(change * 100, 1), "regression": worse > threshold})
+    return rows
+
+
+def print_summary(results: dict) -> None:
+    for pipeline, result in results.items():
+        if "error" in result:
+            print(f"\n[{pipeline}] FAILED: {result['error']}\n{result.get('stderr_tail', '')}")
+            continue
+        print(f"\n[{pipeline}] peak RSS {result['peak_rss_mb']} MB, wall {result['wall_seconds']}s")
+        for case, m in result["cases"].items():
+            if case.startswith("_"):
+                print(f"  {case}: {m}")
+                continue
+            extra = ""
+            if "frames_per_s" in m:
+                extra = f" | {m['frames_per_s']} frames/s"
+            elif "ttft_p50_ms" in m:
+                extra = f" | TTFT p50={m['ttft_p50_ms']}ms p99={m['ttft_p99_ms']}ms | {m['throughput_per_s']} req/s"
+            elif "throughput_per_s" in m:
+                extra = f" | {m['throughput_per_s']}/s"
+            print(f"  {case:>14}: p50={m.get('p50_ms')}ms p90={m.get('p90_ms')}ms p99={m.get('p99_ms')}ms "
+                  f"(n={m.get('n')}){extra}")
+
+
+def print_comparison(rows: list, threshold: float) -> bool:
+    regressions = [r for r in rows if r["regression"]]
+    print(f"\n--- Comparison with baseline (threshold {threshold * 100:.0f}%) ---")
+    for r in rows:
+        flag = "REGRESSION" if r["regression"] else ""
+        label = f"{r['pipeline']}/{r['case']}" if r["case"] else r["pipeline"]
+        print(f"  {label:<24} {r['metric']:<18} {r['baseline']:>10} -> {r['current']:<10} "
+              f"({r['change_pct']:+.1f}%) {flag}")
+    print(f"{len(regressions)} regression(s) out of {len(rows)} compared metrics")
+    return bool(regressions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline CPU benchmarks for the image, video, chat and report paths.")
+    parser.add_argument("--pipelines", default=",".join(PIPELINES), help=f"Comma-separated subset of {PIPELINES}")
+    parser.add_argument("--model", default="yolo11n.yaml",
+                        help="YOLO weights or config; a .yaml builds a randomly initialised model without downloading")
+    parser.add_argument("--iterations", type=int, default=20, help="Measured runs per case (video uses iterations/10)")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=0, help="torch.set_num_threads in the workers (0 = default)")
+    parser.add_argument("--quick", action="store_true", help="Shorter videos, fewer iterations (smoke run)")
+    parser.add_argument("--mock-port", type=int, default=18765, help="Port for the in-process mock Qwen server")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--baseline", help="Compare against this earlier results file")
+    parser.add_argument("--compare", help="Only compare this results file with --baseline; run nothing")
+    parser.add_argument("--threshold", type=float, default=0.15, help="Relative change counted as a regression")
+    parser.add_argument("--verbose", action="store_true", help="Show worker output")
+    parser.add_argument("--worker", choices=PIPELINES, help=argparse.SUPPRESS)
+    parser.add_argument("--worker-output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    if args.compare:
+        if not args.baseline:
+            parser.error("--compare needs --baseline")
+        with open(args.compare, "r", encoding="utf-8") as f:
+            current = json.load(f)
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        sys.exit(1 if print_comparison(compare(current, baseline, args.threshold), args.threshold) else 0)
+
+    if args.quick:
+        args.iterations = min(args.iterations, 5)
+        args.warmup = min(args.warmup, 1)
+
+    pipelines = [p.strip() for p in args.pipelines.split(",") if p.strip()]
+    unknown = [p for p in pipelines if p not in PIPELINES]
+    if unknown:
+        parser.error(f"Unknown pipelines: {unknown}")
+
+    results = {name: run_pipeline(name, args) for name in pipelines}
+    document = {
+        "meta": dict(environment(), model=args.model, iterations=args.iterations, warmup=args.warmup,
+                     threads=args.threads, quick=args.quick),
+        "results": results,
+    }
+    print_summary(results)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(document, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    failed = any("error" in r for r in results.values())
+    regressed = False
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressed = print_comparison(compare(document, baseline, args.threshold), args.threshold)
+    sys.exit(1 if failed or regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+# tools/chat_load_test.py
+#
+# 对话接口压测：N 个并发会话循环调用 /api/chat_stream（可带图片上下文），
+# 统计客户端看到的 TTFT / 总耗时分位数、吞吐和错误数。
+# 建议配合 tools/mock_qwen_server.py 使用，避免占用真实 GPU 后端。
+#
+# 用法:
+#   python tools/mock_qwen_server.py --port 8000 &
+#   QWEN_API_URLS=http://127.0.0.1:8000/chat python server.py &
+#   python tools/chat_load_test.py --url http://localhost:7860 --concurrency 32 --requests 500 --image demo.jpg
+
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+import numpy as np
+
+# 服务端把上游错误当作普通文本流回来（"❌ API Error" 开头，或中途插入下面的标记）
+ERROR_MARKERS = ("[Connection Error", "[System Error")
+
+QUESTIONS = [
+    "What does the detection show?",
+    "How confident is the model about the main finding?",
+    "Where exactly is the lesion located?",
+    "Is there anything that needs urgent attention?",
+    "Summarize the findings for a radiology report.",
+]
+
+
+async def prepare_context(client: httpx.AsyncClient, url: str, image_path: str) -> str:
+    """Runs one detection so the chats get a real context_path (and detection record)."""
+    with open(image_path, "rb") as f:
+        response = await client.post(f"{url}/api/detect_image", files={"files": (image_path, f, "image/jpeg")})
+    response.raise_for_status()
+    data = response.json()
+    if data.get("context_path") is None:
+        raise SystemExit(f"Detection did not return a context_path: {data}")
+    print(f"Context: {data['context_path']}")
+    return data["context_path"]
+
+
+async def one_chat(client: httpx.AsyncClient, url: str, body: dict) -> dict:
+    start = time.perf_counter()
+    ttft = None
+    chars = 0
+    text = []
+    try:
+        async with client.stream("POST", f"{url}/api/chat_stream", json=body) as response:
+            if response.status_code != 200:
+                return {"ok": False, "error": f"HTTP {response.status_code}", "total": time.perf_counter() - start}
+            async for chunk in response.aiter_text():
+                if not chunk:
+                    continue
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                chars += len(chunk)
+                text.append(chunk)
+    except httpx.HTTPError as e:
+        return {"ok": False, "error": type(e).__name__, "total": time.perf_counter() - start}
+
+    answer = "".join(text).strip()
+    ok = bool(answer) and not answer.startswith("❌") and not any(m in answer for m in ERROR_MARKERS)
+    return {"ok": ok, "error": None if ok else answer[:120], "ttft": ttft,
+            "total": time.perf_counter() - start, "chars": chars}
+
+
+async def run(args) -> None:
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency)
+    timeout = httpx.Timeout(args.timeout)
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        context_path = args.context_path
+        if args.image and not context_path:
+            context_path = await prepare_context(client, args.url, args.image)
+
+        history = [[f"Earlier question {i}?", f"Earlier answer {i}. " * 10] for i in range(args.history_turns)]
+        counter = iter(range(args.requests))
+        results = []
+
+        async def worker(worker_id: int):
+            for i in counter:
+                message = QUESTIONS[i % len(QUESTIONS)]
+                if not args.repeat:
+                    # 默认每个问题都不同，避免被服务端的响应缓存直接命中
+                    message += f" (#{i})"
+                body = {"message": message, "history": history, "context_path": context_path}
+                if args.image_mode:
+                    body["image_mode"] = args.image_mode
+                results.append(await one_chat(client, args.url, body))
+                if args.verbose:
+                    r = results[-1]
+                    print(f"[w{worker_id:02d}] #{i} ok={r['ok']} ttft={r.get('ttft') or 0:.3f}s total={r['total']:.3f}s")
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(w) for w in range(args.concurrency)))
+        wall = time.perf_counter() - started
+
+        server_metrics = None
+        try:
+            server_metrics = (await client.get(f"{args.url}/api/chat_metrics")).json()
+        except Exception:
+            pass
+
+    report(results, wall, args, server_metrics)
+
+
+def _pct(values, q) -> float:
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def report(results: list, wall: float, args, server_metrics) -> None:
+    ok = [r for r in results if r["ok"]]
+    ttfts = [r["ttft"] for r in ok if r.get("ttft") is not None]
+    totals = [r["total"] for r in ok]
+    chars = sum(r.get("chars", 0) for r in ok)
+
+    summary = {
+        "requests": len(results),
+        "ok": len(ok),
+        "errors": len(results) - len(ok),
+        "concurrency": args.concurrency,
+        "wall_seconds": round(wall, 3),
+        "requests_per_second": round(len(ok) / wall, 2) if wall else 0.0,
+        "chars_per_second": round(chars / wall, 1) if wall else 0.0,
+        "ttft_p50_ms": round(_pct(ttfts, 50) * 1000, 1),
+        "ttft_p99_ms": round(_pct(ttfts, 99) * 1000, 1),
+        "total_p50_ms": round(_pct(totals, 50) * 1000, 1),
+        "total_p99_ms": round(_pct(totals, 99) * 1000, 1),
+    }
+
+    print("\n--- Summary ---")
+    print(f"Requests: {summary['requests']} | ok: {summary['ok']} | errors: {summary['errors']} "
+          f"| concurrency: {args.concurrency} | wall: {wall:.2f}s")
+    print(f"Throughput: {summary['requests_per_second']} req/s, {summary['chars_per_second']} chars/s")
+    print(f"TTFT  p50={summary['ttft_p50_ms']}ms p99={summary['ttft_p99_ms']}ms")
+    print(f"Total p50={summary['total_p50_ms']}ms p99={summary['total_p99_ms']}ms")
+
+    errors = {}
+    for r in results:
+        if not r["ok"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    for message, count in sorted(errors.items(), key=lambda item: -item[1])[:5]:
+        print(f"  error x{count}: {message}")
+
+    if server_metrics:
+        # 服务端视角，对照客户端数据判断慢在我们这边还是模型那边
+        for name in ("chat_payload_build_seconds", "chat_upstream_ttfb_seconds",
+                     "chat_ttft_server_seconds", "chat_ttft_client_seconds"):
+            m = server_metrics.get(name)
+            if m and m["count"]:
+                print(f"Server {name}: p50={m['p50'] * 1000:.1f}ms p99={m['p99'] * 1000:.1f}ms (n={m['count']})")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "server_metrics": server_metrics}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent load test for /api/chat_stream.")
+    parser.add_argument("--url", default="http://localhost:7860")
+    parser.add_argument("--concurrency", type=int, default=16, help="Number of concurrent chat sessions")
+    parser.add_argument("--requests", type=int, default=200, help="Total chat requests")
+    parser.add_argument("--image", help="Image to run detection on first; its output becomes the chat context")
+    parser.add_argument("--context-path", help="Use an existing context_path instead of --image")
+    parser.add_argument("--image-mode", choices=("always", "auto", "never"), help="Sent as ChatRequest.image_mode")
+    parser.add_argument("--history-turns", type=int, default=0, help="Synthetic history turns per request")
+    parser.add_argument("--repeat", action="store_true", help="Reuse identical questions (exercises the response cache)")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--json", help="Write the summary to this JSON file")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
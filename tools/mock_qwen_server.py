@@ -0,0 +1,132 @@
+# tools/mock_qwen_server.py
+#
+# 本地 Qwen-VL 替身服务：按 qwen_chat.parse_stream_line 能解析的协议流式返回
+# （`data: {...}` 行，字段可选 response / content / delta / text），
+# 可配置首 token 延迟、token 速率以及错误注入，用于压测 /api/chat_stream 而不占用 GPU 后端。
+#
+# 用法:
+#   python tools/mock_qwen_server.py --port 8000 --ttft 0.8 --tokens-per-sec 40 --error-rate 0.02
+#   QWEN_API_URLS=http://127.0.0.1:8000/chat python server.py
+#
+# 接口:
+#   POST /chat          流式回答
+#   POST /upload_image  {"image_base64": ...} -> {"image_id": ...}（配合 QWEN_IMAGE_UPLOAD_URL）
+#   GET  /health        健康检查
+#   GET  /stats         请求/错误计数
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+FIELDS = ("response", "content", "delta", "text")
+
+CANNED_ANSWER = (
+    "Based on the detection results, the highlighted region shows a well-defined lesion. "
+    "The bounding boxes indicate the location of each finding, and the confidence scores suggest "
+    "the model is fairly certain about the primary detection. Further clinical correlation is recommended, "
+    "including comparison with prior examinations and, where appropriate, a follow-up study. "
+    "This automated analysis is intended to support, not replace, the judgement of a qualified physician."
+)
+
+
+def build_app(args) -> FastAPI:
+    app = FastAPI()
+    stats = {"requests": 0, "active": 0, "errors": 0, "aborted": 0, "with_image": 0, "uploads": 0}
+    words = CANNED_ANSWER.split(" ")
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    @app.post("/upload_image")
+    async def upload_image(request: Request):
+        body = await request.json()
+        stats["uploads"] += 1
+        digest = hashlib.sha256(str(body.get("image_base64", "")).encode("utf-8")).hexdigest()
+        return {"image_id": digest[:32]}
+
+    @app.post("/chat")
+    async def chat(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        messages = body.get("messages", [])
+        last = messages[-1] if messages else {}
+        has_image = bool(last.get("image_base64") or last.get("image_id"))
+        if has_image:
+            stats["with_image"] += 1
+
+        # 错误注入 1：直接返回 5xx（触发故障转移/熔断）
+        if random.random() < args.error_rate:
+            stats["errors"] += 1
+            return JSONResponse({"error": "injected failure"}, status_code=args.error_status)
+
+        n_tokens = max(1, int(random.gauss(args.tokens, args.tokens * 0.1)))
+        abort_at = n_tokens // 2 if random.random() < args.abort_rate else None
+
+        async def generate():
+            stats["active"] += 1
+            try:
+                ttft = max(0.0, args.ttft + random.uniform(-args.ttft_jitter, args.ttft_jitter))
+                # 带图请求额外的“视觉编码”耗时
+                if has_image:
+                    ttft += args.image_delay
+                await asyncio.sleep(ttft)
+                interval = 1.0 / args.tokens_per_sec if args.tokens_per_sec > 0 else 0
+                for i in range(n_tokens):
+                    if abort_at is not None and i == abort_at:
+                        # 错误注入 2：流中途断开
+                        stats["aborted"] += 1
+                        raise ConnectionResetError("injected mid-stream abort")
+                    word = words[i % len(words)]
+                    field = random.choice(FIELDS) if args.field == "mixed" else args.field
+                    line = json.dumps({field: (" " if i else "") + word}, ensure_ascii=False)
+                    yield (f"data: {line}\n\n" if args.format == "sse" else line + "\n")
+                    if interval:
+                        await asyncio.sleep(interval)
+                if args.format == "sse":
+                    yield "data: [DONE]\n\n"
+            finally:
+                stats["active"] -= 1
+
+        media_type = "text/event-stream" if args.format == "sse" else "application/x-ndjson"
+        return StreamingResponse(generate(), media_type=media_type)
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Qwen-VL streaming chat backend.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--ttft", type=float, default=0.5, help="Seconds before the first token")
+    parser.add_argument("--ttft-jitter", type=float, default=0.1, help="Uniform +/- jitter on the TTFT")
+    parser.add_argument("--image-delay", type=float, default=0.2, help="Extra TTFT when the request carries an image")
+    parser.add_argument("--tokens-per-sec", type=float, default=30.0, help="Decode rate; 0 = as fast as possible")
+    parser.add_argument("--tokens", type=int, default=80, help="Mean answer length in tokens (words)")
+    parser.add_argument("--field", default="mixed", choices=FIELDS + ("mixed",),
+                        help="JSON field carrying the text; mixed = random per chunk")
+    parser.add_argument("--format", default="sse", choices=("sse", "ndjson"),
+                        help="sse = `data:` lines, ndjson = bare JSON lines")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with an HTTP error")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--abort-rate", type=float, default=0.0, help="Fraction of streams cut off halfway")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    uvicorn.run(build_app(args), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# tools/ws_replay_client.py
+#
+# 本地回放客户端：把视频文件逐帧编码成 JPEG，按指定帧率发给 /ws/detect，
+# 打印每帧延迟和丢帧统计。用于在没有真实内镜/超声信号时测试实时检测接口。
+#
+# 用法:
+#   python tools/ws_replay_client.py demo.mp4 --url ws://localhost:7860/ws/detect --fps 25 --annotate
+
+import argparse
+import asyncio
+import json
+import time
+
+import cv2
+import numpy as np
+import websockets
+
+
+async def replay(video_path: str, url: str, fps: float, annotate: bool, max_frames: int, quality: int) -> None:
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise SystemExit(f"Could not open video: {video_path}")
+
+    if annotate:
+        url += ("&" if "?" in url else "?") + "annotate=true"
+
+    sent_at = {}
+    latencies = []
+    server_totals = []
+    last_dropped = 0
+    received_images = 0
+
+    async with websockets.connect(url, max_size=None) as ws:
+
+        async def sender():
+            interval = 1.0 / fps if fps > 0 else 0
+            seq = 0
+            next_time = time.perf_counter()
+            while max_frames <= 0 or seq < max_frames:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                ok, buf = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+                if not ok:
+                    continue
+                seq += 1
+                sent_at[seq] = time.perf_counter()
+                await ws.send(buf.tobytes())
+                next_time += interval
+                await asyncio.sleep(max(next_time - time.perf_counter(), 0))
+            # 留一点时间接收最后几帧的结果
+            await asyncio.sleep(1.0)
+            await ws.close()
+
+        async def receiver():
+            nonlocal last_dropped, received_images
+            try:
+                async for message in ws:
+                    if isinstance(message, bytes):
+                        received_images += 1
+                        continue
+                    data = json.loads(message)
+                    if data.get("type") != "detections":
+                        print(data)
+                        continue
+                    # 服务端的 seq 与发送顺序一致
+                    rtt = (time.perf_counter() - sent_at.get(data["seq"], time.perf_counter())) * 1000
+                    latencies.append(rtt)
+                    server_totals.append(data["latency_ms"]["total"])
+                    last_dropped = data["dropped"]
+                    print(f"seq={data['seq']:5d} dets={len(data['detections']):2d} "
+                          f"rtt={rtt:7.1f}ms server={data['latency_ms']['total']:7.1f}ms "
+                          f"infer={data['latency_ms']['inference']:6.1f}ms dropped={data['dropped']}")
+            except websockets.ConnectionClosed:
+                pass
+
+        await asyncio.gather(sender(), receiver())
+
+    cap.release()
+    if latencies:
+        lat = np.array(latencies)
+        print("\n--- Summary ---")
+        print(f"Frames sent: {len(sent_at)} | processed: {len(latencies)} | dropped by server: {last_dropped}")
+        print(f"RTT p50={np.percentile(lat, 50):.1f}ms p95={np.percentile(lat, 95):.1f}ms max={lat.max():.1f}ms")
+        print(f"Server total p50={np.percentile(server_totals, 50):.1f}ms")
+        if annotate:
+            print(f"Annotated frames received: {received_images}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a local video file against /ws/detect.")
+    parser.add_argument("video", help="Path to a local video file")
+    parser.add_argument("--url", default="ws://localhost:7860/ws/detect")
+    parser.add_argument("--fps", type=float, default=25.0, help="Send rate; 0 = as fast as possible")
+    parser.add_argument("--annotate", action="store_true", help="Also receive annotated JPEG frames")
+    parser.add_argument("--max-frames", type=int, default=0)
+    parser.add_argument("--quality", type=int, default=80, help="JPEG quality of the sent frames")
+    args = parser.parse_args()
+    asyncio.run(replay(args.video, args.url, args.fps, args.annotate, args.max_frames, args.quality))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# upload_ingest.py
+
+import os
+import uuid
+import asyncio
+import time
+import hashlib
+from typing import AsyncIterator, NamedTuple
+
+from pipeline_metrics import UPLOAD_INGEST, UPLOAD_WRITE, UPLOAD_BYTES
+
+# ----------------------------------------------------
+# 1. Configuration
+# ----------------------------------------------------
+# 每次读写的块大小
+CHUNK_SIZE = 1024 * 1024
+
+# 各类上传的大小上限（字节），可用环境变量覆盖
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_UPLOAD_MB", "100")) * 1024 * 1024
+MAX_VIDEO_BYTES = int(os.environ.get("MAX_VIDEO_UPLOAD_MB", "4096")) * 1024 * 1024
+MAX_MODEL_BYTES = int(os.environ.get("MAX_MODEL_UPLOAD_MB", "1024")) * 1024 * 1024
+
+PARTIAL_PREFIX = ".partial-"
+
+# ----------------------------------------------------
+# 2. Types
+# ----------------------------------------------------
+
+class UploadTooLarge(Exception):
+    """Raised when an upload exceeds its size limit; the partial file is already removed."""
+
+
+class IngestResult(NamedTuple):
+    path: str          # 最终路径: <sha256><ext>
+    sha256: str
+    size: int
+    duplicate: bool    # 相同内容已存在，没有写第二份
+    filename: str      # 客户端原始文件名（仅用于展示）
+
+# ----------------------------------------------------
+# 3. Core Functions
+# ----------------------------------------------------
+
+def _safe_extension(filename: str) -> str:
+    ext = os.path.splitext(os.path.basename(filename or ""))[1].lower()
+    # 扩展名只用于让 OpenCV/YOLO 识别格式，过滤掉奇怪的字符
+    return ext if ext[1:].isalnum() and len(ext) <= 8 else ""
+
+
+async def ingest_stream(chunks: AsyncIterator[bytes], filename: str, upload_dir: str, max_bytes: int) -> IngestResult:
+    """
+    Writes an async stream of chunks to upload_dir while hashing it.
+    The file is stored under its content hash, so concurrent uploads of
+    the same client filename never collide and identical content is kept once.
+    """
+    os.makedirs(upload_dir, exist_ok=True)
+    ext = _safe_extension(filename)
+    partial_path = os.path.join(upload_dir, f"{PARTIAL_PREFIX}{uuid.uuid4().hex}{ext}")
+
+    hasher = hashlib.sha256()
+    size = 0
+    started = time.perf_counter()
+    write_seconds = 0.0
+    try:
+        with open(partial_path, "wb") as f:
+            async for chunk in chunks:
+                if not chunk:
+                    continue
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f"Upload exceeds limit of {max_bytes // (1024 * 1024)} MB")
+                hasher.update(chunk)
+                # 写盘放到线程里，不阻塞事件循环
+                write_started = time.perf_counter()
+                await asyncio.to_thread(f.write, chunk)
+                write_seconds += time.perf_counter() - write_started
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+
+    digest = hasher.hexdigest()
+    final_path = os.path.join(upload_dir, f"{digest}{ext}")
+    duplicate = os.path.exists(final_path)
+    if duplicate:
+        os.remove(partial_path)
+    else:
+        os.replace(partial_path, final_path)
+    UPLOAD_INGEST.observe(time.perf_counter() - started)
+    UPLOAD_WRITE.observe(write_seconds)
+    UPLOAD_BYTES.inc(size)
+    return IngestResult(final_path, digest, size, duplicate, filename)
+
+
+async def _iter_upload_file(upload) -> AsyncIterator[bytes]:
+    while True:
+        chunk = await upload.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+async def ingest_upload_file(upload, upload_dir: str, max_bytes: int) -> IngestResult:
+    """Ingests a FastAPI UploadFile (multipart form field)."""
+    return await ingest_stream(_iter_upload_file(upload), upload.filename, upload_dir, max_bytes)
+
+
+async def ingest_request_body(request, filename: str, upload_dir: str, max_bytes: int) -> IngestResult:
+    """
+    Ingests a raw request body as it arrives from the socket, without the
+    multipart spool-then-copy pass. Rejects early when Content-Length is too big.
+    """
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > max_bytes:
+        raise UploadTooLarge(f"Upload exceeds limit of {max_bytes // (1024 * 1024)} MB")
+    return await ingest_stream(request.stream(), filename, upload_dir, max_bytes)
@@ -0,0 +1,166 @@
+# video_keyframes.py
+
+import os
+import cv2
+import numpy as np
+
+# ----------------------------------------------------
+# 1. Configuration
+# ----------------------------------------------------
+# 对话/报告只需要少量代表帧，不需要整段视频
+MAX_KEYFRAMES = 6
+# 候选池大小：超过后淘汰得分最低的候选，保证内存有上限
+CANDIDATE_POOL_SIZE = MAX_KEYFRAMES * 4
+# 关键帧存储的最长边和 JPEG 质量
+KEYFRAME_MAX_EDGE = 768
+KEYFRAME_JPEG_QUALITY = 85
+# 最终挑选时 “得分” 与 “多样性” 的权重 (MMR)
+DIVERSITY_WEIGHT = 0.5
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".avi", ".mkv", ".webm")
+
+# ----------------------------------------------------
+# 2. Helper Functions
+# ----------------------------------------------------
+
+def is_video_path(path: str) -> bool:
+    return bool(path) and path.lower().endswith(VIDEO_EXTENSIONS)
+
+
+def keyframe_sheet_name(video_path: str) -> str:
+    """Contact sheet file name derived from the processed video name."""
+    stem = os.path.splitext(os.path.basename(video_path))[0]
+    return f"{stem}_keyframes.jpg"
+
+
+def resolve_context_image(context_path: str) -> str:
+    """
+    Maps a processed-video context to its keyframe contact sheet (stored next to it).
+    Image paths are returned unchanged; videos without a sheet resolve to None,
+    so the raw video is never used as image context.
+    """
+    if not is_video_path(context_path):
+        return context_path
+    sheet_path = os.path.join(os.path.dirname(context_path), keyframe_sheet_name(context_path))
+    return sheet_path if os.path.exists(sheet_path) else None
+
+
+def _downscale(frame: np.ndarray, max_edge: int) -> np.ndarray:
+    h, w = frame.shape[:2]
+    scale = max_edge / max(h, w)
+    if scale >= 1:
+        return frame.copy()
+    return cv2.resize(frame, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+
+
+def _color_histogram(frame: np.ndarray) -> np.ndarray:
+    # 在缩略图上算 H-S 直方图，足够区分场景且开销很小
+    thumb = cv2.resize(frame, (64, 64), interpolation=cv2.INTER_AREA)
+    hsv = cv2.cvtColor(thumb, cv2.COLOR_BGR2HSV)
+    hist = cv2.calcHist([hsv], [0, 1], None, [16, 8], [0, 180, 0, 256])
+    return cv2.normalize(hist, hist).flatten()
+
+
+def _hist_distance(a: np.ndarray, b: np.ndarray) -> float:
+    # Bhattacharyya: 0 = 完全相同, 1 = 完全不同
+    return float(cv2.compareHist(a, b, cv2.HISTCMP_BHATTACHARYYA))
+
+# ----------------------------------------------------
+# 3. Keyframe Selector
+# ----------------------------------------------------
+
+class KeyframeSelector:
+    """
+    Online keyframe selection over the annotated frames of one video.
+    Each frame is scored by detection density, confidence and scene change;
+    a bounded candidate pool is kept, and the final set is picked greedily
+    to balance score against visual diversity.
+    """
+
+    def __init__(self, max_keyframes: int = MAX_KEYFRAMES, pool_size: int = CANDIDATE_POOL_SIZE):
+        self.max_keyframes = max_keyframes
+        self.pool_size = max(pool_size, max_keyframes)
+        self.candidates = []
+        self._prev_hist = None
+        # save() 之后为选中关键帧的帧号（时间顺序）
+        self.saved_frame_indices = []
+
+    def add(self, frame_idx: int, frame: np.ndarray, detections: int, mean_conf: float) -> None:
+        hist = _color_histogram(frame)
+        scene_change = 1.0 if self._prev_hist is None else _hist_distance(hist, self._prev_hist)
+        self._prev_hist = hist
+
+        density = min(detections, 5) / 5.0
+        score = density + 0.5 * mean_conf + scene_change
+
+        # 池满且得分不够高时直接跳过，避免无谓的缩放拷贝
+        if len(self.candidates) >= self.pool_size:
+            worst = min(range(len(self.candidates)), key=lambda k: self.candidates[k]["score"])
+            if score <= self.candidates[worst]["score"]:
+                return
+            self.candidates.pop(worst)
+
+        self.candidates.append({
+            "frame_idx": frame_idx,
+            "frame": _downscale(frame, KEYFRAME_MAX_EDGE),
+            "hist": hist,
+            "score": score,
+            "detections": detections,
+        })
+
+    def select(self) -> list:
+        """Greedy max-marginal-relevance selection, returned in temporal order."""
+        remaining = list(self.candidates)
+        selected = []
+        while remaining and len(selected) < self.max_keyframes:
+            def mmr(c):
+                if not selected:
+                    return c["score"]
+                novelty = min(_hist_distance(c["hist"], s["hist"]) for s in selected)
+                return (1 - DIVERSITY_WEIGHT) * c["score"] + DIVERSITY_WEIGHT * novelty * 2
+            best = max(remaining, key=mmr)
+            selected.append(best)
+            remaining.remove(best)
+        return sorted(selected, key=lambda c: c["frame_idx"])
+
+    def save(self, output_dir: str, video_path: str) -> tuple:
+        """
+        Writes the selected keyframes and a single contact sheet as JPEGs.
+        :return: (keyframe_paths, sheet_path) — sheet_path is None if no frames were seen.
+        """
+        selected = self.select()
+        if not selected:
+            return [], None
+
+        os.makedirs(output_dir, exist_ok=True)
+        stem = os.path.splitext(os.path.basename(video_path))[0]
+        params = [cv2.IMWRITE_JPEG_QUALITY, KEYFRAME_JPEG_QUALITY]
+
+        keyframe_paths = []
+        for c in selected:
+            path = os.path.join(output_dir, f"{stem}_kf{c['frame_idx']:06d}.jpg")
+            cv2.imwrite(path, c["frame"], params)
+            keyframe_paths.append(path)
+
+        self.saved_frame_indices = [c["frame_idx"] for c in selected]
+        sheet_path = os.path.join(output_dir, keyframe_sheet_name(video_path))
+        cv2.imwrite(sheet_path, self._contact_sheet(selected), params)
+        return keyframe_paths, sheet_path
+
+    def _contact_sheet(self, selected: list) -> np.ndarray:
+        # 所有帧统一缩放到同一尺寸后按 2 列拼接，并标注帧号
+        cols = 1 if len(selected) == 1 else 2
+        tile_w = KEYFRAME_MAX_EDGE // cols
+        h0, w0 = selected[0]["frame"].shape[:2]
+        tile_h = max(int(h0 * tile_w / w0), 1)
+
+        tiles = []
+        for c in selected:
+            tile = cv2.resize(c["frame"], (tile_w, tile_h), interpolation=cv2.INTER_AREA)
+            cv2.putText(tile, f"#{c['frame_idx']}", (8, 24), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2, cv2.LINE_AA)
+            tiles.append(tile)
+        while len(tiles) % cols:
+            tiles.append(np.zeros_like(tiles[0]))
+
+        rows = [np.hstack(tiles[i:i + cols]) for i in range(0, len(tiles), cols)]
+        return np.vstack(rows)
@@ -0,0 +1,100 @@
+# video_streaming.py
+
+import os
+import shutil
+import subprocess
+
+# ----------------------------------------------------
+# 1. Configuration
+# ----------------------------------------------------
+# ffmpeg 负责把标注帧切成 fMP4 分片 + HLS 播放列表（OpenCV 的 VideoWriter 写不了分片格式）
+FFMPEG_BIN = os.environ.get("FFMPEG_BIN", "ffmpeg")
+
+# 每个分片的目标时长（秒）。越小首帧越快出现，但分片数量越多
+HLS_SEGMENT_SECONDS = 2
+HLS_PLAYLIST_NAME = "index.m3u8"
+HLS_INIT_NAME = "init.mp4"
+
+# ----------------------------------------------------
+# 2. Helper Functions
+# ----------------------------------------------------
+
+def hls_available() -> bool:
+    """Streaming output needs an ffmpeg binary on PATH."""
+    return shutil.which(FFMPEG_BIN) is not None
+
+
+def hls_output_dir(base_dir: str, base_name: str) -> str:
+    """Directory that holds the playlist and segments of one processing job."""
+    return os.path.join(base_dir, f"{base_name}_hls")
+
+# ----------------------------------------------------
+# 3. Segment Writer
+# ----------------------------------------------------
+
+class HLSStreamWriter:
+    """
+    Pipes annotated BGR frames into ffmpeg, which encodes H.264 and cuts
+    fragmented-MP4 HLS segments while processing is still running.
+    The playlist is an EVENT playlist: it only grows, and gets #EXT-X-ENDLIST on close().
+    """
+
+    def __init__(self, output_dir: str, width: int, height: int, fps: float,
+                 segment_seconds: float = HLS_SEGMENT_SECONDS):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.playlist_path = os.path.join(output_dir, HLS_PLAYLIST_NAME)
+        self.width = width
+        self.height = height
+
+        # 每个分片必须以关键帧开头，所以 GOP 对齐分片时长
+        gop = max(int(round(fps * segment_seconds)), 1)
+
+        cmd = [
+            FFMPEG_BIN, "-loglevel", "error", "-y",
+            "-f", "rawvideo", "-pix_fmt", "bgr24",
+            "-s", f"{width}x{height}", "-r", f"{fps:.3f}", "-i", "-",
+            # libx264 + yuv420p 要求宽高为偶数
+            "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2",
+            "-c:v", "libx264", "-preset", "veryfast", "-tune", "zerolatency",
+            "-pix_fmt", "yuv420p",
+            "-g", str(gop), "-keyint_min", str(gop), "-sc_threshold", "0",
+            "-f", "hls",
+            "-hls_time", str(segment_seconds),
+            "-hls_playlist_type", "event",
+            "-hls_segment_type", "fmp4",
+            "-hls_fmp4_init_filename", HLS_INIT_NAME,
+            "-hls_segment_filename", os.path.join(output_dir, "seg_%05d.m4s"),
+            self.playlist_path,
+        ]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def write(self, frame) -> None:
+        # 帧尺寸必须和初始化时一致，否则 rawvideo 会整体错位
+        if frame.shape[1] != self.width or frame.shape[0] != self.height:
+            raise ValueError(f"Frame size {frame.shape[1]}x{frame.shape[0]} does not match stream {self.width}x{self.height}")
+        self.proc.stdin.write(frame.tobytes())
+
+    def segments_ready(self) -> int:
+        """Number of segments already published in the playlist."""
+        try:
+            with open(self.playlist_path, "r", encoding="utf-8") as f:
+                return sum(1 for line in f if line.startswith("#EXTINF"))
+        except OSError:
+            return 0
+
+    def close(self) -> bool:
+        """Flushes the last segment and finalizes the playlist. Returns True on success."""
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        return self.proc.wait() == 0
+
+    def abort(self) -> None:
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        self.proc.kill()
+        self.proc.wait()
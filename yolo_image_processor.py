@@ -9,6 +9,9 @@ from collections import defaultdict
 # 🚨 KEY CHANGE 1: Import the entire yolo_state module
 from yolo_state import load_model, TEMP_DIR # Removed current_model
 import yolo_state  # 👈 Import the entire module
+from annotation_renderer import render_result
+from detection_context import build_image_record, save_detection_record
+from pipeline_metrics import timed, DECODE, INFERENCE, PLOT, ENCODE, DETECTION_JOBS
 
 # ----------------------------------------------------
 # Core Logic Function (Image)
@@ -57,28 +60,42 @@ def run_inference(input_image_files: list, progress=None) -> tuple:
     try:
         for i, input_path in enumerate(input_image_paths):
             
+            # 先自己解码，单独统计解码耗时；OpenCV 读不了的格式仍交给 YOLO 按路径读取
+            with timed(DECODE.labels(pipeline="image"), "cv2.imread"):
+                source = cv2.imread(input_path, cv2.IMREAD_COLOR)
+            if source is None:
+                source = input_path
+
             # 🚨 KEY CHANGE 3: Access via yolo_state.current_model
-            results = yolo_state.current_model.predict( # 👈 Change
-                source=input_path, 
-                save=False, 
-                conf=0.04, 
-                verbose=False
-            )
+            with timed(INFERENCE.labels(pipeline="image"), "predict"):
+                results = yolo_state.current_model.predict( # 👈 Change
+                    source=source, 
+                    save=False, 
+                    conf=0.04, 
+                    verbose=False
+                )
             
             result = results[0]
-            processed_image_np = result.plot() 
+            # 向量化绘制（替代 result.plot()，掩码一次混合）
+            with timed(PLOT.labels(pipeline="image"), "render_result"):
+                processed_image_np = render_result(result, yolo_state.current_model.names)
             
             processed_image_rgb = cv2.cvtColor(processed_image_np, cv2.COLOR_BGR2RGB) 
             processed_images.append(processed_image_rgb) 
             
             temp_file_name = f"qwen_input_{os.path.basename(input_path)}"
             temp_path = os.path.join(TEMP_DIR, temp_file_name)
-            cv2.imwrite(temp_path, processed_image_np) 
+            with timed(ENCODE.labels(pipeline="image"), "cv2.imwrite"):
+                cv2.imwrite(temp_path, processed_image_np) 
             last_processed_path = temp_path 
             saved_output_paths.append(temp_path)
             
             H, W, _ = processed_image_np.shape
-            total_pixels = H * W
+
+            # 结构化检测结果（类别/置信度/归一化框/掩码面积），写在输出图片旁边供问答使用
+            record = build_image_record(result, yolo_state.current_model.names, H, W,
+                                        os.path.basename(yolo_state.current_model_path or ""))
+            save_detection_record(temp_path, record)
             
             num_detections = len(result.boxes)
             all_detections.append(num_detections)
@@ -89,16 +106,11 @@ def run_inference(input_image_files: list, progress=None) -> tuple:
                 class_indices = result.boxes.cls.cpu().numpy().astype(int).tolist()
                 
                 if hasattr(result, 'masks') and result.masks is not None:
-                    mask_data = result.masks.data.cpu().numpy()
-                    
-                    for j in range(num_detections):
-                        class_id = class_indices[j]
-                        # 🚨 KEY CHANGE 4: Access via yolo_state.current_model
-                        class_name = yolo_state.current_model.names.get(class_id, f"Class {class_id}") # 👈 Change
-                        class_counts[class_name] += 1
-                        mask_area = mask_data[j].sum()
-                        area_percentage = (mask_area / total_pixels) * 100 
-                        class_mask_areas[class_name].append(area_percentage)
+                    # 面积百分比与检测记录共用同一算法（掩码在 letterbox 画布上，需扣除填充）
+                    for d in record["detections"]:
+                        class_counts[d["class"]] += 1
+                        if d["area_pct"] is not None:
+                            class_mask_areas[d["class"]].append(d["area_pct"])
                 else:
                     for class_id in class_indices:
                          # 🚨 KEY CHANGE 5: Access via yolo_state.current_model
@@ -128,12 +140,14 @@ def run_inference(input_image_files: list, progress=None) -> tuple:
                     area_stats = f" | Avg Area Pct: {avg_area_pct:.2f}%"
                 result_text += f"[{class_name}]: {count} times{area_stats}\n"
 
+        DETECTION_JOBS.labels(pipeline="image", outcome="ok").inc()
         # 修改返回值：增加 saved_output_paths
         return processed_images, result_text, float(avg_conf), last_processed_path, saved_output_paths
 
     except Exception as e:
         error_info = traceback.format_exc()
         print(f"Inference Error: {error_info}")
+        DETECTION_JOBS.labels(pipeline="image", outcome="error").inc()
         return [], f"❌ Error during inference: {e}", 0.0, None, []
 
 
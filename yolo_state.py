@@ -3,6 +3,8 @@
 import os
 from ultralytics import YOLO
 
+from metrics import gauge
+
 # ----------------------------------------------------
 # 1. Configuration Constants
 # ----------------------------------------------------
@@ -25,6 +27,10 @@ DEFAULT_MODEL_NAME = "yolo11n.pt"
 current_model: YOLO = None
 current_model_path: str = ""
 
+# 抓取时读取当前加载的模型（1 = 已加载）
+gauge("yolo_model_loaded", "Currently loaded YOLO model.", ("model",),
+      lambda: {os.path.basename(current_model_path): 1} if current_model is not None else {})
+
 # ----------------------------------------------------
 # 3. Model Loading Function
 # ----------------------------------------------------
@@ -5,35 +5,63 @@ import numpy as np
 import cv2
 import traceback
 import json
+import uuid
+import time
 from collections import defaultdict
 import yolo_state 
+from video_streaming import HLSStreamWriter, hls_available
+from video_keyframes import KeyframeSelector
+from annotation_renderer import render_result
+from detection_context import VideoDetectionStats, save_detection_record
+from pipeline_metrics import (
+    timed, tracked, DECODE, INFERENCE, PLOT, ENCODE, VIDEO_FPS, VIDEO_FRAMES, VIDEO_JOB,
+    VIDEO_JOBS_ACTIVE, DETECTION_JOBS,
+)
 
 # ----------------------------------------------------
 # Core Logic Function (Video with Generator)
 # ----------------------------------------------------
 
-def process_video_entry(pt_file_obj, input_video_path):
+def process_video_entry(pt_file_obj, input_video_path, stream_dir=None, job_id=None):
     """
     Generator function that streams progress and finally returns the result.
+    If stream_dir is given (and ffmpeg is available), annotated frames are also
+    cut into HLS segments under stream_dir while processing runs.
+    job_id goes into the output file name (a random one when omitted): uploads are
+    named by content hash, so two jobs on the same video must not share outputs.
     Yields JSON strings:
     - {"type": "progress", "current": 10, "total": 100, "log": "Processing..."}
+    - {"type": "stream", "playlist_path": ".../index.m3u8"}  (once, when the first segment is ready)
     - {"type": "result", "data": { ... }}
     - {"type": "error", "message": "..."}
     """
+    # 运行中的任务数（video_jobs_active），客户端断开时生成器被关闭也会减回去
+    with tracked(VIDEO_JOBS_ACTIVE):
+        yield from _process_video(pt_file_obj, input_video_path, stream_dir, job_id or new_job_id())
+
+
+def new_job_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+
+def _process_video(pt_file_obj, input_video_path, stream_dir, job_id):
     
     # 1. Load Model
     load_status = yolo_state.load_model(pt_file_obj)
     if yolo_state.current_model is None:
+        DETECTION_JOBS.labels(pipeline="video", outcome="error").inc()
         yield json.dumps({"type": "error", "message": f"Model load failed: {load_status}"})
         return
 
     if not input_video_path or not os.path.exists(input_video_path):
+        DETECTION_JOBS.labels(pipeline="video", outcome="error").inc()
         yield json.dumps({"type": "error", "message": "Input video file not found."})
         return
 
     # 2. Setup Video Capture
     cap = cv2.VideoCapture(input_video_path)
     if not cap.isOpened():
+        DETECTION_JOBS.labels(pipeline="video", outcome="error").inc()
         yield json.dumps({"type": "error", "message": "Could not open video file."})
         return
     
@@ -62,7 +90,7 @@ def process_video_entry(pt_file_obj, input_video_path):
     # --- 修复 2：强制输出文件名必须是 .mp4 ---
     # 无论输入是 .mov 还是 .avi，输出统一为 .mp4 以保证浏览器兼容性
     base_name = os.path.splitext(os.path.basename(input_video_path))[0]
-    output_video_path = os.path.join(os.path.dirname(input_video_path), f"{base_name}_processed.mp4")
+    output_video_path = os.path.join(os.path.dirname(input_video_path), f"{base_name}_{job_id}_processed.mp4")
     
     # --- 修复 3：关键的编码器选择 ---
     # 浏览器只认 H.264 (avc1)。
@@ -87,17 +115,43 @@ def process_video_entry(pt_file_obj, input_video_path):
 
     if out is None or not out.isOpened():
         cap.release()
+        DETECTION_JOBS.labels(pipeline="video", outcome="error").inc()
         yield json.dumps({"type": "error", "message": "Failed to initialize Video Writer (Codec issue)."})
         return
 
+    # --- 可选：边处理边输出 HLS 分片 ---
+    stream_writer = None
+    if stream_dir:
+        if hls_available():
+            try:
+                stream_writer = HLSStreamWriter(stream_dir, width, height, new_fps)
+            except Exception as e:
+                print(f"DEBUG: Failed to start HLS stream writer: {e}")
+        else:
+            print("DEBUG: ffmpeg not found, streaming output disabled.")
+    stream_announced = False
+    stream_closed = False
+
     frame_idx = 0
     processed_count = 0
     total_detections = 0
     class_counts = defaultdict(int)
+    # 挑选少量代表帧，供后续问答/报告使用（代替整段视频）
+    keyframe_selector = KeyframeSelector()
+    # 各阶段的观测对象提前取好，循环里不再查标签
+    decode_metric = DECODE.labels(pipeline="video")
+    inference_metric = INFERENCE.labels(pipeline="video")
+    plot_metric = PLOT.labels(pipeline="video")
+    encode_metric = ENCODE.labels(pipeline="video")
+    job_started = time.perf_counter()
+    # 按类别汇总的检测统计（次数/置信度/出现时间），写成结构化记录供问答使用
+    detection_stats = VideoDetectionStats(original_fps)
     
     try:
         while cap.isOpened():
-            ret, frame = cap.read()
+            # 跳过的帧同样要解码，一并计入
+            with timed(decode_metric, "cap.read"):
+                ret, frame = cap.read()
             if not ret:
                 break
             
@@ -108,23 +162,47 @@ def process_video_entry(pt_file_obj, input_video_path):
 
             # --- 推理 ---
             # 增加 verbose=False 防止后台日志爆炸
-            results = yolo_state.current_model.predict(source=frame, save=False, conf=0.25, verbose=False)
+            with timed(inference_metric, "predict"):
+                results = yolo_state.current_model.predict(source=frame, save=False, conf=0.25, verbose=False)
             result = results[0]
             
-            # 绘图
-            plotted_frame = result.plot()
+            # 绘图（向量化渲染，替代 result.plot()）
+            with timed(plot_metric, "render_result"):
+                plotted_frame = render_result(result, yolo_state.current_model.names)
             
             # 写入视频
-            out.write(plotted_frame)
+            with timed(encode_metric, "out.write"):
+                out.write(plotted_frame)
+            if stream_writer:
+                try:
+                    stream_writer.write(plotted_frame)
+                except Exception as e:
+                    # 流式输出只是锦上添花，ffmpeg 挂了也不影响最终 MP4
+                    print(f"DEBUG: HLS stream writer failed, disabling: {e}")
+                    stream_writer.abort()
+                    stream_writer = None
+            if stream_writer:
+                # 第一个分片落盘后通知前端，可以开始播放了
+                if not stream_announced and stream_writer.segments_ready() > 0:
+                    stream_announced = True
+                    yield json.dumps({"type": "stream", "playlist_path": stream_writer.playlist_path}) + "\n"
             
             # 统计
             det_count = len(result.boxes)
             total_detections += det_count
+            mean_conf = 0.0
+            frame_classes, frame_confs = [], []
             if det_count > 0:
                 class_indices = result.boxes.cls.cpu().numpy().astype(int).tolist()
                 for cls_id in class_indices:
                     name = yolo_state.current_model.names.get(cls_id, str(cls_id))
                     class_counts[name] += 1
+                    frame_classes.append(name)
+                frame_confs = result.boxes.conf.cpu().numpy().tolist()
+                mean_conf = float(np.mean(frame_confs))
+            detection_stats.add(frame_idx, frame_classes, frame_confs)
+
+            keyframe_selector.add(frame_idx, plotted_frame, det_count, mean_conf)
 
             # --- 实时 Yield 进度 ---
             progress_data = {
@@ -138,11 +216,24 @@ def process_video_entry(pt_file_obj, input_video_path):
 
             frame_idx += 1
             processed_count += 1
+            VIDEO_FRAMES.inc()
 
         # --- 循环结束 ---
         # 必须显式释放资源，否则文件尾部数据会丢失导致无法播放
         out.release() 
         cap.release()
+        if stream_writer:
+            # 收尾：写出最后一个分片并补上 #EXT-X-ENDLIST
+            stream_ok = stream_writer.close()
+            stream_closed = True
+            if stream_ok and not stream_announced:
+                yield json.dumps({"type": "stream", "playlist_path": stream_writer.playlist_path}) + "\n"
+
+        elapsed = time.perf_counter() - job_started
+        VIDEO_JOB.observe(elapsed)
+        if processed_count and elapsed > 0:
+            VIDEO_FPS.observe(processed_count / elapsed)
+        DETECTION_JOBS.labels(pipeline="video", outcome="ok").inc()
 
         result_text = f"✨ Inference Complete!\n"
         result_text += f"Format: {used_codec.upper()} / .mp4\n"
@@ -154,20 +245,35 @@ def process_video_entry(pt_file_obj, input_video_path):
             for name, count in class_counts.items():
                 result_text += f"{name}: {count}\n"
 
+        # 关键帧直接写到 TEMP_DIR，拼图作为问答上下文（JPEG，远小于原视频）
+        keyframe_paths, keyframe_sheet_path = keyframe_selector.save(yolo_state.TEMP_DIR, output_video_path)
+        if keyframe_sheet_path:
+            record = detection_stats.record(width, height, os.path.basename(yolo_state.current_model_path or ""),
+                                            keyframe_selector.saved_frame_indices)
+            save_detection_record(keyframe_sheet_path, record)
+
         final_data = {
             "type": "result",
             "data": {
                 "output_path": output_video_path,
                 "text": result_text,
                 "fps": new_fps,
-                # 关键：返回 context_path 用于后续问答
-                "context_path": output_video_path 
+                # 关键：返回 context_path 用于后续问答（优先使用关键帧拼图）
+                "context_path": keyframe_sheet_path or output_video_path,
+                "keyframe_paths": keyframe_paths,
+                "playlist_path": stream_writer.playlist_path if stream_writer and stream_ok else None
             }
         }
         yield json.dumps(final_data) + "\n"
 
     except Exception as e:
         traceback.print_exc()
-        if out: out.release()
-        if cap: cap.release()
-        yield json.dumps({"type": "error", "message": f"Processing error: {str(e)}"}) + "\n"
\ No newline at end of file
+        DETECTION_JOBS.labels(pipeline="video", outcome="error").inc()
+        yield json.dumps({"type": "error", "message": f"Processing error: {str(e)}"}) + "\n"
+    finally:
+        # 客户端断开时 yield 处抛出的是 GeneratorExit（不是 Exception），清理必须放在 finally：
+        # 否则 ffmpeg 子进程要等 Popen 被回收才结束。release() 重复调用是安全的
+        out.release()
+        cap.release()
+        if stream_writer and not stream_closed:
+            stream_writer.abort()
\ No newline at end of file